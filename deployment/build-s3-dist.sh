@@ -84,7 +84,9 @@ pip install -r ../requirements.txt --target .
 zip -r9 ../dist/cfn-add-edge-lambda.zip .
 popd
 
-zip -g dist/cfn-add-edge-lambda.zip *.py
+zip -g dist/cfn-add-edge-lambda.zip cfn-add-edge-lambda.py
+# shared CloudFront distribution patch module
+zip -g -j dist/cfn-add-edge-lambda.zip ../cloudfront-patch/distribution_patch.py
 
 cp "./dist/cfn-add-edge-lambda.zip" "$build_dist_dir/cfn-add-edge-lambda.zip"
 
@@ -130,7 +132,9 @@ pip install -r ../requirements.txt --target .
 zip -r9 ../dist/cfn-init-clustered-video-stream.zip .
 popd
 
-zip -g dist/cfn-init-clustered-video-stream.zip *.py
+zip -g dist/cfn-init-clustered-video-stream.zip cfn-init-clustered-video-stream.py
+# shared CloudFront distribution patch module
+zip -g -j dist/cfn-init-clustered-video-stream.zip ../cloudfront-patch/distribution_patch.py
 
 cp "./dist/cfn-init-clustered-video-stream.zip" "$build_dist_dir/cfn-init-clustered-video-stream.zip"
 
@@ -153,10 +157,89 @@ pip install -r ../requirements.txt --target .
 zip -r9 ../dist/cfn-s3copyobjects.zip .
 popd
 
-zip -g dist/cfn-s3copyobjects.zip *.py
+zip -g dist/cfn-s3copyobjects.zip cfn-s3copyobjects.py
 
 cp "./dist/cfn-s3copyobjects.zip" "$build_dist_dir/cfn-s3copyobjects.zip"
 
+echo "------------------------------------------------------------------------------"
+echo "[Rebuild] Copilot edge lambda"
+echo "------------------------------------------------------------------------------"
+
+cd $source_dir/copilot || exit
+
+[ -e dist ] && rm -r dist
+mkdir -p dist
+
+# boto3 is provided by the Lambda runtime, keep the edge package small
+zip -9 dist/copilot.zip copilot.py state_reader.py
+
+cp "./dist/copilot.zip" "$build_dist_dir/copilot.zip"
+
+echo "------------------------------------------------------------------------------"
+echo "[Rebuild] Copilot package Custom Resources"
+echo "------------------------------------------------------------------------------"
+
+cd $source_dir/cfn-package-copilot || exit
+
+[ -e dist ] && rm -r dist
+mkdir -p dist
+
+[ -e package ] && rm -r package
+mkdir -p package
+
+# Make lambda package
+pushd package
+echo "Create lambda package"
+pip install -r ../requirements.txt --target .
+zip -r9 ../dist/cfn-package-copilot.zip .
+popd
+
+zip -g dist/cfn-package-copilot.zip *.py
+
+cp "./dist/cfn-package-copilot.zip" "$build_dist_dir/cfn-package-copilot.zip"
+
+echo "------------------------------------------------------------------------------"
+echo "[Rebuild] Playlist alert handler"
+echo "------------------------------------------------------------------------------"
+
+cd $source_dir/playlist-alert-handler || exit
+
+[ -e dist ] && rm -r dist
+mkdir -p dist
+
+# boto3 is provided by the Lambda runtime
+zip -9 dist/playlist-alert-handler.zip playlist-alert-handler.py
+
+cp "./dist/playlist-alert-handler.zip" "$build_dist_dir/playlist-alert-handler.zip"
+
+echo "------------------------------------------------------------------------------"
+echo "[Rebuild] State history"
+echo "------------------------------------------------------------------------------"
+
+cd $source_dir/state-history || exit
+
+[ -e dist ] && rm -r dist
+mkdir -p dist
+
+# boto3 is provided by the Lambda runtime
+zip -9 dist/state-history.zip state-history.py
+
+cp "./dist/state-history.zip" "$build_dist_dir/state-history.zip"
+
+echo "------------------------------------------------------------------------------"
+echo "[Rebuild] Playlist invalidator"
+echo "------------------------------------------------------------------------------"
+
+cd $source_dir/playlist-invalidator || exit
+
+[ -e dist ] && rm -r dist
+mkdir -p dist
+
+# boto3 is provided by the Lambda runtime
+zip -9 dist/playlist-invalidator.zip playlist-invalidator.py
+
+cp "./dist/playlist-invalidator.zip" "$build_dist_dir/playlist-invalidator.zip"
+
 echo "------------------------------------------------------------------------------"
 echo "[Rebuild] Build web page assets"
 echo "------------------------------------------------------------------------------"
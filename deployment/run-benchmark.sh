@@ -0,0 +1,24 @@
+#!/bin/bash
+#
+# This assumes all of the OS-level configuration has been completed and git repo has already been cloned
+#
+# This script should be run from the repo's deployment directory
+# cd deployment
+# ./run-benchmark.sh
+#
+
+# Get reference for all important folders
+template_dir="$PWD"
+source_dir="$template_dir/../source"
+
+echo "------------------------------------------------------------------------------"
+echo "[Benchmark] Copilot"
+echo "------------------------------------------------------------------------------"
+# Set COPILOT_BASELINE to a report from a previous run to fail on regressions
+cd $source_dir/copilot
+pip install boto3
+if [ -n "$COPILOT_BASELINE" ]; then
+    python3 benchmark/bench_copilot.py --output "$template_dir/copilot-benchmark.json" --baseline "$COPILOT_BASELINE" || exit 1
+else
+    python3 benchmark/bench_copilot.py --output "$template_dir/copilot-benchmark.json" || exit 1
+fi
@@ -34,8 +34,21 @@ echo "find ../ -type f -name 'package-lock.json' -delete"
 find $source_dir/simulator -type f -name 'package-lock.json' -delete
 
 echo "------------------------------------------------------------------------------"
-echo "[Test] Services - Example Function"
+echo "[Test] Python unit tests"
 echo "------------------------------------------------------------------------------"
-cd $source_dir/example-function-js
-npm install
-npm test
+# each module is tested next to its source, the copilot benchmark is run by
+# run-benchmark.sh
+pip install boto3 crhelper pytest
+cd $source_dir
+python3 -m pytest -q \
+    copilot \
+    cvs-control \
+    playlist-alert-handler \
+    playlist-invalidator \
+    state-history \
+    cfn-init-clustered-video-stream \
+    cloudfront-patch \
+    segment-health-check \
+    cfn-s3copyobjects \
+    cfn-add-edge-lambda \
+    --ignore=copilot/benchmark || exit 1
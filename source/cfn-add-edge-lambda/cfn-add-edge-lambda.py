@@ -5,13 +5,16 @@ from crhelper import CfnResource
 import boto3
 import logging
 import json
-import copy
+from concurrent.futures import ThreadPoolExecutor
+from distribution_patch import deadline_of, is_deployed, patch_distribution, summarize
 
 logger = logging.getLogger(__name__)
 # Initialise the helper, all inputs are optional, this example shows the defaults
+# the poll functions run every minute until the distribution is deployed
 helper = CfnResource(json_logging=False,
                      log_level='DEBUG',
-                     boto_level='CRITICAL')
+                     boto_level='CRITICAL',
+                     polling_interval=1)
 
 try:
     ## Init code goes here
@@ -21,6 +24,9 @@ except Exception as e:
 
 client = boto3.client('cloudfront')
 
+# distributions patched at the same time, CloudFront throttles update calls
+MAX_CONCURRENCY = 4
+
 
 def update_cache_behavior(behavior, lambda_association):
     # only proceed if this is not a smooth streaming behavior
@@ -66,37 +72,58 @@ def remove_cache_behavior(behavior, lambda_association):
             behavior["LambdaFunctionAssociations"]["Items"])
 
 
-def handler(event, context):
-    helper(event, context)
-
+def get_distribution_ids(properties):
+    """
+    Return the distribution ids of a resource. Ids is a list of distribution
+    ids, or of region:distribution-id entries as used for StreamInstances.
+    Resources created before Ids existed pass a single Id.
+    """
+    if "Ids" in properties:
+        ids = [x.strip().split(":")[-1].strip() for x in properties["Ids"] if x.strip()]
+    elif "Id" in properties:
+        ids = [properties["Id"]]
+    else:
+        raise ValueError("Missing property 'Ids'")
+    if not ids:
+        raise ValueError("Property 'Ids' is empty")
+    # keep the order, drop duplicates
+    return list(dict.fromkeys(ids))
 
-@helper.create
-@helper.update
-def create(event, context):
-    logger.info("Create or Update")
-    logger.info(json.dumps(event))
 
+def get_lambda_association(properties):
     # Check that all the required properties are specified
-    if "Id" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'Id'")
-    if "LambdaFunctionARN" not in event["ResourceProperties"]:
+    if "LambdaFunctionARN" not in properties:
         raise ValueError("Missing property 'LambdaFunctionARN'")
-    if "EventType" not in event["ResourceProperties"]:
+    if "EventType" not in properties:
         raise ValueError("Missing property 'EventType'")
 
-    lambda_association = {
-        "LambdaFunctionARN": event["ResourceProperties"]["LambdaFunctionARN"],
-        "EventType": event["ResourceProperties"]["EventType"],
+    return {
+        "LambdaFunctionARN": properties["LambdaFunctionARN"],
+        "EventType": properties["EventType"],
         "IncludeBody": False
     }
 
-    try:
-        response = client.get_distribution_config(
-            Id=event["ResourceProperties"]["Id"])
 
-        config = copy.deepcopy(response["DistributionConfig"])
-        saved_config = copy.deepcopy(response["DistributionConfig"])
+def for_each_distribution(distribution_ids, function, properties):
+    """
+    Call function for every distribution with a bounded number of workers and
+    return a dict of distribution id to (result, exception)
+    """
+    max_workers = max(1, min(int(properties.get("MaxConcurrency", MAX_CONCURRENCY)), len(distribution_ids)))
+
+    def call(distribution_id):
+        try:
+            return function(distribution_id), None
+        except Exception as e:
+            logger.exception("Distribution {} failed".format(distribution_id))
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(distribution_ids, executor.map(call, distribution_ids)))
 
+
+def associate(lambda_association):
+    def mutate(config):
         # handle the DefaultCacheBehavior key first
         update_cache_behavior(config["DefaultCacheBehavior"],
                               lambda_association)
@@ -104,15 +131,102 @@ def create(event, context):
         # handle cache behaviors
         for behavior in config["CacheBehaviors"].get("Items", []):
             update_cache_behavior(behavior, lambda_association)
+    return mutate
+
+
+def disassociate(lambda_association):
+    def mutate(config):
+        # handle the DefaultCacheBehavior key first
+        remove_cache_behavior(config["DefaultCacheBehavior"],
+                              lambda_association)
+
+        # handle cache behaviors
+        for behavior in config["CacheBehaviors"].get("Items", []):
+            remove_cache_behavior(behavior, lambda_association)
+    return mutate
+
+
+def is_missing(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code") == "NoSuchDistribution"
+
+
+def all_deployed(distribution_ids, properties):
+    results = for_each_distribution(distribution_ids,
+                                    lambda x: is_deployed(client, x),
+                                    properties)
+    # a distribution that cannot be read is polled again, unless it is gone
+    return all(deployed or is_missing(e) for deployed, e in results.values())
+
+
+def report(results, action):
+    """
+    Put the result of every distribution in the resource Data, and fail the
+    resource if any distribution failed
+    """
+    failed = {k: e for k, (_, e) in results.items() if e is not None}
+    done = {k: r for k, (r, e) in results.items() if e is None}
+    for distribution_id, result in done.items():
+        helper.Data[distribution_id] = "changed" if result["Changed"] else "unchanged"
+    helper.Data["Changed"] = str(any(r["Changed"] for r in done.values())).lower()
+    helper.Data["Changes"] = ";".join("{}:{}".format(k, summarize(r, 200)) for k, r in done.items() if r["Changed"])
+    if failed:
+        # CloudFormation rolls back by sending the previous properties, or a
+        # delete after a failed create, which undoes the distributions that
+        # were changed
+        raise RuntimeError("Failed to {} {} of {} distributions: {}. Changed: {}".format(
+            action, len(failed), len(results),
+            "; ".join("{} ({})".format(k, e) for k, e in failed.items()),
+            ", ".join(k for k, r in done.items() if r["Changed"]) or "none"))
+
+
+def handler(event, context):
+    helper(event, context)
+
+
+@helper.create
+@helper.update
+def create(event, context):
+    logger.info("Create or Update")
+    logger.info(json.dumps(event))
+
+    properties = event["ResourceProperties"]
+    distribution_ids = get_distribution_ids(properties)
+    lambda_association = get_lambda_association(properties)
+    # conflicts are only retried while the invocation has time to report
+    deadline = deadline_of(context)
+
+    # update each distribution only if the association changes anything
+    mutate = associate(lambda_association)
+    results = for_each_distribution(distribution_ids,
+                                    lambda x: patch_distribution(client, x, mutate, deadline=deadline),
+                                    properties)
+
+    # remove the association from distributions dropped by a stack update
+    if event["RequestType"] == "Update":
+        old_properties = event["OldResourceProperties"]
+        removed = [x for x in get_distribution_ids(old_properties) if x not in distribution_ids]
+        if removed:
+            mutate = disassociate(get_lambda_association(old_properties))
+            results.update(for_each_distribution(removed,
+                                                 lambda x: patch_distribution(client, x, mutate,
+                                                                              deadline=deadline),
+                                                 properties))
+
+    report(results, "update")
 
-        # update CloudFormation and wait for the response
-        response = client.update_distribution(
-            DistributionConfig=config,
-            Id=event["ResourceProperties"]["Id"],
-            IfMatch=response["ETag"])
 
-    except Exception as e:
-        raise e
+@helper.poll_create
+@helper.poll_update
+def poll_create(event, context):
+    logger.info("Poll Create or Update")
+    distribution_ids = get_distribution_ids(event["ResourceProperties"])
+    if event["RequestType"] == "Update":
+        distribution_ids += [x for x in get_distribution_ids(event["OldResourceProperties"]) if x not in distribution_ids]
+    # returning None keeps polling. Updates keep their physical resource id,
+    # True lets crhelper generate one on create.
+    if all_deployed(distribution_ids, event["ResourceProperties"]):
+        return event.get("PhysicalResourceId") or True
+    return None
 
 
 @helper.delete
@@ -121,39 +235,23 @@ def delete(event, context):
     # Delete never returns anything. Should not fail if the underlying resources are already deleted.
     # Desired state.
 
-    # Check that all the required properties are specified
-    if "Id" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'Id'")
-    if "LambdaFunctionARN" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'LambdaFunctionARN'")
-    if "EventType" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'EventType'")
-
-    lambda_association = {
-        "LambdaFunctionARN": event["ResourceProperties"]["LambdaFunctionARN"],
-        "EventType": event["ResourceProperties"]["EventType"],
-        "IncludeBody": False
-    }
+    properties = event["ResourceProperties"]
+    distribution_ids = get_distribution_ids(properties)
+    lambda_association = get_lambda_association(properties)
+    deadline = deadline_of(context)
 
     # delete any associated L@E functions with our Lambda ARN
-    try:
-        # get the distribution
-        response = client.get_distribution_config(
-            Id=event["ResourceProperties"]["Id"])
-        config = response["DistributionConfig"]
-
-        # handle the DefaultCacheBehavior key first
-        remove_cache_behavior(config["DefaultCacheBehavior"],
-                              lambda_association)
-
-        # handle cache behaviors
-        for behavior in config["CacheBehaviors"].get("Items", []):
-            remove_cache_behavior(behavior, lambda_association)
+    mutate = disassociate(lambda_association)
+    results = for_each_distribution(distribution_ids,
+                                    lambda x: patch_distribution(client, x, mutate, deadline=deadline),
+                                    properties)
+    # distributions that were already deleted have nothing to remove
+    results = {k: (r, e) for k, (r, e) in results.items() if not is_missing(e)}
+    report(results, "remove the association from")
 
-        # update the distribution with changes
-        client.update_distribution(DistributionConfig=config,
-                                   Id=event["ResourceProperties"]["Id"],
-                                   IfMatch=response["ETag"])
 
-    except Exception as e:
-        raise e
+@helper.poll_delete
+def poll_delete(event, context):
+    logger.info("Poll Delete")
+    # the copilot can only be deleted once no deployed distribution uses it
+    return True if all_deployed(get_distribution_ids(event["ResourceProperties"]), event["ResourceProperties"]) else None
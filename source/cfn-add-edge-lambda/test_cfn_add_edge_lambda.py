@@ -0,0 +1,120 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the cfn-add-edge-lambda custom resource. CloudFront is
+# replaced with a fake that keeps one config per distribution and fails the
+# updates of chosen distributions, no AWS account is needed.
+
+import copy
+import importlib.util
+import os
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ARN = "arn:aws:lambda:us-east-1:123456789012:function:copilot:3"
+
+
+class FakeCloudFront:
+    def __init__(self, ids, failing=()):
+        self.configs = {x: {
+            "DefaultCacheBehavior": {"LambdaFunctionAssociations": {"Quantity": 0}},
+            "CacheBehaviors": {"Quantity": 1, "Items": [{"LambdaFunctionAssociations": {"Quantity": 0}}]}
+        } for x in ids}
+        self.failing = set(failing)
+        self.updates = []
+        self.lock = threading.Lock()
+
+    def get_distribution_config(self, Id):
+        if Id not in self.configs:
+            raise ClientError({"Error": {"Code": "NoSuchDistribution"}}, "GetDistributionConfig")
+        return {"DistributionConfig": copy.deepcopy(self.configs[Id]), "ETag": "E1"}
+
+    def update_distribution(self, DistributionConfig, Id, IfMatch):
+        if Id in self.failing:
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "UpdateDistribution")
+        with self.lock:
+            self.updates.append(Id)
+            self.configs[Id] = DistributionConfig
+        return {"ETag": "E2"}
+
+    def arns(self, distribution_id):
+        config = self.configs[distribution_id]
+        behaviors = [config["DefaultCacheBehavior"]] + config["CacheBehaviors"]["Items"]
+        return [[x["LambdaFunctionARN"] for x in b["LambdaFunctionAssociations"].get("Items", [])]
+                for b in behaviors]
+
+
+@pytest.fixture
+def edge(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # distribution_patch.py is added to the deployment package by the build
+    monkeypatch.syspath_prepend(os.path.join(HERE, "..", "cloudfront-patch"))
+    spec = importlib.util.spec_from_file_location("cfn_add_edge_lambda", os.path.join(HERE, "cfn-add-edge-lambda.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def event(request_type, ids, old_ids=None):
+    properties = {"Ids": ids, "LambdaFunctionARN": ARN, "EventType": "origin-request"}
+    result = {"RequestType": request_type, "ResourceProperties": properties}
+    if old_ids is not None:
+        result["OldResourceProperties"] = dict(properties, Ids=old_ids)
+    return result
+
+
+def test_one_failing_distribution_does_not_stop_the_others(edge):
+    edge.client = FakeCloudFront(["E1", "E2", "E3"], failing=["E2"])
+    with pytest.raises(RuntimeError) as error:
+        edge.create(event("Create", ["us-west-2:E1", "us-east-1:E2", "eu-west-1:E3"]), None)
+    assert "1 of 3" in str(error.value) and "E2" in str(error.value)
+    assert "Changed: E1, E3" in str(error.value)
+    assert sorted(edge.client.updates) == ["E1", "E3"]
+    assert edge.client.arns("E1") == edge.client.arns("E3") == [[ARN], [ARN]]
+    assert edge.helper.Data["E1"] == edge.helper.Data["E3"] == "changed"
+    assert "E2" not in edge.helper.Data
+    assert edge.helper.Data["Changed"] == "true"
+
+
+def test_for_each_distribution_keeps_the_error_of_each_id(edge):
+    def function(distribution_id):
+        if distribution_id == "E2":
+            raise ValueError(distribution_id)
+        return distribution_id.lower()
+    results = edge.for_each_distribution(["E1", "E2", "E3"], function, {"MaxConcurrency": "2"})
+    assert list(results) == ["E1", "E2", "E3"]
+    assert results["E1"] == ("e1", None) and results["E3"] == ("e3", None)
+    assert results["E2"][0] is None and isinstance(results["E2"][1], ValueError)
+
+
+def test_unchanged_distributions_are_not_updated(edge):
+    edge.client = FakeCloudFront(["E1", "E2"])
+    edge.create(event("Create", ["E1", "E2"]), None)
+    edge.client.updates.clear()
+    edge.create(event("Update", ["E1", "E2"], ["E1", "E2"]), None)
+    assert edge.client.updates == []
+    assert edge.helper.Data["Changed"] == "false"
+
+
+def test_update_removes_the_association_from_dropped_distributions(edge):
+    edge.client = FakeCloudFront(["E1", "E2", "E3"])
+    edge.create(event("Create", ["E1", "E2", "E3"]), None)
+    edge.create(event("Update", ["E1", "E3"], ["E1", "E2", "E3"]), None)
+    assert edge.client.arns("E2") == [[], []]
+    assert edge.client.arns("E1") == [[ARN], [ARN]]
+
+
+def test_delete_skips_deleted_distributions_and_reports_failures(edge):
+    edge.client = FakeCloudFront(["E1", "E2", "E3"])
+    edge.create(event("Create", ["E1", "E2", "E3"]), None)
+    del edge.client.configs["E1"]
+    edge.client.failing.add("E3")
+    with pytest.raises(RuntimeError) as error:
+        edge.delete(event("Delete", ["E1", "E2", "E3"]), None)
+    assert "1 of 2" in str(error.value) and "E3" in str(error.value)
+    assert edge.client.arns("E2") == [[], []]
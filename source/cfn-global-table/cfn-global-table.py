@@ -2,164 +2,213 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # Adapted from: https://github.com/kspurrier/cfn-dynamodb-global-table/blob/master/DynamoDBGlobalTableCreate/dynamoDBGlobalTableCreate.py
-
+#
+# Make the state table a global table with a replica in every region of
+# ReplicationGroupList, and report success once every replica is ACTIVE.
+#
+# Two versions of global tables are supported:
+#
+#   2017.11.29  the table already exists in every region, as created by the
+#               clustered-video-stream-instance stacks. All replica changes
+#               are sent in a single update_global_table call.
+#   2019.11.21  the table exists in this region only, and DynamoDB creates
+#               the replicas. DynamoDB accepts one replica change at a time,
+#               so each poll sends the next change once the table is ACTIVE.
+#
+# A table that is already global keeps its version. GlobalTableVersion
+# chooses the version of a table that is not global yet.
+
+from crhelper import CfnResource
 import boto3
-import cfnresponse
+import datetime
 import json
 import logging
 import os
 
-logger = logging.getLogger()
+logger = logging.getLogger(__name__)
+helper = CfnResource(json_logging=False,
+                     log_level=os.environ.get('LoggingLevel') or 'WARNING',
+                     boto_level='CRITICAL',
+                     polling_interval=1)
+
+try:
+    ## Init code goes here
+    pass
+except Exception as e:
+    helper.init_failure(e)
+
+region = os.environ['AWS_REGION']
+client = boto3.client('dynamodb')
+cloudwatch = boto3.client('cloudwatch')
+
+LEGACY = '2017.11.29'
+CURRENT = '2019.11.21'
+
+
+def get_properties(event):
+    properties = event['ResourceProperties']
+    if 'GlobalTableName' not in properties:
+        raise ValueError("Missing property 'GlobalTableName'")
+    if 'ReplicationGroupList' not in properties:
+        raise ValueError("Missing property 'ReplicationGroupList'")
+    version = properties.get('GlobalTableVersion') or LEGACY
+    if version not in (LEGACY, CURRENT):
+        raise ValueError("GlobalTableVersion must be {} or {}".format(LEGACY, CURRENT))
+    regions = [x.strip() for x in properties['ReplicationGroupList'] if x.strip()]
+    return properties['GlobalTableName'], set(regions), version
+
+
+def get_version(table_name, requested):
+    """
+    Return the global table version of a table, or the requested version if
+    the table is not global yet
+    """
+    table = client.describe_table(TableName=table_name)['Table']
+    if table.get('GlobalTableVersion'):
+        return table['GlobalTableVersion']
+    try:
+        client.describe_global_table(GlobalTableName=table_name)
+        return LEGACY
+    except client.exceptions.GlobalTableNotFoundException:
+        return requested
 
-if 'LoggingLevel' in os.environ.keys() and os.environ['LoggingLevel']:
-   log_level = logging.getLevelName(os.environ['LoggingLevel'])
-else:
-   log_level = logging.getLevelName('WARNING')
 
-log_handler = logger.handlers[0]
+def legacy_replicas(table_name):
+    """
+    Return the regions of a 2017.11.29 global table, or None if the table is
+    not global
+    """
+    try:
+        response = client.describe_global_table(GlobalTableName=table_name)
+    except client.exceptions.GlobalTableNotFoundException:
+        return None
+    return {x['RegionName'] for x in response['GlobalTableDescription']['ReplicationGroup']}
+
+
+def legacy_apply(table_name, regions):
+    """
+    Create the global table, or add and remove all replicas in one call
+    """
+    existing = legacy_replicas(table_name)
+    if existing is None:
+        logger.info('Creating DynamoDB Global Table {} in {}'.format(table_name, sorted(regions)))
+        client.create_global_table(GlobalTableName=table_name,
+                                   ReplicationGroup=[{'RegionName': x} for x in sorted(regions)])
+        return
+    updates = [{'Create': {'RegionName': x}} for x in sorted(regions - existing)]
+    updates += [{'Delete': {'RegionName': x}} for x in sorted(existing - regions)]
+    if not updates:
+        logger.info('No replication group changes detected')
+        return
+    logger.info('Updating DynamoDB Global Table {}: {}'.format(table_name, json.dumps(updates)))
+    client.update_global_table(GlobalTableName=table_name, ReplicaUpdates=updates)
+
+
+def legacy_ready(table_name):
+    response = client.describe_global_table(GlobalTableName=table_name)
+    status = response['GlobalTableDescription']['GlobalTableStatus']
+    logger.info('Global Table {} is {}'.format(table_name, status))
+    return status == 'ACTIVE'
+
+
+def next_replica_update(table, regions):
+    """
+    Return the next replica change for a 2019.11.21 global table, or None
+    """
+    replicas = {x['RegionName'] for x in table.get('Replicas', [])}
+    # the table in this region is the source, it is never a replica update
+    missing = sorted(regions - replicas - {region})
+    if missing:
+        return {'Create': {'RegionName': missing[0]}}
+    extra = sorted(replicas - regions - {region})
+    if extra:
+        return {'Delete': {'RegionName': extra[0]}}
+    return None
+
+
+def current_step(table_name, regions):
+    """
+    Send the next replica change if the table can take one. Return True once
+    every replica is in place and ACTIVE.
+    """
+    table = client.describe_table(TableName=table_name)['Table']
+    replica_status = {x['RegionName']: x.get('ReplicaStatus') for x in table.get('Replicas', [])}
+    logger.info('Table {} is {}, replicas {}'.format(table_name, table['TableStatus'], json.dumps(replica_status)))
+    if table['TableStatus'] != 'ACTIVE':
+        return False
+    update = next_replica_update(table, regions)
+    if update is None:
+        return all(status == 'ACTIVE' for status in replica_status.values())
+    if any(status not in ('ACTIVE', None) for status in replica_status.values()):
+        # a replica is still being created or deleted
+        return False
+    logger.info('Updating table {} replicas: {}'.format(table_name, json.dumps(update)))
+    try:
+        client.update_table(TableName=table_name, ReplicaUpdates=[update])
+    except client.exceptions.ResourceInUseException:
+        logger.info('Table {} is busy, retrying on the next poll'.format(table_name))
+    return False
+
+
+def replication_latency(table_name, regions):
+    """
+    Return the average ReplicationLatency in ms over the last five minutes
+    from this region to every other replica, as resource Data
+    """
+    data = {}
+    end = datetime.datetime.utcnow()
+    for receiving in sorted(regions - {region}):
+        response = cloudwatch.get_metric_statistics(
+            Namespace='AWS/DynamoDB',
+            MetricName='ReplicationLatency',
+            Dimensions=[{'Name': 'TableName', 'Value': table_name},
+                        {'Name': 'ReceivingRegion', 'Value': receiving}],
+            StartTime=end - datetime.timedelta(minutes=5),
+            EndTime=end,
+            Period=300,
+            Statistics=['Average'])
+        points = response.get('Datapoints', [])
+        # no datapoints until something has been written to the table
+        data['ReplicationLatencyMs-' + receiving] = '{:.1f}'.format(points[0]['Average']) if points else 'none'
+    return data
 
-if log_level == 30:
-   log_handler.setFormatter(logging.Formatter('%(message)s'))
-else:
-   log_handler.setFormatter(logging.Formatter('[%(levelname)s]: %(message)s'))
 
-logger.setLevel(log_level)
+def handler(event, context):
+    helper(event, context)
 
 
-def global_table_create(event, context):
+@helper.create
+@helper.update
+def create(event, context):
     logger.info(json.dumps(event))
-    global_table_name = event['ResourceProperties']['GlobalTableName']
-
+    table_name, regions, requested = get_properties(event)
+    version = get_version(table_name, requested)
+    logger.info('Global Table {} uses version {}'.format(table_name, version))
+    if version == LEGACY:
+        legacy_apply(table_name, regions)
+    helper.Data.update({'GlobalTableName': table_name, 'GlobalTableVersion': version,
+                        'LogGroup': context.log_group_name})
+    return table_name
+
+
+@helper.poll_create
+@helper.poll_update
+def poll_create(event, context):
+    table_name, regions, _ = get_properties(event)
+    if event['CrHelperData']['GlobalTableVersion'] == LEGACY:
+        ready = legacy_ready(table_name)
+    else:
+        ready = current_step(table_name, regions)
+    if not ready:
+        return None
     try:
-        resp = {'Status': 'FAILED', 'Data': {'GlobalTableName': global_table_name, 'LogGroup': context.log_group_name }}
-        client = boto3.client('dynamodb')
-
-        logger.debug('Creating DynamoDB Global Table ' + global_table_name)
-        response = {}
-        replication_group = []
-
-        for region in event['ResourceProperties']['ReplicationGroupList']:
-            replication_group.append({ 'RegionName': region})
-
-        response = client.create_global_table(
-            GlobalTableName=global_table_name,
-            ReplicationGroup=replication_group
-        )
-        logger.info(response)
-        resp['Reason'] = 'Created Global Table: ' + global_table_name
-        resp['Status'] = 'SUCCESS'
-
-    except client.exceptions.GlobalTableAlreadyExistsException as e:
-        logger.info('Global Table already exists, falling back to update logic: ' + e.message )
-        # Describe the already existing global table, so we can attempt to update instead
-        response = {}
-        response = client.describe_global_table(
-            GlobalTableName=global_table_name
-        )
-
-        logger.debug(response)
-
-        existing_replication_group_list = []
-        for region in response['GlobalTableDescription']['ReplicationGroup']:
-            logger.debug('Existing Replication Group List')
-            existing_replication_group_list.append(region['RegionName'])
-        event['OldResourceProperties']= { 'ReplicationGroupList': existing_replication_group_list }
-        response = global_table_update(event,context)
-        return response
-
+        helper.Data.update(replication_latency(table_name, regions))
     except Exception as e:
-        logger.error('Failed to create DynamoDB Global Table: ' + global_table_name)
-        resp['Reason'] = 'Failed to create DynamoDB Global Table: ' + e.message 
-        resp['Status'] = 'FAILED'
-    
-    return resp
+        logger.warning('Failed to read replication latency: {}'.format(e))
+    return event['CrHelperData']['PhysicalResourceId']
 
-def global_table_update(event, context):
-    logger.debug(json.dumps(event))
-    global_table_name = event['ResourceProperties']['GlobalTableName']
 
-    try:
-        resp = {'Status': 'FAILED', 'Data': {'GlobalTableName': global_table_name, 'LogGroup': context.log_group_name }}
-        client = boto3.client('dynamodb')
-
-        # Describe the existing global table, as we cannot trust the provided
-        # event['OldResourceProperties']['ReplicationGroupList']) to show the
-        # current actual replication group list for a stack update failure / rollback.
-        response = {}
-        response = client.describe_global_table(
-            GlobalTableName=global_table_name
-        )
-        logger.debug(response)
-
-        existing_replication_groups = set() 
-        for region in response['GlobalTableDescription']['ReplicationGroup']:
-            existing_replication_groups.add(region['RegionName'])
-
-        new_rep_groups = set(event['ResourceProperties']['ReplicationGroupList'])
-        old_rep_groups = set(event['OldResourceProperties']['ReplicationGroupList'])
-
-        changeset_rep_group_discrepancies = old_rep_groups - existing_replication_groups
-        if len(changeset_rep_group_discrepancies):
-            logger.info("Using the results of describe_global_table rather than the value from OldResourceProperties in the event")
-            # Use reality, not the value from OldResourceProperties in the event
-            old_rep_groups = existing_replication_groups
-
-        if new_rep_groups == old_rep_groups:
-            logger.info('No replication group changes detected')
-            resp['Reason'] = 'No replication group changes detected'
-            resp['Status'] = 'SUCCESS'
-            return resp
-        else:
-            logger.info('Replication group changes detected. Updating Global Table')
-
-        AddReplicationGroups = new_rep_groups - old_rep_groups
-        RemoveReplicationGroups = old_rep_groups - new_rep_groups
-
-        if len(AddReplicationGroups):
-            for region in AddReplicationGroups:
-                update_global_table(global_table_name, region, 'Create')
-                logger.info('Add replication group region: ' + region)
-
-        if len(RemoveReplicationGroups):
-            for region in RemoveReplicationGroups:
-                update_global_table(global_table_name, region, 'Delete')
-                logger.info('Remove replication group region: ' + region)
-
-        resp['Reason'] = 'Updated Global Table: ' + global_table_name
-        resp['Status'] = 'SUCCESS'
-    except Exception as e:
-        logger.error('Failed to update DynamoDB Global Table: ' + global_table_name)
-        resp['Reason'] = 'Failed to update Global Table: ' + e.message
-        resp['Status'] = 'FAILED'
-    
-    return resp
-
-def update_global_table(global_table_name, region, action):
-    client = boto3.client('dynamodb')
-    ReplicaUpdates = []
-    ReplicaUpdate = {}
-    ReplicationGroup = {}
-    ReplicationGroup['RegionName'] = region
-    ReplicaUpdate[action] = ReplicationGroup
-    ReplicaUpdates.append(ReplicaUpdate)
-
-    response = client.update_global_table(
-        GlobalTableName=global_table_name,
-        ReplicaUpdates=ReplicaUpdates
-    )
-
-    return response
-
-
-def handler(event, context):
-  if event['RequestType'] == 'Create':
-    response = global_table_create(event,context)
-  if event['RequestType'] == 'Delete':
-    response = {'Status': 'SUCCESS', 'Data': { 'LogGroup': context.log_group_name }}
-  if event['RequestType'] == 'Update':
-    response = global_table_update(event,context)
-
-  if 'Reason' in response.keys():
-    cfnresponse.send(event, context, log_level, response['Status'], response['Data'], response['Reason'])
-  else:
-    cfnresponse.send(event, context, log_level, response['Status'], response['Data'])
\ No newline at end of file
+@helper.delete
+def delete(event, context):
+    # the replicas are left in place, the tables belong to the instance stacks
+    logger.info('Got Delete')
@@ -1,50 +0,0 @@
-#  Copyright 2016 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
-#  This file is licensed to you under the AWS Customer Agreement (the "License").
-#  You may not use this file except in compliance with the License.
-#  A copy of the License is located at http://aws.amazon.com/agreement/ .
-#  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
-#  See the License for the specific language governing permissions and limitations under the License.
-
-from botocore.vendored import requests
-import json
-import logging
-
-SUCCESS = "SUCCESS"
-FAILED = "FAILED"
-
-def send(event, context, logLevel, responseStatus, responseData, failureReason=None, physicalResourceId=None):
-    log_level = logLevel
-    logger = logging.getLogger()
-    log_handler = logger.handlers[0]
-    if log_level == 30:
-       log_handler.setFormatter(logging.Formatter("%(message)s"))
-    else:
-       log_handler.setFormatter(logging.Formatter("[%(levelname)s]: %(message)s"))
-    logger.setLevel(log_level)
-
-    responseUrl = event['ResponseURL']
-    responseBody = {}
-    responseBody['Status'] = responseStatus
-    responseBody['Reason'] = failureReason or 'See the details in CloudWatch Log Stream: ' + context.log_stream_name
-    responseBody['PhysicalResourceId'] = physicalResourceId or context.log_stream_name
-    responseBody['StackId'] = event['StackId']
-    responseBody['RequestId'] = event['RequestId']
-    responseBody['LogicalResourceId'] = event['LogicalResourceId']
-    responseBody['Data'] = responseData
-
-    json_responseBody = json.dumps(responseBody)
-
-    logger.info("Response body:\n"+json_responseBody)
-
-    headers = {
-        'content-type' : '',
-        'content-length' : str(len(json_responseBody))
-    }
-
-    try:
-        response = requests.put(responseUrl,
-                                data=json_responseBody,
-                                headers=headers)
-        logger.warning("Status code: " + response.reason)
-    except Exception as e:
-        logger.error("send(..) failed executing requests.put(..): " + str(e))
\ No newline at end of file
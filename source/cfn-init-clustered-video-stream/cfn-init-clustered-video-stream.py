@@ -5,12 +5,17 @@ from crhelper import CfnResource
 import boto3
 import logging
 import json
-import copy
 import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from distribution_patch import deadline_of, is_deployed, patch_distribution, summarize
 
 logger = logging.getLogger(__name__)
 # Initialise the helper, all inputs are optional, this example shows the defaults
-helper = CfnResource(json_logging=False, log_level='DEBUG', boto_level='CRITICAL')
+# the poll functions run every minute until the master playlist distribution is deployed
+helper = CfnResource(json_logging=False, log_level='DEBUG', boto_level='CRITICAL', polling_interval=1)
 
 try:
     ## Init code goes here
@@ -22,8 +27,253 @@ region = os.environ['AWS_REGION']
 dynamodb_resource = boto3.resource('dynamodb', region_name=region)
 cloudfront_client = boto3.client('cloudfront')
 
+# names of the first two stream instances, kept from the two region layout
+INSTANCE_NAMES = ["(1) Primary Region", "(2) Secondary Region"]
+
+# origin latency probes: requests per origin, and the timeout of each request
+PROBE_SAMPLES = 3
+PROBE_TIMEOUT = 2.0
+
+# CloudFront origin groups have exactly two members
+GROUP_SIZE = 2
+
+FAILOVER_STATUS_CODES = [500, 502, 503, 504]
+
+
+def get_stream_instances(properties):
+    """
+    Return a list of (region, distribution id) for each stream instance.
+
+    StreamInstances is a list of "region:distribution-id" strings, in
+    priority order. Stacks created before it existed pass RegionOne and
+    RegionTwo with their distribution ids instead.
+    """
+    instances = [x.strip() for x in properties.get("StreamInstances", []) if x.strip()]
+    if instances:
+        stream_instances = []
+        for instance in instances:
+            if instance.count(":") != 1:
+                raise ValueError("StreamInstances entry '{}' is not region:distribution-id".format(instance))
+            region, distribution_id = [x.strip() for x in instance.split(":")]
+            stream_instances.append((region, distribution_id))
+        return stream_instances
+
+    if "RegionOneCloudfrontDistributionId" not in properties:
+        raise ValueError("Missing property 'RegionOneCloudfrontDistributionId'")
+    if "RegionTwoCloudfrontDistributionId" not in properties:
+        raise ValueError("Missing property 'RegionTwoCloudfrontDistributionId'")
+    if "RegionOne" not in properties:
+        raise ValueError("Missing property 'RegionOne'")
+    if "RegionTwo" not in properties:
+        raise ValueError("Missing property 'RegionTwo'")
+    return [(properties["RegionOne"], properties["RegionOneCloudfrontDistributionId"]),
+            (properties["RegionTwo"], properties["RegionTwoCloudfrontDistributionId"])]
+
+
+def get_domains(stream_instances):
+    """
+    Look up the CloudFront domain of every stream instance concurrently
+    """
+    def get_domain(instance):
+        response = cloudfront_client.get_distribution(Id=instance[1])
+        return response["Distribution"]["DomainName"]
+
+    with ThreadPoolExecutor(max_workers=min(10, len(stream_instances))) as executor:
+        return list(executor.map(get_domain, stream_instances))
+
+
+def instance_name(index):
+    if index < len(INSTANCE_NAMES):
+        return INSTANCE_NAMES[index]
+    return "({}) Region {}".format(index + 1, index + 1)
+
+
+def get_origin_latency(properties):
+    """
+    Return the supplied latency of origins as {origin id or domain: ms}.
+
+    OriginLatency is a list of "origin:ms" strings, where origin is an origin
+    id or domain name. "origin:down" marks an origin as unhealthy.
+    """
+    supplied = {}
+    for entry in [x.strip() for x in properties.get("OriginLatency", []) if x.strip()]:
+        if ":" not in entry:
+            raise ValueError("OriginLatency entry '{}' is not origin:ms".format(entry))
+        origin, value = [x.strip() for x in entry.rsplit(":", 1)]
+        supplied[origin] = None if value.lower() == "down" else float(value)
+    return supplied
+
+
+def origin_url(origin, path):
+    if "CustomOriginConfig" in origin:
+        custom = origin["CustomOriginConfig"]
+        if custom.get("OriginProtocolPolicy") == "http-only":
+            scheme, port = "http", custom.get("HTTPPort", 80)
+        else:
+            scheme, port = "https", custom.get("HTTPSPort", 443)
+        host = origin["DomainName"] if port in (80, 443) else "{}:{}".format(origin["DomainName"], port)
+    else:
+        scheme, host = "https", origin["DomainName"]
+    return "{}://{}{}/{}".format(scheme, host, origin.get("OriginPath", ""), path.lstrip("/"))
+
+
+def probe(url):
+    """
+    Return the median time to the response headers of url in ms, or None if
+    the origin does not answer or answers with a server error. Client errors
+    count as healthy, S3 origins answer 403 without the origin access identity.
+    """
+    samples = []
+    for _ in range(PROBE_SAMPLES):
+        start = time.time()
+        try:
+            urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=PROBE_TIMEOUT).close()
+        except urllib.error.HTTPError as e:
+            if e.code >= 500:
+                logger.info("probe {} answered {}".format(url, e.code))
+                return None
+        except Exception as e:
+            logger.info("probe {} failed: {}".format(url, e))
+            return None
+        samples.append((time.time() - start) * 1000)
+    return sorted(samples)[len(samples) // 2]
+
+
+def rank_origins(config, supplied):
+    """
+    Return the origins of a distribution config as a list of
+    (origin id, latency in ms or None when unhealthy), healthy and fastest
+    first. Origins keep their config order when latencies are equal.
+    """
+    origins = config["Origins"]["Items"]
+    path = config.get("DefaultRootObject") or ""
+
+    def latency(origin):
+        for key in (origin["Id"], origin["DomainName"]):
+            if key in supplied:
+                return supplied[key]
+        return probe(origin_url(origin, path))
+
+    with ThreadPoolExecutor(max_workers=min(10, len(origins))) as executor:
+        latencies = list(executor.map(latency, origins))
+    ranking = sorted(enumerate(zip([x["Id"] for x in origins], latencies)),
+                     key=lambda x: (x[1][1] is None, x[1][1] or 0, x[0]))
+    return [x[1] for x in ranking]
+
+
+def origin_group(group_id, members):
+    return {
+        "Id": group_id,
+        "FailoverCriteria": {
+            "StatusCodes": {
+                "Quantity": len(FAILOVER_STATUS_CODES),
+                "Items": list(FAILOVER_STATUS_CODES)
+            }
+        },
+        "Members": {
+            "Quantity": len(members),
+            "Items": [{"OriginId": x} for x in members]
+        }
+    }
+
+
+def group_origins(config, name, ranking):
+    """
+    Build the origin groups from a ranking and point the cache behaviors at
+    them, in place.
+
+    The first group holds the two fastest origins and serves the default
+    behavior. With more origins, each origin after the first also leads a
+    group with the next origin in the ranking as its failover, and a cache
+    behavior that targets an origin gets the group that origin leads, so every
+    behavior keeps its first-try origin and gains a failover. A behavior that
+    targets a group of an earlier ranking gets the group its first origin
+    leads now, since group ids follow the ranking.
+    """
+    # the first-try origin of each existing group, before the groups change
+    leaders = {x["Id"]: x["Members"]["Items"][0]["OriginId"]
+               for x in config.get("OriginGroups", {}).get("Items", [])}
+    ranked = [x[0] for x in ranking]
+    # origins added since the ranking go last
+    ranked += [x["Id"] for x in config["Origins"]["Items"] if x["Id"] not in ranked]
+    if len(ranked) < GROUP_SIZE:
+        return
+    groups = {}
+    for index, origin_id in enumerate(ranked[:-1]):
+        group_id = name + "-OriginGroup" if index == 0 else "{}-OriginGroup-{}".format(name, index + 1)
+        groups[origin_id] = origin_group(group_id, ranked[index:index + GROUP_SIZE])
+    group_ids = [x["Id"] for x in groups.values()]
+    config["OriginGroups"] = {"Quantity": len(groups), "Items": list(groups.values())}
+
+    config["DefaultCacheBehavior"]["TargetOriginId"] = group_ids[0]
+    for behavior in config.get("CacheBehaviors", {}).get("Items", []):
+        target = leaders.get(behavior["TargetOriginId"], behavior["TargetOriginId"])
+        if target in groups:
+            behavior["TargetOriginId"] = groups[target]["Id"]
+        elif target in ranked:
+            # the last origin leads no group, its behaviors target it directly
+            behavior["TargetOriginId"] = target
+        elif target.startswith(name + "-OriginGroup"):
+            # a group whose first origin was removed from the distribution
+            behavior["TargetOriginId"] = group_ids[0]
+
+
+def ungroup_origins(config):
+    """
+    Point the cache behaviors back at the first member of their origin group
+    and remove the groups, in place
+    """
+    groups = {x["Id"]: x["Members"]["Items"][0]["OriginId"]
+              for x in config.get("OriginGroups", {}).get("Items", [])}
+    for behavior in [config["DefaultCacheBehavior"]] + config.get("CacheBehaviors", {}).get("Items", []):
+        behavior["TargetOriginId"] = groups.get(behavior["TargetOriginId"], behavior["TargetOriginId"])
+    if "OriginGroups" in config:
+        config["OriginGroups"]["Quantity"] = 0
+        config["OriginGroups"]["Items"] = []
+
+
+def order_origins(name, distribution_id, supplied, deadline=None):
+    """
+    Rank the origins of the master playlist distribution and rebuild its
+    origin groups from the ranking. Returns the ranking and the patch result.
+    """
+    config = cloudfront_client.get_distribution_config(Id=distribution_id)["DistributionConfig"]
+    ranking = rank_origins(config, supplied)
+    logger.info("Origin ranking: {}".format(json.dumps(ranking)))
+    # the ranking is applied again to a fresh config after a conflict
+    result = patch_distribution(cloudfront_client, distribution_id,
+                                lambda config: group_origins(config, name, ranking), deadline=deadline)
+    return ranking, result
+
+
+def format_ranking(ranking):
+    return ",".join("{}:{}".format(origin_id, "down" if latency is None else int(round(latency)))
+                    for origin_id, latency in ranking)
+
+
+def put_stream_instance(table, domain, name, region):
+    """
+    Create the state table item of a stream instance, open, or update the
+    name and region of an existing one. Everything else on an existing item,
+    such as distro_open, drain_percent or the health of the stream instance,
+    belongs to the operator and the health checks and is kept.
+    """
+    table.update_item(
+        Key={"domain": domain},
+        UpdateExpression="SET #name = :name, #region = :region, distro_open = if_not_exists(distro_open, :open)",
+        ExpressionAttributeNames={"#name": "name", "#region": "region"},
+        ExpressionAttributeValues={":name": name, ":region": region, ":open": True})
+
 
 def handler(event, context):
+    if "RequestType" not in event:
+        # invoked directly to rank the origins again, with the properties of
+        # the custom resource as the event
+        ranking, result = order_origins(event["ClusteredVideoStreamName"],
+                                        event["MasterPlaylistDistributionId"],
+                                        get_origin_latency(event), deadline_of(context))
+        return {"OriginRanking": format_ranking(ranking), "Changed": result["Changed"],
+                "Changes": result["Changes"]}
     helper(event, context)
 
 @helper.update
@@ -41,84 +291,34 @@ def create(event, context):
         raise ValueError("Missing property 'ClusteredVideoStreamName'")
     if "MasterPlaylistDistributionId" not in event["ResourceProperties"]:
         raise ValueError("Missing property 'MasterPlaylistDistributionId'")
-    if "RegionOneCloudfrontDistributionId" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionOneCloudfrontDistributionId'")
-    if "RegionTwoCloudfrontDistributionId" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionTwoCloudfrontDistributionId'")
-    if "RegionOne" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionOne'")
-    if "RegionTwo" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionTwo'")   
+    stream_instances = get_stream_instances(event["ResourceProperties"])
 
     try:
-        # Create state table entries for each region in the clustered video stream
-
-        # Region One
-        response = cloudfront_client.get_distribution(Id=event["ResourceProperties"]["RegionOneCloudfrontDistributionId"])
-
-        config = response["Distribution"]
-        item = {}
-        item["name"] = "(1) Primary Region"
-        item["domain"] = config["DomainName"]
-        item["region"] = event["ResourceProperties"]["RegionOne"]
-        item["distro_open"] = True
+        # Create state table entries for each stream instance in the clustered video stream
+        domains = get_domains(stream_instances)
 
         table = dynamodb_resource.Table(event["ResourceProperties"]["ClusteredVideoStreamName"])
-        response = table.put_item(Item=item)
-        
-        # Region Two
-        response = cloudfront_client.get_distribution(Id=event["ResourceProperties"]["RegionTwoCloudfrontDistributionId"])
-
-        config = response["Distribution"]  
-        item["name"] = "(2) Secondary Region"
-        item["domain"] = config["DomainName"]
-        item["region"] = event["ResourceProperties"]["RegionTwo"]
-        item["distro_open"] = True
-
-        response = table.put_item(Item=item)
-
-        # Create a cloudfront origin group using all the origins in the master playlist
-
-        new_origin_groups = {
-            "Quantity": 1,
-            "Items": [{
-                "Id": event["ResourceProperties"]["ClusteredVideoStreamName"]+"-"+"OriginGroup",
-                "FailoverCriteria": {
-                "StatusCodes": {
-                    "Quantity": 4,
-                    "Items": [
-                        500,
-                        502,
-                        503,
-                        504
-                        ]
-                    }
-                },
-                "Members": {
-                    "Quantity": 0,
-                    "Items": [
-                        
-                    ]}
-                }]
-            }
-
-        response = cloudfront_client.get_distribution_config(Id=event["ResourceProperties"]["MasterPlaylistDistributionId"])
-
-        config = copy.deepcopy(response["DistributionConfig"]) 
-
-        
-
-        for origin in config["Origins"]["Items"]:
-            new_origin_group_member = {
-                "OriginId": origin["Id"]
-            }
-            
-            new_origin_groups["Items"][0]["Members"]["Quantity"] = new_origin_groups["Items"][0]["Members"]["Quantity"] + 1
-            new_origin_groups["Items"][0]["Members"]["Items"].append(new_origin_group_member)
-
-        config["OriginGroups"] = new_origin_groups
-
-        response = cloudfront_client.update_distribution(DistributionConfig=config, Id=event["ResourceProperties"]["MasterPlaylistDistributionId"], IfMatch=response["ETag"])
+        for index, (region, _) in enumerate(stream_instances):
+            put_stream_instance(table, domains[index], instance_name(index), region)
+
+        with table.batch_writer() as batch:
+            # remove the entries of stream instances dropped by a stack update
+            if event["RequestType"] == "Update":
+                old_instances = get_stream_instances(event["OldResourceProperties"])
+                removed = [x for x in old_instances if x[1] not in [y[1] for y in stream_instances]]
+                if removed:
+                    for domain in get_domains(removed):
+                        if domain not in domains:
+                            batch.delete_item(Key={'domain': domain})
+
+        # Group the origins of the master playlist, fastest first
+        ranking, result = order_origins(event["ResourceProperties"]["ClusteredVideoStreamName"],
+                                        event["ResourceProperties"]["MasterPlaylistDistributionId"],
+                                        get_origin_latency(event["ResourceProperties"]),
+                                        deadline_of(context))
+        helper.Data["OriginRanking"] = format_ranking(ranking)
+        helper.Data["Changed"] = str(result["Changed"]).lower()
+        helper.Data["Changes"] = summarize(result)
     
     except Exception as e:
         raise e
@@ -126,6 +326,16 @@ def create(event, context):
     return "MyResourceId"
 
 
+@helper.poll_create
+@helper.poll_update
+def poll_create(event, context):
+    logger.info("Got Poll Create")
+    # returning None keeps polling, the physical resource id completes the resource
+    if is_deployed(cloudfront_client, event["ResourceProperties"]["MasterPlaylistDistributionId"]):
+        return event["CrHelperData"]["PhysicalResourceId"]
+    return None
+
+
 @helper.delete
 def delete(event, context):
     logger.info("Got Delete")
@@ -137,50 +347,29 @@ def delete(event, context):
         raise ValueError("Missing property 'ClusteredVideoStreamName'")
     if "MasterPlaylistDistributionId" not in event["ResourceProperties"]:
         raise ValueError("Missing property 'MasterPlaylistDistributionId'")
-    if "RegionOneCloudfrontDistributionId" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionOneCloudfrontDistributionId'")
-    if "RegionTwoCloudfrontDistributionId" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionTwoCloudfrontDistributionId'")
-    if "RegionOne" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionOne'")
-    if "RegionTwo" not in event["ResourceProperties"]:
-        raise ValueError("Missing property 'RegionTwo'") 
+    stream_instances = get_stream_instances(event["ResourceProperties"])
 
     # Delete the associated the origin group from the master playlist distributionn
     try:
 
-        # Delete RegionOne domain
-        response = cloudfront_client.get_distribution(Id=event["ResourceProperties"]["RegionOneCloudfrontDistributionId"])
-
-        config = response["Distribution"]
-        domain = config["DomainName"]
-
-        table = dynamodb_resource.Table(event["ResourceProperties"]["ClusteredVideoStreamName"])
-
-        response = table.delete_item(Key={'domain': domain})
-
-        # Delete RegionTwo domain
-        response = cloudfront_client.get_distribution(Id=event["ResourceProperties"]["RegionTwoCloudfrontDistributionId"])
-
-        config = response["Distribution"]
-        domain = config["DomainName"]
+        # Delete the state table entry of each stream instance
+        domains = get_domains(stream_instances)
 
         table = dynamodb_resource.Table(event["ResourceProperties"]["ClusteredVideoStreamName"])
-
-        response = table.delete_item(Key={'domain': domain})
+        with table.batch_writer() as batch:
+            for domain in domains:
+                batch.delete_item(Key={'domain': domain})
 
         # Delete OriginGroup
-        response = cloudfront_client.get_distribution_config(Id=event["ResourceProperties"]["MasterPlaylistDistributionId"])
-        config = response["DistributionConfig"] 
-
-        if "OriginGroups" in config:
-            config["OriginGroups"]["Quantity"] = 0
-            config["OriginGroups"]["Items"] = []
-
-        response = cloudfront_client.update_distribution(DistributionConfig=config, Id=event["ResourceProperties"]["MasterPlaylistDistributionId"], IfMatch=response["ETag"])
+        patch_distribution(cloudfront_client, event["ResourceProperties"]["MasterPlaylistDistributionId"], ungroup_origins,
+                           deadline=deadline_of(context))
         
     except Exception as e:
         raise e
     
 
 
+@helper.poll_delete
+def poll_delete(event, context):
+    logger.info("Got Poll Delete")
+    return True if is_deployed(cloudfront_client, event["ResourceProperties"]["MasterPlaylistDistributionId"]) else None
@@ -0,0 +1,80 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the cfn-init-clustered-video-stream custom resource. The
+# distribution configs are plain dicts, no AWS account is needed.
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def init():
+    os.environ.setdefault("AWS_REGION", "us-west-2")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    # distribution_patch.py is added to the deployment package by the build
+    sys.path.insert(0, os.path.join(HERE, "..", "cloudfront-patch"))
+    spec = importlib.util.spec_from_file_location(
+        "cfn_init_clustered_video_stream", os.path.join(HERE, "cfn-init-clustered-video-stream.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def distribution_config(origins, behaviors):
+    return {
+        "Origins": {"Quantity": len(origins), "Items": [{"Id": x, "DomainName": x + ".example.com"} for x in origins]},
+        "DefaultCacheBehavior": {"TargetOriginId": origins[0]},
+        "CacheBehaviors": {"Quantity": len(behaviors),
+                           "Items": [{"PathPattern": path, "TargetOriginId": target} for path, target in behaviors]}
+    }
+
+
+def first_try(config, target):
+    groups = {x["Id"]: x["Members"]["Items"][0]["OriginId"] for x in config["OriginGroups"]["Items"]}
+    return groups.get(target, target)
+
+
+def test_behaviors_get_the_group_their_origin_leads(init):
+    config = distribution_config(["a", "b", "c"], [("/b/*", "b"), ("/c/*", "c")])
+    init.group_origins(config, "cvs", [("a", 10), ("b", 20), ("c", 30)])
+    assert config["DefaultCacheBehavior"]["TargetOriginId"] == "cvs-OriginGroup"
+    behaviors = config["CacheBehaviors"]["Items"]
+    assert behaviors[0]["TargetOriginId"] == "cvs-OriginGroup-2"
+    assert first_try(config, behaviors[0]["TargetOriginId"]) == "b"
+    # the slowest origin leads no group
+    assert behaviors[1]["TargetOriginId"] == "c"
+
+
+def test_rerank_keeps_the_first_try_origin_of_behaviors(init):
+    config = distribution_config(["a", "b", "c"], [("/b/*", "b"), ("/a/*", "a")])
+    init.group_origins(config, "cvs", [("a", 10), ("b", 20), ("c", 30)])
+    before = [first_try(config, x["TargetOriginId"]) for x in config["CacheBehaviors"]["Items"]]
+    init.group_origins(config, "cvs", [("c", 10), ("a", 20), ("b", 30)])
+    after = [first_try(config, x["TargetOriginId"]) for x in config["CacheBehaviors"]["Items"]]
+    assert before == after == ["b", "a"]
+    assert first_try(config, config["DefaultCacheBehavior"]["TargetOriginId"]) == "c"
+
+
+def test_ungroup_restores_the_first_try_origins(init):
+    config = distribution_config(["a", "b", "c"], [("/b/*", "b")])
+    init.group_origins(config, "cvs", [("b", 10), ("c", 20), ("a", 30)])
+    init.ungroup_origins(config)
+    assert config["OriginGroups"]["Items"] == []
+    assert config["DefaultCacheBehavior"]["TargetOriginId"] == "b"
+    assert config["CacheBehaviors"]["Items"][0]["TargetOriginId"] == "b"
+
+
+def test_stream_instance_update_keeps_the_operator_state(init):
+    class Table:
+        def update_item(self, **kwargs):
+            self.update = kwargs
+    table = Table()
+    init.put_stream_instance(table, "d0.cloudfront.net", "(1) Primary Region", "us-west-2")
+    assert "distro_open = if_not_exists(distro_open, :open)" in table.update["UpdateExpression"]
+    assert table.update["ExpressionAttributeValues"][":open"] is True
@@ -0,0 +1,106 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Lambda@Edge functions cannot use environment variables, so this resource
+# builds the copilot deployment package for one clustered video stream by
+# adding a copilot_config.json file to the generic copilot.zip.
+
+from crhelper import CfnResource
+import boto3
+import copy
+import hashlib
+import io
+import logging
+import json
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+# Initialise the helper, all inputs are optional, this example shows the defaults
+helper = CfnResource(json_logging=False, log_level='DEBUG', boto_level='CRITICAL')
+
+try:
+    ## Init code goes here
+    pass
+except Exception as e:
+    helper.init_failure(e)
+
+client = boto3.client('s3')
+cloudfront_client = boto3.client('cloudfront')
+
+CONFIG_FILE_NAME = "copilot_config.json"
+
+
+def resolve_stream_instances(stream_instances):
+    """
+    Replace "region:distribution-id" entries, as used by the
+    clustered-video-stream stack, with the domain and region the copilot
+    needs. Entries that are already maps are kept as they are.
+    """
+    def resolve(instance):
+        if isinstance(instance, dict):
+            return instance
+        region, distribution_id = [x.strip() for x in instance.split(":")]
+        response = cloudfront_client.get_distribution(Id=distribution_id)
+        return {"domain": response["Distribution"]["DomainName"], "region": region}
+
+    instances = [x for x in stream_instances if isinstance(x, dict) or x.strip()]
+    with ThreadPoolExecutor(max_workers=max(1, min(10, len(instances)))) as executor:
+        return list(executor.map(resolve, instances))
+
+
+def handler(event, context):
+    helper(event, context)
+
+
+@helper.create
+@helper.update
+def create(event, context):
+    logger.info("Got Create or Update")
+    logger.info(json.dumps(event))
+
+    # Check that all the required properties are specified
+    if "SourceBucket" not in event["ResourceProperties"]:
+        raise ValueError("Missing property 'SourceBucket'")
+    if "SourceKey" not in event["ResourceProperties"]:
+        raise ValueError("Missing property 'SourceKey'")
+    if "Bucket" not in event["ResourceProperties"]:
+        raise ValueError("Missing property 'Bucket'")
+    if "Config" not in event["ResourceProperties"]:
+        raise ValueError("Missing property 'Config'")
+
+    config = copy.deepcopy(event["ResourceProperties"]["Config"])
+    config["stream_instances"] = resolve_stream_instances(config.get("stream_instances", []))
+    config = json.dumps(config, sort_keys=True, indent=2)
+
+    response = client.get_object(Bucket=event["ResourceProperties"]["SourceBucket"],
+                                 Key=event["ResourceProperties"]["SourceKey"])
+    package = io.BytesIO(response["Body"].read())
+    with zipfile.ZipFile(package, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+        if CONFIG_FILE_NAME in archive.namelist():
+            raise ValueError("Source package already contains {}".format(CONFIG_FILE_NAME))
+        # fixed timestamp so the same code and configuration give the same package
+        info = zipfile.ZipInfo(CONFIG_FILE_NAME, date_time=(1980, 1, 1, 0, 0, 0))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        archive.writestr(info, config)
+
+    # the key changes whenever the code or the configuration changes, which
+    # lets the template publish a new copilot version only when needed
+    body = package.getvalue()
+    key = "copilot/{}.zip".format(hashlib.sha256(body).hexdigest())
+    client.put_object(Bucket=event["ResourceProperties"]["Bucket"], Key=key, Body=body)
+    logger.info("Wrote copilot package s3://{}/{}".format(event["ResourceProperties"]["Bucket"], key))
+
+    helper.Data["Key"] = key
+    return key
+
+
+@helper.delete
+def delete(event, context):
+    logger.info("Got Delete")
+    # Delete never returns anything. Should not fail if the underlying resources are already deleted.
+    # Desired state.
+
+    # the physical resource id is the key of the package written on create
+    if "Bucket" in event["ResourceProperties"] and event["PhysicalResourceId"].startswith("copilot/"):
+        client.delete_object(Bucket=event["ResourceProperties"]["Bucket"], Key=event["PhysicalResourceId"])
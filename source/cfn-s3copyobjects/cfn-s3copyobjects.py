@@ -1,12 +1,29 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+# Copy every object under SourceBucket/SourcePrefix to Bucket/Prefix.
+#
+# Objects are copied while the source is listed, by a bounded pool of threads
+# sharing one S3 client. Objects larger than MULTIPART_THRESHOLD are copied in
+# parts with upload_part_copy, which also lifts the 5 GB limit of
+# copy_object. Objects whose destination already has the same size and ETag
+# are skipped, so a stack update only copies what changed.
+#
+# The destination keys are recorded in a manifest object in the destination
+# bucket. An update deletes the keys that are no longer copied, and a delete
+# removes every key in the manifest, both with batched delete_objects calls.
+
 from crhelper import CfnResource
 import boto3
+import functools
 import logging
 import json
+import math
 import os
+import threading
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 # Initialise the helper, all inputs are optional, this example shows the defaults
@@ -17,20 +34,202 @@ try:
     pass
 except Exception as e:
     helper.init_failure(e)
-    
-client = boto3.client('s3')
+
+# objects copied at the same time, and parts copied at the same time per object
+MAX_WORKERS = 16
+MAX_PART_WORKERS = 4
+
+MULTIPART_THRESHOLD = 256 * 1024 * 1024
+PART_SIZE = 128 * 1024 * 1024
+MAX_PARTS = 10000
+
+# multipart copies get a new ETag, so the source ETag is kept in metadata
+SOURCE_ETAG = "source-etag"
+
+# delete_objects accepts at most this many keys per call
+DELETE_BATCH = 1000
+
+# one client with enough pooled connections for every thread that uses it
+client = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS * (MAX_PART_WORKERS + 1)))
+
 
 def handler(event, context):
     helper(event, context)
 
+
+def destination_key(key, source_prefix, prefix):
+    return os.path.join(prefix, os.path.relpath(key, source_prefix))
+
+
+def list_objects(bucket, prefix):
+    """
+    Yield the objects under a prefix one page at a time
+    """
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        # pages of an empty prefix have no Contents
+        for item in page.get('Contents', []):
+            if not item['Key'].endswith('/'):
+                yield item
+
+
+def is_current(item, bucket, key):
+    """
+    Return True if the destination already holds this version of the object
+    """
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    if response['ContentLength'] != item['Size']:
+        return False
+    return item['ETag'] in (response['ETag'], '"{}"'.format(response.get('Metadata', {}).get(SOURCE_ETAG, '')))
+
+
+def copy_multipart(item, source_bucket, bucket, key):
+    source = {'Bucket': source_bucket, 'Key': item['Key']}
+    head = client.head_object(**source)
+    metadata = dict(head.get('Metadata', {}))
+    metadata[SOURCE_ETAG] = item['ETag'].strip('"')
+    extra = {k: head[k] for k in ('ContentType', 'CacheControl', 'ContentEncoding',
+                                  'ContentDisposition', 'ContentLanguage') if k in head}
+    upload = client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata, **extra)
+    size = item['Size']
+    part_size = max(PART_SIZE, int(math.ceil(size / float(MAX_PARTS))))
+    ranges = [(n + 1, start, min(start + part_size, size) - 1)
+              for n, start in enumerate(range(0, size, part_size))]
+
+    def copy_part(part):
+        number, first, last = part
+        response = client.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload['UploadId'],
+                                           PartNumber=number, CopySource=source,
+                                           CopySourceRange='bytes={}-{}'.format(first, last),
+                                           CopySourceIfMatch=item['ETag'])
+        return {'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_PART_WORKERS) as executor:
+            parts = list(executor.map(copy_part, ranges))
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload['UploadId'],
+                                         MultipartUpload={'Parts': parts})
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload['UploadId'])
+        raise
+
+
+def copy(item, source_bucket, bucket, key):
+    """
+    Copy one object unless the destination is current, return True if copied
+    """
+    if is_current(item, bucket, key):
+        logger.info("skip {}, destination is current".format(key))
+        return False
+    logger.info("copy {} to {}".format(item['Key'], key))
+    if item['Size'] > MULTIPART_THRESHOLD:
+        copy_multipart(item, source_bucket, bucket, key)
+    else:
+        client.copy_object(CopySource={'Bucket': source_bucket, 'Key': item['Key']}, Bucket=bucket, Key=key)
+    return True
+
+
+def copy_objects(source_bucket, source_prefix, bucket, prefix):
+    """
+    Copy while listing, with at most MAX_WORKERS * 2 objects queued at a time.
+    Returns the destination keys and the number of objects copied and skipped.
+    """
+    slots = threading.BoundedSemaphore(MAX_WORKERS * 2)
+    lock = threading.Lock()
+    # finished copies are counted and dropped, only the keys for the manifest
+    # and the failures are kept
+    counts = {'copied': 0, 'skipped': 0}
+    failed = []
+    keys = []
+
+    def done(key, future):
+        error = future.exception()
+        with lock:
+            if error:
+                failed.append((key, error))
+            elif future.result():
+                counts['copied'] += 1
+            else:
+                counts['skipped'] += 1
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for item in list_objects(source_bucket, source_prefix):
+            key = destination_key(item['Key'], source_prefix, prefix)
+            keys.append(key)
+            slots.acquire()
+            executor.submit(copy, item, source_bucket, bucket, key).add_done_callback(
+                functools.partial(done, key))
+
+    for key, error in failed:
+        logger.error("copy to {} failed: {}".format(key, error))
+    if failed:
+        raise RuntimeError("Failed to copy {} of {} objects, first error: {}".format(
+            len(failed), len(keys), failed[0][1]))
+    return keys, counts['copied'], counts['skipped']
+
+
+def manifest_key(event):
+    """
+    Return the key of the manifest of this resource, unique per stack and
+    logical resource
+    """
+    if event['ResourceProperties'].get('ManifestKey'):
+        return event['ResourceProperties']['ManifestKey']
+    stack_id = event['StackId'].split('/')[-1]
+    return ".manifests/{}/{}.json".format(stack_id, event['LogicalResourceId'])
+
+
+def read_manifest(bucket, key):
+    """
+    Return the keys in a manifest, or None if there is no manifest, as for
+    resources created before manifests were written
+    """
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())['Keys']
+
+
+def write_manifest(bucket, key, keys):
+    client.put_object(Bucket=bucket, Key=key, ContentType='application/json',
+                      Body=json.dumps({'Keys': sorted(keys)}).encode())
+
+
+def delete_keys(bucket, keys):
+    """
+    Delete keys with one delete_objects call per DELETE_BATCH keys
+    """
+    keys = sorted(keys)
+    for start in range(0, len(keys), DELETE_BATCH):
+        batch = keys[start:start + DELETE_BATCH]
+        response = client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in batch],
+            'Quiet': True
+        })
+        errors = response.get('Errors', [])
+        if errors:
+            raise RuntimeError("Failed to delete {} objects from {}, first error: {} {}".format(
+                len(errors), bucket, errors[0]['Key'], errors[0]['Message']))
+    logger.info("deleted {} objects from {}".format(len(keys), bucket))
+
+
 @helper.create
 @helper.update
 def create(event, context):
     ReturnId = 0
     logger.info("Got Create")
     logger.info(json.dumps(event))
-    # Optionally return an ID that will be used for the resource PhysicalResourceId, 
-    # if None is returned an ID will be generated. If a poll_create function is defined 
+    # Optionally return an ID that will be used for the resource PhysicalResourceId,
+    # if None is returned an ID will be generated. If a poll_create function is defined
     # return value is placed into the poll event as event['CrHelperData']['PhysicalResourceId']
     #
 
@@ -45,23 +244,28 @@ def create(event, context):
     source_prefix = event['ResourceProperties'].get('SourcePrefix') or ''
     bucket = event['ResourceProperties']['Bucket']
     prefix = event['ResourceProperties'].get('Prefix') or ''
-    
-    try:
 
-        paginator = client.get_paginator('list_objects_v2')
-        page_iterator = paginator.paginate(Bucket=source_bucket, Prefix=source_prefix)
-        for key in {x['Key'] for page in page_iterator for x in page['Contents']}:
-            dest_key = os.path.join(prefix, os.path.relpath(key, source_prefix))
-            print("dest_key: {}".format(dest_key))
-            if not key.endswith('/'):
-                print ('copy {} to {}'.format(key, dest_key))
-                #client.copy_object(CopySource={'Bucket': source_bucket, 'Key': key}, Bucket=bucket, Key = dest_key, ACL='public-read')
-                client.copy_object(CopySource={'Bucket': source_bucket, 'Key': key}, Bucket=bucket, Key = dest_key)
-                
-                logger.info("Received event: %s" % json.dumps(event))
-    except Exception as e:
-        raise e
-    
+    keys, copied, skipped = copy_objects(source_bucket, source_prefix, bucket, prefix)
+    logger.info("copied {} objects, skipped {} current objects".format(copied, skipped))
+    helper.Data["Copied"] = copied
+    helper.Data["Skipped"] = skipped
+
+    # remove the keys the previous version of the resource copied that are
+    # not copied any more. If the bucket changed, CloudFormation deletes the
+    # old resource, which cleans up the old bucket.
+    manifest = manifest_key(event)
+    removed = []
+    if event["RequestType"] == "Update" and event["OldResourceProperties"].get("Bucket") == bucket:
+        old_keys = read_manifest(bucket, manifest_key(dict(event, ResourceProperties=event["OldResourceProperties"])))
+        if old_keys is None:
+            logger.info("no manifest from the previous version, nothing to remove")
+        else:
+            removed = set(old_keys) - set(keys)
+    write_manifest(bucket, manifest, keys)
+    if removed:
+        delete_keys(bucket, removed)
+    helper.Data["Removed"] = len(removed)
+
     return ReturnId
 
 @helper.delete
@@ -70,15 +274,21 @@ def delete(event, context):
     # Delete never returns anything. Should not fail if the underlying resources are already deleted.
     # Desired state.
 
-    
+    if "Bucket" not in event["ResourceProperties"]:
+        return
+    bucket = event['ResourceProperties']['Bucket']
+    manifest = manifest_key(event)
 
-    # Delete the associated lambda function behavior if it exists for the distribution
     try:
-
-        print ('delete no-op')
-
-    except Exception as e:
-        raise e
-    
-
-
+        keys = read_manifest(bucket, manifest)
+        if keys is None:
+            # resources created before manifests: the keys the source maps to
+            source_prefix = event['ResourceProperties'].get('SourcePrefix') or ''
+            prefix = event['ResourceProperties'].get('Prefix') or ''
+            keys = [destination_key(item['Key'], source_prefix, prefix)
+                    for item in list_objects(event['ResourceProperties']['SourceBucket'], source_prefix)]
+        delete_keys(bucket, set(keys) | {manifest})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchBucket':
+            raise
+        logger.info("bucket {} is already deleted".format(bucket))
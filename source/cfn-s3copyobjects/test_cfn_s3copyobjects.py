@@ -0,0 +1,228 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the cfn-s3copyobjects custom resource. S3 is replaced with a
+# fake that keeps the buckets in a dict, no AWS account is needed.
+
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import os
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def etag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+class FakePaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(k for b, k in self.s3.objects if b == Bucket and k.startswith(Prefix))
+        # two objects per page, so listing spans pages
+        for start in range(0, max(len(keys), 1), 2):
+            page = [{"Key": k, "Size": len(self.s3.objects[(Bucket, k)]["Body"]),
+                     "ETag": self.s3.objects[(Bucket, k)]["ETag"]} for k in keys[start:start + 2]]
+            yield {"Contents": page} if page else {}
+
+
+class FakeS3:
+    def __init__(self, objects=None):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        self.calls = []
+        self.fail = set()
+        self.buckets = set(bucket for bucket, key in (objects or {}))
+        for (bucket, key), body in (objects or {}).items():
+            self.objects[(bucket, key)] = {"Body": body, "ETag": etag(body), "Metadata": {}}
+
+    def record(self, name, key):
+        with self.lock:
+            self.calls.append((name, key))
+        if key in self.fail and name != "abort_multipart_upload":
+            raise ClientError({"Error": {"Code": "AccessDenied", "Message": "denied"}}, name)
+
+    def body(self, bucket, key):
+        return self.objects[(bucket, key)]["Body"]
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return FakePaginator(self)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        item = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(item["Body"]), "ETag": item["ETag"], "Metadata": dict(item["Metadata"])}
+
+    def copy_object(self, CopySource, Bucket, Key):
+        self.record("copy_object", Key)
+        with self.lock:
+            self.objects[(Bucket, Key)] = dict(self.objects[(CopySource["Bucket"], CopySource["Key"])])
+
+    def create_multipart_upload(self, Bucket, Key, Metadata, **kwargs):
+        with self.lock:
+            upload_id = str(next(self.upload_ids))
+            self.uploads[upload_id] = {"Metadata": Metadata, "Parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange,
+                         CopySourceIfMatch):
+        self.record("upload_part_copy", Key)
+        source = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+        assert CopySourceIfMatch == source["ETag"]
+        first, last = map(int, CopySourceRange[len("bytes="):].split("-"))
+        part = source["Body"][first:last + 1]
+        with self.lock:
+            self.uploads[UploadId]["Parts"][PartNumber] = part
+        return {"CopyPartResult": {"ETag": etag(part)}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        numbers = [x["PartNumber"] for x in MultipartUpload["Parts"]]
+        assert numbers == sorted(upload["Parts"])
+        body = b"".join(upload["Parts"][n] for n in numbers)
+        with self.lock:
+            self.objects[(Bucket, Key)] = {"Body": body, "ETag": '"multipart-{}"'.format(len(numbers)),
+                                           "Metadata": upload["Metadata"]}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.record("abort_multipart_upload", Key)
+        self.uploads.pop(UploadId)
+
+    def get_object(self, Bucket, Key):
+        if Bucket not in self.buckets:
+            raise ClientError({"Error": {"Code": "NoSuchBucket", "Message": "no bucket"}}, "GetObject")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "no key"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)]["Body"])}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.buckets.add(Bucket)
+        self.objects[(Bucket, Key)] = {"Body": Body, "ETag": etag(Body), "Metadata": {}}
+
+    def delete_objects(self, Bucket, Delete):
+        self.record("delete_objects", len(Delete["Objects"]))
+        for item in Delete["Objects"]:
+            self.objects.pop((Bucket, item["Key"]), None)
+        return {}
+
+    def keys(self, bucket):
+        return sorted(k for b, k in self.objects if b == bucket)
+
+
+@pytest.fixture
+def s3copy(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    spec = importlib.util.spec_from_file_location("cfn_s3copyobjects", os.path.join(HERE, "cfn-s3copyobjects.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_objects_are_copied_and_current_ones_skipped(s3copy):
+    s3copy.client = FakeS3({
+        ("source", "web/index.html"): b"<html>",
+        ("source", "web/app.js"): b"app",
+        ("source", "web/css/site.css"): b"body {}",
+        ("source", "web/css/"): b"",
+        ("destination", "site/index.html"): b"<html>",
+        ("destination", "site/app.js"): b"old app"
+    })
+    keys, copied, skipped = s3copy.copy_objects("source", "web", "destination", "site")
+    assert sorted(keys) == ["site/app.js", "site/css/site.css", "site/index.html"]
+    assert (copied, skipped) == (2, 1)
+    assert sorted(key for name, key in s3copy.client.calls) == ["site/app.js", "site/css/site.css"]
+    assert s3copy.client.body("destination", "site/app.js") == b"app"
+
+
+def test_large_objects_are_copied_in_parts(s3copy, monkeypatch):
+    monkeypatch.setattr(s3copy, "MULTIPART_THRESHOLD", 8)
+    monkeypatch.setattr(s3copy, "PART_SIZE", 4)
+    body = bytes(range(10))
+    s3copy.client = FakeS3({("source", "large.bin"): body, ("source", "small.bin"): b"small"})
+    keys, copied, skipped = s3copy.copy_objects("source", "", "destination", "")
+    assert (copied, skipped) == (2, 0)
+    assert s3copy.client.body("destination", "large.bin") == body
+    assert [name for name, key in s3copy.client.calls if key == "large.bin"] == ["upload_part_copy"] * 3
+    # the source ETag kept in metadata makes the part copy current
+    keys, copied, skipped = s3copy.copy_objects("source", "", "destination", "")
+    assert (copied, skipped) == (0, 2)
+
+
+def test_failed_part_copy_aborts_the_upload(s3copy, monkeypatch):
+    monkeypatch.setattr(s3copy, "MULTIPART_THRESHOLD", 8)
+    monkeypatch.setattr(s3copy, "PART_SIZE", 4)
+    s3copy.client = FakeS3({("source", "large.bin"): bytes(10), ("source", "small.bin"): b"small"})
+    s3copy.client.fail.add("large.bin")
+    with pytest.raises(RuntimeError, match="1 of 2"):
+        s3copy.copy_objects("source", "", "destination", "")
+    assert ("abort_multipart_upload", "large.bin") in s3copy.client.calls
+    assert s3copy.client.uploads == {}
+    assert s3copy.client.body("destination", "small.bin") == b"small"
+
+
+def delete_event(**properties):
+    return {
+        "RequestType": "Delete",
+        "StackId": "arn:aws:cloudformation:us-west-2:123456789012:stack/cvs/0123",
+        "LogicalResourceId": "WebsiteContent",
+        "ResourceProperties": dict({"SourceBucket": "source", "SourcePrefix": "web", "Bucket": "destination",
+                                    "Prefix": "site"}, **properties)
+    }
+
+
+def test_delete_removes_only_the_keys_in_the_manifest(s3copy, monkeypatch):
+    monkeypatch.setattr(s3copy, "DELETE_BATCH", 2)
+    s3copy.client = FakeS3({
+        ("source", "web/index.html"): b"<html>",
+        ("destination", "site/index.html"): b"<html>",
+        ("destination", "site/app.js"): b"app",
+        ("destination", "site/css/site.css"): b"body {}",
+        ("destination", "site/uploads/user.png"): b"png",
+        ("destination", "other/index.html"): b"<html>"
+    })
+    event = delete_event()
+    manifest = s3copy.manifest_key(event)
+    s3copy.write_manifest("destination", manifest, ["site/index.html", "site/app.js", "site/css/site.css"])
+    s3copy.delete(event, None)
+    assert s3copy.client.keys("destination") == ["other/index.html", "site/uploads/user.png"]
+    # three keys and the manifest in batches of two
+    assert [x for x in s3copy.client.calls if x[0] == "delete_objects"] == [("delete_objects", 2)] * 2
+
+
+def test_delete_without_manifest_removes_the_keys_the_source_maps_to(s3copy):
+    s3copy.client = FakeS3({
+        ("source", "web/index.html"): b"<html>",
+        ("source", "web/app.js"): b"app",
+        ("destination", "site/index.html"): b"<html>",
+        ("destination", "site/app.js"): b"app",
+        ("destination", "site/uploads/user.png"): b"png"
+    })
+    s3copy.delete(delete_event(), None)
+    assert s3copy.client.keys("destination") == ["site/uploads/user.png"]
+
+
+def test_delete_of_a_deleted_bucket_succeeds(s3copy):
+    s3copy.client = FakeS3({("source", "web/index.html"): b"<html>"})
+    s3copy.delete(delete_event(), None)
+    assert s3copy.client.calls == []
+
+
+def test_manifest_lists_the_copied_keys(s3copy):
+    s3copy.client = FakeS3({("source", "web/index.html"): b"<html>", ("source", "web/app.js"): b"app"})
+    event = dict(delete_event(), RequestType="Create")
+    s3copy.create(event, None)
+    manifest = json.loads(s3copy.client.body("destination", s3copy.manifest_key(event)))
+    assert manifest == {"Keys": ["site/app.js", "site/index.html"]}
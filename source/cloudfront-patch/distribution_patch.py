@@ -0,0 +1,136 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Shared by the custom resources that change CloudFront distributions, and
+# added to their deployment packages by build-s3-dist.sh.
+#
+# patch_distribution reads a distribution config, applies a change to a copy
+# and only calls update_distribution when the copy differs from what is
+# deployed, because every update starts a global redeploy of the
+# distribution. If another update lands between the read and the write, the
+# change is applied again to a fresh read after a backoff. Retries stop
+# early at a deadline, so a resource reports the conflict to CloudFormation
+# before its Lambda function times out.
+#
+# is_deployed is used by the poll functions of those resources, so they only
+# report success once the change has reached every edge location.
+
+import copy
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 20.0
+
+# seconds kept for one more read and update after a backoff, and kept free
+# at the end of an invocation to report the result
+ATTEMPT_SECONDS = 10.0
+DEADLINE_MARGIN = 5.0
+
+
+def diff(old, new, path=""):
+    """
+    Return a list of (path, old value, new value) for every leaf that differs
+    between two distribution configs. Missing values are None.
+    """
+    # CloudFront leaves out empty Items lists, so missing and empty are equal
+    if old in (None, []) and new in (None, []):
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in sorted(set(old) | set(new)):
+            changes.extend(diff(old.get(key), new.get(key), "{}.{}".format(path, key) if path else key))
+        return changes
+    if isinstance(old, list) and isinstance(new, list):
+        changes = []
+        for index in range(max(len(old), len(new))):
+            changes.extend(diff(old[index] if index < len(old) else None,
+                                new[index] if index < len(new) else None,
+                                "{}[{}]".format(path, index)))
+        return changes
+    if old != new:
+        return [(path, old, new)]
+    return []
+
+
+def is_conflict(error):
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("PreconditionFailed", "InvalidIfMatchVersion")
+
+
+def deadline_of(context):
+    """
+    Return the time (epoch seconds) by which the retries of an invocation
+    must end, or None without a Lambda context
+    """
+    if context is None:
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN
+
+
+def patch_distribution(client, distribution_id, mutate, max_attempts=MAX_ATTEMPTS, deadline=None):
+    """
+    Apply mutate to the config of a distribution and update it if anything
+    changed. mutate receives a copy of the DistributionConfig and changes it
+    in place. A conflict is not retried when the backoff and another attempt
+    would end after deadline (epoch seconds).
+
+    Returns a dict with Id, Changed, Changes (list of changed paths), ETag
+    and Attempts.
+    """
+    for attempt in range(1, max_attempts + 1):
+        response = client.get_distribution_config(Id=distribution_id)
+        current = response["DistributionConfig"]
+        config = copy.deepcopy(current)
+        mutate(config)
+        changes = diff(current, config)
+        result = {
+            "Id": distribution_id,
+            "Changed": bool(changes),
+            "Changes": [change[0] for change in changes],
+            "ETag": response["ETag"],
+            "Attempts": attempt
+        }
+        if not changes:
+            logger.info("Distribution {} already up to date, skipping update".format(distribution_id))
+            return result
+        for path, old, new in changes:
+            logger.info("Distribution {} {}: {!r} -> {!r}".format(distribution_id, path, old, new))
+        try:
+            response = client.update_distribution(DistributionConfig=config,
+                                                  Id=distribution_id,
+                                                  IfMatch=response["ETag"])
+            result["ETag"] = response["ETag"]
+            return result
+        except Exception as error:
+            if not is_conflict(error) or attempt == max_attempts:
+                raise
+            # full jitter, so concurrent stack operations spread out
+            delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1)))
+            if deadline is not None and time.time() + delay + ATTEMPT_SECONDS > deadline:
+                logger.info("Distribution {} changed during update, no time left to retry".format(distribution_id))
+                raise
+            logger.info("Distribution {} changed during update, retrying in {:.1f}s".format(distribution_id, delay))
+            time.sleep(delay)
+
+
+def is_deployed(client, distribution_id):
+    """
+    Return True once a distribution has no change in progress
+    """
+    status = client.get_distribution(Id=distribution_id)["Distribution"]["Status"]
+    logger.info("Distribution {} is {}".format(distribution_id, status))
+    return status == "Deployed"
+
+
+def summarize(result, limit=1000):
+    """
+    Return the changed paths of a patch result as a string short enough for
+    custom resource Data
+    """
+    text = ",".join(result["Changes"])
+    return text if len(text) <= limit else text[:limit - 3] + "..."
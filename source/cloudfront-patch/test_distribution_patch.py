@@ -0,0 +1,74 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of distribution_patch. CloudFront is replaced with a fake that
+# reports a conflict for the first updates, no AWS account is needed.
+
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import distribution_patch
+
+
+class FakeCloudFront:
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        self.config = {"Comment": "", "Enabled": True}
+        self.updates = 0
+
+    def get_distribution_config(self, Id):
+        return {"DistributionConfig": dict(self.config), "ETag": "E{}".format(self.updates)}
+
+    def update_distribution(self, DistributionConfig, Id, IfMatch):
+        self.updates += 1
+        if self.updates <= self.conflicts:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "UpdateDistribution")
+        self.config = DistributionConfig
+        return {"ETag": "E{}".format(self.updates)}
+
+
+def comment(config):
+    config["Comment"] = "patched"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(distribution_patch.time, "sleep", waits.append)
+    return waits
+
+
+def test_unchanged_config_is_not_updated(sleeps):
+    client = FakeCloudFront(0)
+    result = distribution_patch.patch_distribution(client, "E1", lambda config: None)
+    assert not result["Changed"]
+    assert client.updates == 0
+
+
+def test_conflicts_are_retried_with_backoff(sleeps):
+    client = FakeCloudFront(3)
+    result = distribution_patch.patch_distribution(client, "E1", comment)
+    assert result["Changed"] and result["Attempts"] == 4
+    assert client.config["Comment"] == "patched"
+    assert len(sleeps) == 3
+    assert all(0 <= x <= distribution_patch.BASE_DELAY * 2 ** n for n, x in enumerate(sleeps))
+
+
+def test_retries_stop_at_the_deadline(sleeps):
+    client = FakeCloudFront(3)
+    deadline = time.time() + distribution_patch.ATTEMPT_SECONDS - 1
+    with pytest.raises(ClientError):
+        distribution_patch.patch_distribution(client, "E1", comment, deadline=deadline)
+    assert client.updates == 1
+    assert sleeps == []
+
+
+def test_deadline_of_keeps_a_margin():
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 60000
+    deadline = distribution_patch.deadline_of(Context())
+    assert abs(deadline - (time.time() + 60 - distribution_patch.DEADLINE_MARGIN)) < 1
+    assert distribution_patch.deadline_of(None) is None
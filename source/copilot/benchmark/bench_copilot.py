@@ -0,0 +1,289 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Offline benchmark for the copilot origin-request handler.
+#
+# Synthetic CloudFront origin-request events are replayed at a fixed rate
+# against the copilot, which reads its state from a LocalDynamoDB stand-in
+# with injectable latency and errors. The report contains:
+#
+#   * cold init time of the copilot module, measured in fresh interpreters
+#   * latency of the first request in a fresh container
+#   * p50/p95/p99/max per-request overhead of origin_request
+#   * state table calls per 1,000 requests
+#
+# Usage (from source/copilot):
+#   python benchmark/bench_copilot.py --latency-ms 50 --output report.json
+#   python benchmark/bench_copilot.py --latency-ms 50 --baseline report.json
+#
+# Compare the state readers with --config state_reader=boto3 (the boto3
+# resource) and the default --config state_reader=lean.
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+COPILOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+# the copilot imports state_reader from its own directory, as in the package
+sys.path.insert(0, COPILOT_DIR)
+
+from local_dynamodb import LocalDynamoDB  # noqa: E402
+
+TABLE_NAME = "cvs-benchmark"
+REGIONS = ["us-west-2", "eu-west-1", "ap-northeast-1"]
+
+# run in a fresh interpreter so module import and client creation are cold
+COLD_START = r"""
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import copilot
+init = time.perf_counter() - start
+event = json.loads(sys.argv[2])
+start = time.perf_counter()
+copilot.origin_request(event, None)
+first = time.perf_counter() - start
+print(json.dumps({"init_ms": init * 1000, "first_request_ms": first * 1000}))
+"""
+
+# metrics compared against a baseline, all lower is better
+REGRESSION_METRICS = [
+    "cold_init_ms", "first_request_ms", "p50_ms", "p95_ms", "p99_ms",
+    "calls_per_1000"
+]
+
+
+def make_event(domain, uri):
+    """
+    Build a CloudFront origin-request event for a custom origin
+    """
+    return {
+        "Records": [{
+            "cf": {
+                "config": {
+                    "distributionDomainName": domain,
+                    "distributionId": "EDFDVBD6EXAMPLE",
+                    "eventType": "origin-request",
+                    "requestId": "4TyzHTaYWb1GX1qTfsHhEqV6HUDd_BzoBZnwfnvQc_1oF26ClkoUSEQ=="
+                },
+                "request": {
+                    "clientIp": "203.0.113.178",
+                    "headers": {
+                        "host": [{"key": "Host", "value": domain}],
+                        "user-agent": [{"key": "User-Agent", "value": "Amazon CloudFront"}]
+                    },
+                    "method": "GET",
+                    "querystring": "",
+                    "uri": uri,
+                    "origin": {
+                        "custom": {
+                            "customHeaders": {},
+                            "domainName": "origin.example.com",
+                            "keepaliveTimeout": 5,
+                            "path": "",
+                            "port": 443,
+                            "protocol": "https",
+                            "readTimeout": 30,
+                            "sslProtocols": ["TLSv1.2"]
+                        }
+                    }
+                }
+            }
+        }]
+    }
+
+
+def synthetic_events(domains, renditions, count, seed):
+    """
+    Yield a mix of variant playlist and segment requests across domains
+    """
+    rng = random.Random(seed)
+    for n in range(count):
+        domain = rng.choice(domains)
+        rendition = rng.randint(1, renditions)
+        if rng.random() < 0.5:
+            uri = "/out/v1/benchmark/index_{}.m3u8".format(rendition)
+        else:
+            uri = "/out/v1/benchmark/index_{}_{}.ts".format(rendition, n // 100)
+        yield make_event(domain, uri)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def write_config(path, endpoint_url, domains, overrides):
+    config = {
+        "table_name": TABLE_NAME,
+        "stream_instances": [{
+            "domain": domain,
+            "region": REGIONS[n % len(REGIONS)]
+        } for n, domain in enumerate(domains)],
+        "endpoint_url": endpoint_url
+    }
+    config.update(overrides)
+    with open(path, "w") as config_file:
+        json.dump(config, config_file, indent=2)
+
+
+def load_copilot():
+    """
+    Import a fresh copy of the copilot module, as a new container would
+    """
+    spec = importlib.util.spec_from_file_location(
+        "copilot_benchmark_{}".format(time.monotonic_ns()),
+        os.path.join(COPILOT_DIR, "copilot.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure_cold_start(runs, event):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_START, COPILOT_DIR, json.dumps(event)],
+            check=True, capture_output=True, text=True, env=os.environ.copy())
+        samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return {
+        "cold_init_ms": percentile([s["init_ms"] for s in samples], 0.5),
+        "first_request_ms": percentile([s["first_request_ms"] for s in samples], 0.5)
+    }
+
+
+def measure_requests(copilot, events, rate):
+    """
+    Replay events at a fixed rate and return the overhead of each call in ms
+    """
+    interval = 1.0 / rate if rate else 0
+    samples = []
+    blocked = 0
+    next_at = time.perf_counter()
+    for event in events:
+        pause = next_at - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        start = time.perf_counter()
+        response = copilot.origin_request(event, None)
+        samples.append((time.perf_counter() - start) * 1000)
+        blocked += response.get("status") == "404"
+        next_at += interval
+    return samples, blocked
+
+
+def run(args):
+    overrides = dict(item.split("=", 1) for item in args.config)
+    domains = ["d{}.cloudfront.net".format(n) for n in range(args.domains)]
+    closed = set(domains[:int(round(args.closed_fraction * len(domains)))])
+
+    stand_in = LocalDynamoDB(latency_ms=args.latency_ms,
+                             jitter_ms=args.jitter_ms,
+                             error_rate=args.error_rate,
+                             seed=args.seed)
+    stand_in.create_table(TABLE_NAME)
+    for n, domain in enumerate(domains):
+        stand_in.put(TABLE_NAME, {
+            "domain": domain,
+            "region": REGIONS[n % len(REGIONS)],
+            "distro_open": domain not in closed
+        })
+    endpoint_url = stand_in.start()
+
+    config_dir = tempfile.mkdtemp(prefix="copilot-benchmark-")
+    config_path = os.path.join(config_dir, "copilot_config.json")
+    write_config(config_path, endpoint_url, domains, overrides)
+    os.environ["COPILOT_CONFIG"] = config_path
+    os.environ.setdefault("AWS_REGION", args.edge_region)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+    try:
+        report = measure_cold_start(args.cold_runs, make_event(domains[0], "/index_1.m3u8"))
+
+        count = int(args.rate * args.duration)
+        events = list(synthetic_events(domains, args.renditions, count, args.seed))
+        copilot = load_copilot()
+        stand_in.calls.clear()
+        samples, blocked = measure_requests(copilot, events, args.rate)
+        calls = sum(stand_in.calls.values())
+    finally:
+        stand_in.stop()
+
+    report.update({
+        "requests": len(samples),
+        "blocked": blocked,
+        "p50_ms": percentile(samples, 0.50),
+        "p95_ms": percentile(samples, 0.95),
+        "p99_ms": percentile(samples, 0.99),
+        "max_ms": max(samples),
+        "calls_per_1000": 1000.0 * calls / len(samples),
+        "settings": {
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "rate": args.rate,
+            "duration": args.duration,
+            "domains": args.domains,
+            "config": overrides
+        }
+    })
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """
+    Return the metrics that are worse than the baseline by more than tolerance
+    """
+    regressions = []
+    for metric in REGRESSION_METRICS:
+        if metric in baseline and report[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append("{}: {:.3f} > {:.3f}".format(metric, report[metric], baseline[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the copilot origin-request handler")
+    parser.add_argument("--latency-ms", type=float, default=20, help="state table latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random extra latency per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of state table calls that fail")
+    parser.add_argument("--rate", type=float, default=1000, help="origin requests per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of requests to replay")
+    parser.add_argument("--domains", type=int, default=2, help="number of stream instance distributions")
+    parser.add_argument("--closed-fraction", type=float, default=0.5, help="fraction of distributions closed")
+    parser.add_argument("--renditions", type=int, default=4, help="renditions per stream instance")
+    parser.add_argument("--cold-runs", type=int, default=5, help="fresh interpreters used to measure cold start")
+    parser.add_argument("--edge-region", default="eu-central-1", help="region the copilot pretends to run in")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a copilot_config.json setting")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--baseline", help="fail if the report regresses from this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression from the baseline")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(report, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# A small in-process stand-in for the DynamoDB JSON API, used to benchmark the
+# copilot and to simulate failover without AWS. It speaks the same wire
+# protocol as DynamoDB so the real SDK code path is measured, and it can inject
+# latency and errors into every call.
+#
+# Writes support the subset of condition and update expressions used by this
+# solution: attribute_exists, attribute_not_exists, comparisons, AND, OR, NOT
+# and parentheses in conditions, and SET (with if_not_exists) and REMOVE in
+# updates.
+
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TARGET_PREFIX = "DynamoDB_20120810."
+ERROR_PREFIX = "com.amazonaws.dynamodb.v20120810#"
+
+TOKEN = re.compile(r"\s*(<>|<=|>=|[()=<>,+-]|[:#]?[A-Za-z_][A-Za-z0-9_.]*)")
+COMPARATORS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b
+}
+
+
+def serialize(value):
+    """
+    Convert a plain Python value to a DynamoDB attribute value
+    """
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+    if isinstance(value, str):
+        return {"S": value}
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, dict):
+        return {"M": {k: serialize(v) for k, v in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {"L": [serialize(v) for v in value]}
+    if isinstance(value, (set, frozenset)) and all(isinstance(v, str) for v in value):
+        return {"SS": sorted(value)}
+    raise TypeError("Cannot serialize {!r}".format(value))
+
+
+class ConditionFailed(Exception):
+    pass
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError("Cannot parse expression at {!r}".format(expression[position:]))
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class Expression:
+    """
+    Parser and evaluator for condition and update expressions against an
+    item in wire format
+    """
+
+    def __init__(self, body, item):
+        self.names = body.get("ExpressionAttributeNames", {})
+        self.values = body.get("ExpressionAttributeValues", {})
+        self.item = item
+        self.tokens = []
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def take(self, expected=None):
+        token = self.tokens.pop(0)
+        if expected is not None and token.upper() != expected:
+            raise ValueError("Expected {} but found {}".format(expected, token))
+        return token
+
+    def peek(self):
+        return self.tokens[0].upper() if self.tokens else None
+
+    # conditions
+
+    def condition(self, expression):
+        self.tokens = tokenize(expression)
+        result = self.or_condition()
+        if self.tokens:
+            raise ValueError("Unexpected {}".format(self.tokens[0]))
+        return result
+
+    def or_condition(self):
+        result = self.and_condition()
+        while self.peek() == "OR":
+            self.take()
+            right = self.and_condition()
+            result = result or right
+        return result
+
+    def and_condition(self):
+        result = self.not_condition()
+        while self.peek() == "AND":
+            self.take()
+            right = self.not_condition()
+            result = result and right
+        return result
+
+    def not_condition(self):
+        if self.peek() == "NOT":
+            self.take()
+            return not self.not_condition()
+        if self.peek() == "(":
+            self.take()
+            result = self.or_condition()
+            self.take(")")
+            return result
+        if self.peek() in ("ATTRIBUTE_EXISTS", "ATTRIBUTE_NOT_EXISTS"):
+            function = self.take().upper()
+            self.take("(")
+            exists = self.name(self.take()) in self.item
+            self.take(")")
+            return exists if function == "ATTRIBUTE_EXISTS" else not exists
+        left = self.operand()
+        comparator = self.take()
+        right = self.operand()
+        if left is None or right is None or set(left) != set(right):
+            # missing attributes and values of different types never match
+            return comparator == "<>" and left != right
+        return COMPARATORS[comparator](deserialize(left), deserialize(right))
+
+    def operand(self):
+        token = self.take()
+        if token.upper() == "IF_NOT_EXISTS":
+            self.take("(")
+            current = self.item.get(self.name(self.take()))
+            self.take(",")
+            default = self.operand()
+            self.take(")")
+            return default if current is None else current
+        if token.startswith(":"):
+            return self.values[token]
+        return self.item.get(self.name(token))
+
+    # updates
+
+    def update(self, expression):
+        """
+        Return the item with the update applied
+        """
+        self.tokens = tokenize(expression)
+        updated = dict(self.item)
+        while self.tokens:
+            clause = self.take().upper()
+            while True:
+                if clause == "SET":
+                    name = self.name(self.take())
+                    self.take("=")
+                    value = self.operand()
+                    if self.peek() in ("+", "-"):
+                        sign = 1 if self.take() == "+" else -1
+                        value = serialize(deserialize(value) + sign * deserialize(self.operand()))
+                    updated[name] = value
+                elif clause == "REMOVE":
+                    updated.pop(self.name(self.take()), None)
+                else:
+                    raise ValueError("Unsupported update clause {}".format(clause))
+                if self.peek() != ",":
+                    break
+                self.take()
+        return updated
+
+
+def deserialize(attribute):
+    """
+    Convert a DynamoDB attribute value to a plain Python value
+    """
+    (kind, value), = attribute.items()
+    if kind == "N":
+        number = float(value)
+        return int(number) if number.is_integer() else number
+    if kind == "M":
+        return {k: deserialize(v) for k, v in value.items()}
+    if kind == "L":
+        return [deserialize(v) for v in value]
+    if kind == "NULL":
+        return None
+    if kind == "SS":
+        return set(value)
+    return value
+
+
+class LocalDynamoDB:
+    """
+    Threaded HTTP server holding tables of items in DynamoDB wire format
+
+    latency_ms, jitter_ms and error_rate can be changed while the server is
+    running. calls counts requests by operation name.
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.tables = {}
+        self.keys = {}
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.server = None
+        # called with (table, old item, new item) after every write, under
+        # the lock, with plain values and None for a missing item
+        self.listeners = []
+
+    # table helpers for seeding and inspecting state from Python
+
+    def create_table(self, name, key="domain"):
+        self.tables[name] = {}
+        self.keys[name] = key
+
+    def put(self, table, item):
+        wire = {k: serialize(v) for k, v in item.items()}
+        with self.lock:
+            self.write(table, self.key_of(table, wire), wire)
+
+    def items(self, table):
+        with self.lock:
+            wires = list(self.tables[table].values())
+        return [{k: deserialize(v) for k, v in wire.items()} for wire in wires]
+
+    def get(self, table, key):
+        with self.lock:
+            wire = self.tables[table].get(json.dumps(serialize(key)))
+        if wire is None:
+            return None
+        return {k: deserialize(v) for k, v in wire.items()}
+
+    def key_of(self, table, wire):
+        return json.dumps(wire[self.keys[table]])
+
+    def write(self, table, key, wire):
+        """
+        Store or, with wire None, delete an item and tell the listeners
+        """
+        old = self.tables[table].get(key)
+        if wire is None:
+            self.tables[table].pop(key, None)
+        else:
+            self.tables[table][key] = wire
+        for listener in self.listeners:
+            listener(table,
+                     None if old is None else {k: deserialize(v) for k, v in old.items()},
+                     None if wire is None else {k: deserialize(v) for k, v in wire.items()})
+
+    # server lifecycle
+
+    def start(self):
+        """
+        Start serving on a free local port and return the endpoint url
+        """
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive like the real service
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, without this every
+            # response on a kept-alive connection waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                operation = self.headers.get("X-Amz-Target", "")[len(TARGET_PREFIX):]
+                status, payload = stand_in.dispatch(operation, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/x-amz-json-1.0")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("x-amzn-RequestId", str(uuid.uuid4()))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # request handling
+
+    def dispatch(self, operation, body):
+        with self.lock:
+            self.calls[operation] += 1
+            delay = self.latency_ms + self.random.uniform(0, self.jitter_ms)
+            failed = self.random.random() < self.error_rate
+        if delay:
+            time.sleep(delay / 1000.0)
+        if failed:
+            return 500, {
+                "__type": ERROR_PREFIX + "InternalServerError",
+                "message": "Injected failure"
+            }
+        method = getattr(self, "op_" + operation, None)
+        # transactions name a table per item and check each of them
+        if method is None or (operation != "TransactWriteItems" and body.get("TableName") not in self.tables):
+            return 400, {
+                "__type": ERROR_PREFIX + "ResourceNotFoundException",
+                "message": "Requested resource not found"
+            }
+        with self.lock:
+            try:
+                return 200, method(body)
+            except ConditionFailed as error:
+                return 400, error.args[0]
+
+    def op_GetItem(self, body):
+        table = body["TableName"]
+        item = self.tables[table].get(self.key_of(table, body["Key"]))
+        if item is None:
+            return {}
+        if "ProjectionExpression" in body:
+            names = body.get("ExpressionAttributeNames", {})
+            fields = [names.get(f.strip(), f.strip())
+                      for f in body["ProjectionExpression"].split(",")]
+            item = {k: v for k, v in item.items() if k in fields}
+        return {"Item": item}
+
+    def check(self, table, key, body):
+        """
+        Return the current item, or raise ConditionFailed if the condition
+        of a write does not hold for it
+        """
+        current = self.tables[table].get(key) or {}
+        if "ConditionExpression" in body and not Expression(body, current).condition(body["ConditionExpression"]):
+            raise ConditionFailed({
+                "__type": ERROR_PREFIX + "ConditionalCheckFailedException",
+                "message": "The conditional request failed"
+            })
+        return current
+
+    def op_PutItem(self, body):
+        table = body["TableName"]
+        key = self.key_of(table, body["Item"])
+        self.check(table, key, body)
+        self.write(table, key, body["Item"])
+        return {}
+
+    def op_DeleteItem(self, body):
+        table = body["TableName"]
+        key = self.key_of(table, body["Key"])
+        self.check(table, key, body)
+        self.write(table, key, None)
+        return {}
+
+    def op_UpdateItem(self, body):
+        table = body["TableName"]
+        key = self.key_of(table, body["Key"])
+        current = self.check(table, key, body)
+        updated = dict(current, **body["Key"])
+        if "UpdateExpression" in body:
+            updated = Expression(body, updated).update(body["UpdateExpression"])
+        self.write(table, key, updated)
+        if body.get("ReturnValues") == "ALL_NEW":
+            return {"Attributes": updated}
+        return {}
+
+    def op_Scan(self, body):
+        items = list(self.tables[body["TableName"]].values())
+        return {"Items": items, "Count": len(items), "ScannedCount": len(items)}
+
+    def op_TransactWriteItems(self, body):
+        """
+        Check every condition first and apply the writes only if all hold
+        """
+        actions = []
+        reasons = []
+        for entry in body["TransactItems"]:
+            (kind, request), = entry.items()
+            table = request["TableName"]
+            if table not in self.tables:
+                raise ConditionFailed({
+                    "__type": ERROR_PREFIX + "ResourceNotFoundException",
+                    "message": "Requested resource not found"
+                })
+            key = self.key_of(table, request.get("Key") or request["Item"])
+            try:
+                self.check(table, key, request)
+                reasons.append({"Code": "None"})
+            except ConditionFailed:
+                reasons.append({"Code": "ConditionalCheckFailed", "Message": "The conditional request failed"})
+            actions.append((kind, request, table, key))
+        if any(reason["Code"] != "None" for reason in reasons):
+            raise ConditionFailed({
+                "__type": ERROR_PREFIX + "TransactionCanceledException",
+                "message": "Transaction cancelled, please refer cancellation reasons for specific reasons [{}]".format(
+                    ", ".join(reason["Code"] for reason in reasons)),
+                "CancellationReasons": reasons
+            })
+        for kind, request, table, key in actions:
+            if kind == "Put":
+                self.write(table, key, request["Item"])
+            elif kind == "Delete":
+                self.write(table, key, None)
+            elif kind == "Update":
+                updated = dict(self.tables[table].get(key) or {}, **request["Key"])
+                self.write(table, key, Expression(request, updated).update(request["UpdateExpression"]))
+        return {}
@@ -0,0 +1,580 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# The copilot is the Lambda@Edge origin-request handler attached to the
+# CloudFront distribution of each stream instance. It returns a 404 for every
+# request to a distribution that is closed (distro_open is false) in the state
+# table, and for a stable fraction of the requests to a distribution that is
+# being drained (drain_percent between 0 and 100). Optionally it redirects
+# those requests to an open stream instance instead. Requests for a stale
+# rendition of an open distribution (stale_renditions) are answered with a
+# 404, so players switch to another rendition in the same region.
+#
+# In multi-tenant mode (channel_path_segment above 0) one state table holds
+# every channel. The path segment at that position of the request is looked
+# up in channel_paths of the distribution's own item, which maps the paths
+# of this distribution to channel ids, and the state of the channel is the
+# item "<channel>#<distribution domain>". The same channel can have a
+# different path on every distribution, like MediaPackage endpoint ids, and
+# one copilot version serves every channel. Requests whose path segment is
+# not in channel_paths use the item of the distribution domain itself, so
+# paths made up by viewers never cost a read or a cache entry of their own.
+#
+# Cached states are kept in a least recently used cache of at most
+# cache_max_entries keys.
+#
+# Lambda@Edge does not support environment variables, so the configuration is
+# read from copilot_config.json, which is added to the deployment package by
+# the cfn-package-copilot custom resource in copilot.yaml.
+#
+# Request outcomes and state table lookups are counted per container and
+# written as CloudWatch Embedded Metric Format documents at most once per
+# metrics interval, so the request path only updates counters.
+#
+# The state table is read with state_reader.LeanReader, a GetItem client
+# built on the standard library, so a new edge container does not import
+# boto3 before its first request. Set state_reader to "boto3" to read through
+# a boto3 resource instead.
+
+import collections
+import json
+import math
+import os
+import random
+import threading
+import time
+import zlib
+
+import state_reader
+
+CONFIG_FILE = os.environ.get(
+    "COPILOT_CONFIG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "copilot_config.json"))
+
+with open(CONFIG_FILE) as config_file:
+    CONFIG = json.load(config_file)
+
+# CloudFormation passes every custom resource property as a string, so each
+# value is converted here
+
+# domain -> region of each stream instance in the clustered video stream
+REGION_LOOKUP = {
+    instance["domain"]: instance["region"]
+    for instance in CONFIG["stream_instances"]
+}
+
+TABLE_NAME = CONFIG["table_name"]
+
+# the state is cached per container: fresh for CACHE_TTL seconds, then
+# served stale for up to CACHE_STALE more seconds while it is refreshed in
+# the background. A flip is seen within CACHE_TTL + CACHE_STALE seconds.
+CACHE_TTL = float(CONFIG.get("cache_ttl_seconds", 2))
+CACHE_STALE = float(CONFIG.get("cache_stale_seconds", 3))
+
+# replicas of the state table global table, in fallback order
+REPLICA_REGIONS = [
+    region.strip() for region in CONFIG.get("replica_regions", "").split(",")
+    if region.strip()
+] or list(dict.fromkeys(REGION_LOOKUP.values()))
+
+# Each replica read is a single attempt bounded by these timeouts, so a cache
+# miss costs at most len(REPLICA_REGIONS) * (connect + read) seconds
+CONNECT_TIMEOUT = float(CONFIG.get("connect_timeout_ms", 250)) / 1000
+READ_TIMEOUT = float(CONFIG.get("read_timeout_ms", 250)) / 1000
+
+# "lean" or "boto3", see state_reader.py
+STATE_READER = state_reader.READERS[CONFIG.get("state_reader", "lean")]
+
+# a replica is skipped for BREAKER_RESET seconds after BREAKER_FAILURES
+# consecutive failed reads, then probed with a single request
+BREAKER_FAILURES = int(CONFIG.get("breaker_failure_threshold", 3))
+BREAKER_RESET = float(CONFIG.get("breaker_reset_seconds", 10))
+
+# "open" passes requests through when no state can be read, "closed" 404s them
+FAILURE_POLICY = CONFIG.get("failure_policy", "open")
+
+# "path" drains by request path, so every viewer gets the same answer for a
+# path and CloudFront's cached 404s stay consistent. "client" drains by viewer
+# IP, which only spreads viewers if the distribution does not share cached
+# responses between them.
+DRAIN_KEY = CONFIG.get("drain_key", "path")
+
+# "404" lets the player or origin group find another region, "redirect"
+# answers with a 302 to the same path on the nearest open stream instance and
+# falls back to 404 when there is none
+BLOCKED_RESPONSE = CONFIG.get("blocked_response", "404")
+
+# position of the path segment that names the channel, for example 3 for
+# /out/v1/<channel>/index.m3u8. 0 reads the item of the distribution domain
+# for every request.
+CHANNEL_SEGMENT = int(CONFIG.get("channel_path_segment", 0))
+
+# most state table keys cached per container
+CACHE_MAX_ENTRIES = int(CONFIG.get("cache_max_entries", 1000))
+
+# only used to point the copilot at a local stand-in of the state table
+ENDPOINT_URL = CONFIG.get("endpoint_url") or None
+
+# metrics are written per domain every METRICS_INTERVAL seconds, and the
+# latency of METRICS_SAMPLE_RATE of the requests and lookups is recorded.
+# Counts are never sampled.
+METRICS_ENABLED = str(CONFIG.get("metrics", "true")).lower() == "true"
+METRICS_INTERVAL = float(CONFIG.get("metrics_interval_seconds", 60))
+METRICS_SAMPLE_RATE = float(CONFIG.get("metrics_sample_rate", 1))
+METRICS_NAMESPACE = "ClusteredVideoStream"
+
+# rough geography of region name prefixes, used to find nearby replicas
+AREAS = {
+    "us": 0, "ca": 0, "mx": 0, "sa": 0,
+    "eu": 1, "me": 1, "il": 1, "af": 1,
+    "ap": 2, "cn": 2
+}
+EDGE_REGION = os.environ.get("AWS_REGION", "us-east-1")
+
+
+def distance(region):
+    if region == EDGE_REGION:
+        return 0
+    same_area = AREAS.get(region.split("-")[0]) == AREAS.get(
+        EDGE_REGION.split("-")[0])
+    return 1 if same_area else 2
+
+
+# replicas nearest to this edge first, ties keep the configured order
+REPLICA_REGIONS.sort(key=distance)
+
+# state of a stream instance as stored in the state table. channel_paths
+# maps path segments to channel ids, and is only set on distribution items.
+State = collections.namedtuple(
+    "State", ["distro_open", "drain_percent", "path_prefix", "stale_renditions",
+              "channel_paths"])
+
+# state used for domains that are missing from the state table
+OPEN = State(True, 0.0, "", (), {})
+
+# state table key -> (State, monotonic time it was read), least recently
+# used first
+cache = collections.OrderedDict()
+refreshing = set()
+lock = threading.Lock()
+
+
+class StateUnavailable(Exception):
+    pass
+
+
+# latency histogram buckets grow by a quarter from 1 microsecond, so a
+# latency is off by at most 12% and anything up to a minute fits in the 100
+# values an EMF metric allows
+BUCKET_BASE = 0.001
+BUCKET_GROWTH = math.log(1.25)
+
+
+def latency_bucket(ms):
+    """
+    Return the index of the histogram bucket of a latency in ms
+    """
+    if ms <= BUCKET_BASE:
+        return 0
+    return math.ceil(math.log(ms / BUCKET_BASE) / BUCKET_GROWTH)
+
+
+def bucket_value(index):
+    """
+    Return the latency in ms at the centre of a histogram bucket
+    """
+    if index == 0:
+        return BUCKET_BASE
+    return round(BUCKET_BASE * math.exp((index - 0.5) * BUCKET_GROWTH), 4)
+
+
+class Metrics:
+    """
+    Counters and latency histograms per domain, written as one EMF document
+    per domain with the Domain and EdgeRegion dimensions
+    """
+
+    UNITS = {"OriginRequestLatency": "Milliseconds", "LookupLatency": "Milliseconds"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # (domain, name) and (domain, name, bucket) to counts
+        self.counts = collections.Counter()
+        self.histograms = collections.Counter()
+        self.started = time.monotonic()
+
+    def sampled(self):
+        return METRICS_ENABLED and (METRICS_SAMPLE_RATE >= 1
+                                    or random.random() < METRICS_SAMPLE_RATE)
+
+    def record(self, domain, name, latency_name=None, ms=None):
+        """
+        Count one name, and add a sampled latency in ms if there is one
+        """
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            if name:
+                self.counts[domain, name] += 1
+            if ms is not None:
+                self.histograms[domain, latency_name, latency_bucket(ms)] += 1
+
+    def flush(self, force=False):
+        """
+        Write the documents if the interval has passed, and start a new one
+        """
+        if not METRICS_ENABLED or not force and time.monotonic(
+        ) - self.started < METRICS_INTERVAL:
+            return
+        with self.lock:
+            counts, histograms = self.counts, self.histograms
+            self.reset()
+        documents = collections.defaultdict(dict)
+        for (domain, name), count in counts.items():
+            documents[domain][name] = count
+        for (domain, name, bucket), count in sorted(histograms.items()):
+            histogram = documents[domain].setdefault(name, {"Values": [], "Counts": []})
+            histogram["Values"].append(bucket_value(bucket))
+            histogram["Counts"].append(count)
+        timestamp = int(time.time() * 1000)
+        for domain, values in documents.items():
+            document = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["Domain", "EdgeRegion"], ["EdgeRegion"]],
+                        "Metrics": [{
+                            "Name": name,
+                            "Unit": self.UNITS.get(name, "Count")
+                        } for name in sorted(values)]
+                    }]
+                },
+                "Domain": domain,
+                "EdgeRegion": EDGE_REGION
+            }
+            document.update(values)
+            print(json.dumps(document))
+
+
+metrics = Metrics()
+
+
+class Breaker:
+    """
+    Consecutive failure circuit breaker for one replica of the state table
+    """
+
+    def __init__(self, region):
+        self.region = region
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+
+    def allow(self):
+        with lock:
+            if self.state == "open" and time.monotonic(
+            ) - self.opened_at >= BREAKER_RESET:
+                self.transition("half-open")
+                return True
+            return self.state == "closed"
+
+    def record(self, success):
+        with lock:
+            if success:
+                self.failures = 0
+                if self.state != "closed":
+                    self.transition("closed")
+            else:
+                self.failures += 1
+                if self.state == "half-open" or self.failures >= BREAKER_FAILURES:
+                    self.opened_at = time.monotonic()
+                    if self.state != "open":
+                        self.transition("open")
+
+    def transition(self, state):
+        self.state = state
+        print(
+            json.dumps({
+                "breaker": state,
+                "region": self.region,
+                "failures": self.failures
+            }))
+
+
+def create_reader(region):
+    return STATE_READER(region, TABLE_NAME, endpoint_url=ENDPOINT_URL,
+                        connect_timeout=CONNECT_TIMEOUT,
+                        read_timeout=READ_TIMEOUT)
+
+
+# one reader and breaker per replica, created once per container and reused
+REPLICAS = [(create_reader(region), Breaker(region))
+            for region in REPLICA_REGIONS]
+
+
+def state_key(channel, domain):
+    return "{}#{}".format(channel, domain) if channel else domain
+
+
+def channel_segment(uri):
+    """
+    Return the path segment of a request that names its channel, or "" when
+    the path has no directory at CHANNEL_SEGMENT
+    """
+    if CHANNEL_SEGMENT <= 0:
+        return ""
+    segments = uri.split("/")
+    # the last segment is the file name, never a channel
+    if CHANNEL_SEGMENT < len(segments) - 1:
+        return segments[CHANNEL_SEGMENT]
+    return ""
+
+
+def channel_of(uri, domain):
+    """
+    Return the channel id of a request to a distribution, or "" when its
+    path segment is not a channel path of the distribution
+    """
+    segment = channel_segment(uri)
+    if not segment:
+        return ""
+    return get_state(domain).channel_paths.get(segment, "")
+
+
+def with_segment(uri, segment):
+    """
+    Return a request path with its channel segment replaced
+    """
+    segments = uri.split("/")
+    segments[CHANNEL_SEGMENT] = segment
+    return "/".join(segments)
+
+
+def cached(key):
+    with lock:
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+        return entry
+
+
+def store(key, state):
+    with lock:
+        cache[key] = (state, time.monotonic())
+        cache.move_to_end(key)
+        while len(cache) > CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+
+def read_state(key):
+    """
+    Read the state of a state table key from the nearest available replica
+    of the state table and cache it
+    """
+    # metrics are per distribution, not per channel
+    domain = key.rsplit("#", 1)[-1]
+    for reader, breaker in REPLICAS:
+        if not breaker.allow():
+            continue
+        sampled = metrics.sampled()
+        start = time.perf_counter() if sampled else 0
+        try:
+            item = reader.get_item(
+                {"domain": key},
+                "distro_open, drain_percent, path_prefix, stale_renditions, channel_paths")
+        except Exception as error:
+            print(
+                json.dumps({
+                    "region": breaker.region,
+                    "domain": key,
+                    "error": str(error)
+                }))
+            timeout = isinstance(error, state_reader.LookupTimeout)
+            metrics.record(domain, "LookupTimeouts" if timeout else "LookupErrors")
+            breaker.record(False)
+            continue
+        if sampled:
+            metrics.record(domain, None, "LookupLatency",
+                           (time.perf_counter() - start) * 1000)
+        breaker.record(True)
+        # domains missing from the state table are never blocked, and
+        # tables written before drain_percent existed have no drain
+        state = State(item.get("distro_open", True),
+                      float(item.get("drain_percent", 0)),
+                      item.get("path_prefix", ""),
+                      rendition_stems(item.get("stale_renditions", ())),
+                      item.get("channel_paths", {}))
+        store(key, state)
+        return state
+    metrics.record(domain, "StateUnavailable")
+    raise StateUnavailable(key)
+
+
+def refresh(key):
+    try:
+        read_state(key)
+    except StateUnavailable:
+        pass
+    finally:
+        with lock:
+            refreshing.discard(key)
+
+
+def get_state(key):
+    """
+    Return the state of a state table key, going to the state table only
+    when the cached value is missing or older than CACHE_TTL + CACHE_STALE
+    """
+    entry = cached(key)
+    if entry is not None:
+        age = time.monotonic() - entry[1]
+        if age < CACHE_TTL:
+            return entry[0]
+        if age < CACHE_TTL + CACHE_STALE:
+            # stale-while-revalidate, one refresh per key at a time
+            with lock:
+                start = key not in refreshing
+                refreshing.add(key)
+            if start:
+                threading.Thread(target=refresh, args=(key, ),
+                                 daemon=True).start()
+            return entry[0]
+    try:
+        return read_state(key)
+    except StateUnavailable:
+        # keep using the last known state while every replica is failing
+        if entry is not None:
+            return entry[0]
+        return OPEN if FAILURE_POLICY == "open" else State(False, 0.0, "", (), {})
+
+
+def rendition_stems(paths):
+    """
+    Return the playlist paths of stale renditions without their extension,
+    which is the part segment names share with the playlist
+    """
+    return tuple(sorted(os.path.splitext(path)[0] for path in paths))
+
+
+def stale_rendition(uri, stems):
+    """
+    Return True if a request is for the playlist of a stale rendition or a
+    segment named after it, like index_1.m3u8 and index_1_00042.ts. The stem
+    must be followed by a separator, so index_1 does not match index_10.
+    """
+    for stem in stems:
+        if uri.startswith(stem) and uri[len(stem):len(stem) + 1] in ("_", ".", "-", "/"):
+            return True
+    return False
+
+
+def drained(request, drain_percent):
+    """
+    Return True if this request falls in the drained fraction. The hash is
+    stable across edge containers, so a request is drained everywhere once
+    it is drained anywhere, and raising drain_percent only adds requests.
+    """
+    if drain_percent <= 0:
+        return False
+    if drain_percent >= 100:
+        return True
+    if DRAIN_KEY == "client":
+        key = request.get("clientIp", "")
+    else:
+        key = request["uri"]
+    return zlib.crc32(key.encode()) % 10000 < drain_percent * 100
+
+
+def redirect_location(domain, state, request, channel=""):
+    """
+    Return the URL of this request on the nearest stream instance that is
+    open and not draining, or None if there is no such instance. Draining
+    instances are skipped so two of them never redirect to each other.
+    A channel is only redirected to distributions that serve it, under the
+    path it has there.
+    """
+    targets = [(distance(region), n, other)
+               for n, (other, region) in enumerate(REGION_LOOKUP.items())
+               if other != domain]
+    for _, _, other in sorted(targets):
+        segment = None
+        if channel:
+            paths = sorted(x for x, c in get_state(other).channel_paths.items() if c == channel)
+            if not paths:
+                continue
+            segment = paths[0]
+        target = get_state(state_key(channel, other))
+        if target.distro_open and target.drain_percent <= 0:
+            uri = request["uri"]
+            if segment is not None:
+                uri = with_segment(uri, segment)
+            # stream instances can serve the same stream under different paths
+            if state.path_prefix and target.path_prefix and uri.startswith(
+                    state.path_prefix):
+                uri = target.path_prefix + uri[len(state.path_prefix):]
+            if request.get("querystring"):
+                uri += "?" + request["querystring"]
+            return "https://" + other + uri
+    return None
+
+
+def blocked_response(domain, state, request, channel=""):
+    response = {"headers": {}}
+    location = None
+    if BLOCKED_RESPONSE == "redirect":
+        location = redirect_location(domain, state, request, channel)
+    if location is None:
+        response['status'] = '404'
+        return response
+    response['status'] = '302'
+    response['statusDescription'] = "Found"
+    response['headers']['location'] = [{"key": "Location", "value": location}]
+    # let CloudFront reuse the redirect no longer than a state change takes
+    response['headers']['cache-control'] = [{
+        "key": "Cache-Control",
+        "value": "max-age={}".format(int(CACHE_TTL + CACHE_STALE))
+    }]
+    return response
+
+
+def origin_request(event, context):
+    """
+    This function is the L@E entry point for origin requests
+    """
+
+    sampled = metrics.sampled()
+    start = time.perf_counter() if sampled else 0
+    request = event['Records'][0]['cf']['request']
+    # get the domain name for this distribution
+    domain = event['Records'][0]['cf']['config']['distributionDomainName']
+    outcome = "Errors"
+    try:
+        channel = channel_of(request['uri'], domain)
+        state = get_state(state_key(channel, domain))
+        # if open == false block all requests, if the distribution is draining
+        # block the drained fraction of requests
+        if not state.distro_open or drained(request, state.drain_percent):
+            response = blocked_response(domain, state, request, channel)
+            outcome = "Redirected" if response['status'] == '302' else "Blocked"
+        elif state.stale_renditions and stale_rendition(request['uri'],
+                                                        state.stale_renditions):
+            # never redirected, the player should stay in this region
+            response = {"status": "404", "headers": {}}
+            outcome = "RenditionBlocked"
+        else:
+            response = request
+            outcome = "PassedThrough"
+    except Exception as error:
+        # a malformed state table item must not turn into a 5xx at the edge,
+        # the request is counted as an error and the failure policy applies
+        print(json.dumps({"domain": domain, "uri": request.get('uri'), "error": repr(error)}))
+        response = request if FAILURE_POLICY == "open" else {"status": "404", "headers": {}}
+    finally:
+        metrics.record(domain, outcome, "OriginRequestLatency",
+                       (time.perf_counter() - start) * 1000 if sampled else None)
+        metrics.flush()
+    return response
@@ -0,0 +1,235 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# State table reads for the copilot.
+#
+# Importing boto3 and building a DynamoDB resource costs a few hundred ms in
+# every new edge container, before the first viewer request is answered.
+# LeanReader sends GetItem with the standard library only: the request is
+# signed with Signature Version 4 and sent over a keep-alive connection that
+# is reused by later reads of the same container. Boto3Reader keeps the boto3
+# resource path, and only imports boto3 when it is created.
+#
+# Both readers return the item as plain values, {} for a missing item, and
+# raise LookupTimeout or StateReadError when a read fails.
+
+import datetime
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import socket
+import threading
+import urllib.parse
+
+SERVICE = "dynamodb"
+TARGET = "DynamoDB_20120810.GetItem"
+CONTENT_TYPE = "application/x-amz-json-1.0"
+
+
+class StateReadError(Exception):
+    pass
+
+
+class LookupTimeout(StateReadError):
+    pass
+
+
+def deserialize(attribute):
+    """
+    Return the plain value of a DynamoDB attribute in wire format. Numbers
+    are returned as float, the copilot never needs exact decimals.
+    """
+    (kind, value), = attribute.items()
+    if kind == "S" or kind == "BOOL":
+        return value
+    if kind == "N":
+        return float(value)
+    if kind == "NULL":
+        return None
+    if kind == "M":
+        return {k: deserialize(v) for k, v in value.items()}
+    if kind == "L":
+        return [deserialize(v) for v in value]
+    if kind == "SS":
+        return set(value)
+    if kind == "NS":
+        return {float(v) for v in value}
+    raise StateReadError("unsupported attribute type " + kind)
+
+
+def get_credentials():
+    """
+    Return (access key, secret key, session token). Lambda sets the
+    environment variables of the execution role in every container, botocore
+    is only imported where they are missing.
+    """
+    access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+    secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+    if access_key and secret_key:
+        return access_key, secret_key, os.environ.get("AWS_SESSION_TOKEN")
+    import botocore.session
+    credentials = botocore.session.get_session().get_credentials()
+    if credentials is None:
+        raise StateReadError("no AWS credentials found")
+    frozen = credentials.get_frozen_credentials()
+    return frozen.access_key, frozen.secret_key, frozen.token
+
+
+class LeanReader:
+    """
+    GetItem on one replica of a table. Idle connections are pooled, so the
+    background refresh thread and a request can read at the same time.
+    """
+
+    def __init__(self, region, table_name, endpoint_url=None,
+                 connect_timeout=0.25, read_timeout=0.25):
+        url = urllib.parse.urlsplit(
+            endpoint_url or "https://{}.{}.amazonaws.com".format(SERVICE, region))
+        self.region = region
+        self.table_name = table_name
+        self.secure = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.secure else 80)
+        self.host_header = url.netloc
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        # (date, secret key, signing key) of the last request. The signing key
+        # is derived again when the date or the credentials change
+        self.signing_key = (None, None, None)
+
+    def connect(self):
+        if self.secure:
+            connection = http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.connect_timeout)
+        else:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def key(self, date, secret_key):
+        cached_date, cached_secret, key = self.signing_key
+        if cached_date != date or cached_secret != secret_key:
+            key = ("AWS4" + secret_key).encode()
+            for part in (date, self.region, SERVICE, "aws4_request"):
+                key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+            self.signing_key = (date, secret_key, key)
+        return key
+
+    def headers(self, body, now=None):
+        """
+        Return the signed headers of a GetItem request
+        """
+        access_key, secret_key, token = get_credentials()
+        now = now or datetime.datetime.utcnow()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = amz_date[:8]
+        headers = {
+            "content-type": CONTENT_TYPE,
+            "host": self.host_header,
+            "x-amz-date": amz_date,
+            "x-amz-target": TARGET
+        }
+        if token:
+            headers["x-amz-security-token"] = token
+        names = sorted(headers)
+        canonical = "\n".join([
+            "POST", "/", "",
+            "".join("{}:{}\n".format(name, headers[name]) for name in names),
+            ";".join(names),
+            hashlib.sha256(body).hexdigest()
+        ])
+        scope = "{}/{}/{}/aws4_request".format(date, self.region, SERVICE)
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope,
+            hashlib.sha256(canonical.encode()).hexdigest()
+        ])
+        signature = hmac.new(self.key(date, secret_key), string_to_sign.encode(),
+                             hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+                access_key, scope, ";".join(names), signature))
+        return headers
+
+    def post(self, body):
+        """
+        Send a request and return (status, response body). A pooled
+        connection the server has closed is replaced once.
+        """
+        headers = self.headers(body)
+        for attempt in range(2):
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            reused = connection is not None
+            try:
+                if connection is None:
+                    connection = self.connect()
+                connection.request("POST", "/", body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except socket.timeout as error:
+                if connection is not None:
+                    connection.close()
+                raise LookupTimeout("{} timed out: {}".format(self.host, error))
+            except (http.client.HTTPException, OSError) as error:
+                if connection is not None:
+                    connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise StateReadError("{} failed: {}".format(self.host, error))
+            if response.will_close:
+                connection.close()
+            else:
+                with self.lock:
+                    self.idle.append(connection)
+            return response.status, data
+
+    def get_item(self, key, projection):
+        body = json.dumps({
+            "TableName": self.table_name,
+            "Key": {name: {"S": value} for name, value in key.items()},
+            "ProjectionExpression": projection
+        }).encode()
+        status, data = self.post(body)
+        result = json.loads(data or b"{}")
+        if status != 200:
+            raise StateReadError("{} {}: {}".format(
+                status, result.get("__type", "").split("#")[-1],
+                result.get("message") or result.get("Message", "")))
+        return {name: deserialize(value)
+                for name, value in result.get("Item", {}).items()}
+
+
+class Boto3Reader:
+    """
+    GetItem through a boto3 DynamoDB resource
+    """
+
+    def __init__(self, region, table_name, endpoint_url=None,
+                 connect_timeout=0.25, read_timeout=0.25):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ConnectTimeoutError, ReadTimeoutError
+        self.timeouts = (ConnectTimeoutError, ReadTimeoutError)
+        self.table = boto3.resource(
+            SERVICE, region_name=region, endpoint_url=endpoint_url,
+            config=Config(connect_timeout=connect_timeout,
+                          read_timeout=read_timeout,
+                          retries={"max_attempts": 0})).Table(table_name)
+
+    def get_item(self, key, projection):
+        try:
+            response = self.table.get_item(Key=key, ProjectionExpression=projection)
+        except self.timeouts as error:
+            raise LookupTimeout(str(error))
+        except Exception as error:
+            raise StateReadError(str(error))
+        return response.get("Item", {})
+
+
+READERS = {"lean": LeanReader, "boto3": Boto3Reader}
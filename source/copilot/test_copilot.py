@@ -0,0 +1,226 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the copilot. Each test loads its own copy of copilot.py with
+# a copilot_config.json written for it, and replaces the state table readers
+# with FakeReader, so no AWS account or network is needed.
+
+import importlib.util
+import json
+import os
+import uuid
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeReader:
+    """
+    A state table replica that answers GetItem from a dict and counts reads
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.reads = []
+
+    def get_item(self, key, projection):
+        self.reads.append(key["domain"])
+        return dict(self.items.get(key["domain"], {}))
+
+
+@pytest.fixture
+def load_copilot(tmp_path, monkeypatch):
+    def load(items, **config):
+        settings = {
+            "table_name": "cvs",
+            "stream_instances": [
+                {"domain": "d0.cloudfront.net", "region": "us-west-2"},
+                {"domain": "d1.cloudfront.net", "region": "eu-west-1"}
+            ],
+            "metrics": "false"
+        }
+        settings.update(config)
+        path = tmp_path / "copilot_config.json"
+        path.write_text(json.dumps(settings))
+        monkeypatch.setenv("COPILOT_CONFIG", str(path))
+        monkeypatch.setenv("AWS_REGION", "us-west-2")
+        spec = importlib.util.spec_from_file_location(
+            "copilot_" + uuid.uuid4().hex, os.path.join(HERE, "copilot.py"))
+        copilot = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(copilot)
+        reader = FakeReader(items)
+        copilot.REPLICAS = [(reader, copilot.Breaker("us-west-2"))]
+        return copilot, reader
+    return load
+
+
+def request(domain, uri, querystring=""):
+    return {"Records": [{"cf": {
+        "config": {"distributionDomainName": domain},
+        "request": {"uri": uri, "querystring": querystring, "clientIp": "192.0.2.1", "headers": {}}
+    }}]}
+
+
+def status(response):
+    return response.get("status", "pass")
+
+
+def test_unknown_channel_segments_do_not_grow_cache_or_reads(load_copilot):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True, "channel_paths": {"news": "news"}},
+        "news#d0.cloudfront.net": {"distro_open": True}
+    }, channel_path_segment=3)
+    copilot.origin_request(request("d0.cloudfront.net", "/out/v1/news/index.m3u8"), None)
+    entries = len(copilot.cache)
+    reads = len(reader.reads)
+    for _ in range(500):
+        uri = "/out/v1/{}/index.m3u8".format(uuid.uuid4().hex)
+        assert status(copilot.origin_request(request("d0.cloudfront.net", uri), None)) == "pass"
+    assert len(copilot.cache) == entries
+    assert len(reader.reads) == reads
+
+
+def test_cache_is_capped(load_copilot):
+    copilot, reader = load_copilot({}, cache_max_entries=3)
+    for n in range(5):
+        copilot.get_state("d{}.cloudfront.net".format(n))
+    assert list(copilot.cache) == ["d2.cloudfront.net", "d3.cloudfront.net", "d4.cloudfront.net"]
+
+
+def test_channel_uses_its_own_item(load_copilot):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True, "channel_paths": {"news": "news", "sport": "sport"}},
+        "news#d0.cloudfront.net": {"distro_open": False},
+        "sport#d0.cloudfront.net": {"distro_open": True}
+    }, channel_path_segment=3)
+    assert status(copilot.origin_request(request("d0.cloudfront.net", "/out/v1/news/index.m3u8"), None)) == "404"
+    assert status(copilot.origin_request(request("d0.cloudfront.net", "/out/v1/sport/index.m3u8"), None)) == "pass"
+
+
+def test_channel_redirects_to_its_path_on_the_other_distribution(load_copilot):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True, "channel_paths": {"news": "news"}},
+        "d1.cloudfront.net": {"distro_open": True, "channel_paths": {"ep-1234": "news"}},
+        "news#d0.cloudfront.net": {"distro_open": False},
+        "news#d1.cloudfront.net": {"distro_open": True}
+    }, channel_path_segment=3, blocked_response="redirect")
+    response = copilot.origin_request(request("d0.cloudfront.net", "/out/v1/news/index.m3u8", "a=1"), None)
+    assert response["status"] == "302"
+    assert response["headers"]["location"][0]["value"] == "https://d1.cloudfront.net/out/v1/ep-1234/index.m3u8?a=1"
+
+
+@pytest.mark.parametrize("policy, expected", [("open", "pass"), ("closed", "404")])
+def test_malformed_state_applies_the_failure_policy(load_copilot, policy, expected):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True, "drain_percent": "half"}
+    }, failure_policy=policy)
+    recorded = []
+    copilot.metrics.record = lambda domain, outcome, *args: recorded.append(outcome)
+    assert status(copilot.origin_request(request("d0.cloudfront.net", "/out/v1/index.m3u8"), None)) == expected
+    assert recorded[-1] == "Errors"
+
+
+def test_malformed_stale_rendition_applies_the_failure_policy(load_copilot):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True, "stale_renditions": [1]}
+    }, failure_policy="open")
+    assert status(copilot.origin_request(request("d0.cloudfront.net", "/out/v1/index_1.m3u8"), None)) == "pass"
+
+
+def test_drain_is_stable_and_grows_with_the_percentage(load_copilot):
+    copilot, reader = load_copilot({})
+    uris = ["/out/v1/index_1_{:05d}.ts".format(n) for n in range(2000)]
+    at_25 = {x for x in uris if copilot.drained({"uri": x}, 25)}
+    at_50 = {x for x in uris if copilot.drained({"uri": x}, 50)}
+    assert at_25 == {x for x in uris if copilot.drained({"uri": x}, 25)}
+    assert at_25 < at_50
+    assert 400 < len(at_25) < 600
+    assert not any(copilot.drained({"uri": x}, 0) for x in uris)
+    assert all(copilot.drained({"uri": x}, 100) for x in uris)
+
+
+def test_drain_by_client(load_copilot):
+    copilot, reader = load_copilot({}, drain_key="client")
+    clients = ["192.0.2.{}".format(n) for n in range(256)]
+    drained = [x for x in clients if copilot.drained({"uri": "/out/v1/index.m3u8", "clientIp": x}, 50)]
+    assert 0 < len(drained) < len(clients)
+
+
+def test_redirect_skips_closed_and_draining_instances(load_copilot):
+    instances = [
+        {"domain": "d0.cloudfront.net", "region": "us-west-2"},
+        {"domain": "d1.cloudfront.net", "region": "us-east-1"},
+        {"domain": "d2.cloudfront.net", "region": "us-east-2"},
+        {"domain": "d3.cloudfront.net", "region": "eu-west-1"}
+    ]
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": False},
+        "d1.cloudfront.net": {"distro_open": True, "drain_percent": 10},
+        "d2.cloudfront.net": {"distro_open": False},
+        "d3.cloudfront.net": {"distro_open": True, "path_prefix": "/eu"}
+    }, stream_instances=instances, blocked_response="redirect")
+    state = copilot.get_state("d0.cloudfront.net")
+    location = copilot.redirect_location("d0.cloudfront.net", state, {"uri": "/out/v1/index.m3u8"})
+    assert location == "https://d3.cloudfront.net/out/v1/index.m3u8"
+    reader.items["d2.cloudfront.net"]["distro_open"] = True
+    copilot.cache.clear()
+    location = copilot.redirect_location("d0.cloudfront.net", state, {"uri": "/out/v1/index.m3u8"})
+    # same area as the edge first
+    assert location == "https://d2.cloudfront.net/out/v1/index.m3u8"
+
+
+def test_redirect_falls_back_to_404(load_copilot):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": False},
+        "d1.cloudfront.net": {"distro_open": False}
+    }, blocked_response="redirect")
+    assert status(copilot.origin_request(request("d0.cloudfront.net", "/out/v1/index.m3u8"), None)) == "404"
+
+
+def test_stale_rendition_matches_playlist_and_segments_only(load_copilot):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True, "stale_renditions": {"/out/v1/index_1.m3u8"}}
+    })
+    answers = {uri: status(copilot.origin_request(request("d0.cloudfront.net", uri), None))
+               for uri in ("/out/v1/index_1.m3u8", "/out/v1/index_1_00042.ts", "/out/v1/index_10.m3u8",
+                           "/out/v1/index_2.m3u8", "/out/v1/index.m3u8")}
+    assert answers == {"/out/v1/index_1.m3u8": "404", "/out/v1/index_1_00042.ts": "404",
+                       "/out/v1/index_10.m3u8": "pass", "/out/v1/index_2.m3u8": "pass",
+                       "/out/v1/index.m3u8": "pass"}
+
+
+@pytest.mark.parametrize("policy, expected", [("open", "pass"), ("closed", "404")])
+def test_unavailable_state_applies_the_failure_policy(load_copilot, policy, expected):
+    copilot, reader = load_copilot({}, failure_policy=policy)
+
+    def failing(key, projection):
+        raise OSError("unreachable")
+    reader.get_item = failing
+    assert status(copilot.origin_request(request("d0.cloudfront.net", "/out/v1/index.m3u8"), None)) == expected
+
+
+def test_metrics_are_aggregated_per_domain(load_copilot, capsys):
+    copilot, reader = load_copilot({
+        "d0.cloudfront.net": {"distro_open": True},
+        "d1.cloudfront.net": {"distro_open": False}
+    }, metrics="true", metrics_interval_seconds=3600)
+    for _ in range(3):
+        copilot.origin_request(request("d0.cloudfront.net", "/out/v1/index.m3u8"), None)
+    copilot.origin_request(request("d1.cloudfront.net", "/out/v1/index.m3u8"), None)
+    assert capsys.readouterr().out == ""
+    copilot.metrics.flush(force=True)
+    documents = {x["Domain"]: x for x in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert documents["d0.cloudfront.net"]["PassedThrough"] == 3
+    assert documents["d1.cloudfront.net"]["Blocked"] == 1
+    latency = documents["d0.cloudfront.net"]["OriginRequestLatency"]
+    assert sum(latency["Counts"]) == 3
+    assert len(latency["Values"]) == len(latency["Counts"])
+    names = [x["Name"] for x in documents["d0.cloudfront.net"]["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+    assert "PassedThrough" in names and "OriginRequestLatency" in names
+
+
+def test_latency_buckets_are_within_an_eighth(load_copilot):
+    copilot, reader = load_copilot({})
+    for ms in (0.01, 0.5, 3, 47, 1000, 60000):
+        assert abs(copilot.bucket_value(copilot.latency_bucket(ms)) - ms) / ms < 0.125
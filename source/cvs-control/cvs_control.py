@@ -0,0 +1,434 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Operator control of the stream instances in the state table.
+#
+#   python cvs_control.py --stream NAME list
+#   python cvs_control.py --stream NAME open INSTANCE [INSTANCE ...]
+#   python cvs_control.py --stream NAME close INSTANCE [INSTANCE ...]
+#   python cvs_control.py --stream NAME flip --close INSTANCE --open INSTANCE
+#   python cvs_control.py --stream NAME drain INSTANCE PERCENT
+#   python cvs_control.py --stream NAME watch
+#   python cvs_control.py --stream NAME add-channel CHANNEL [--path INSTANCE=PATH ...]
+#   python cvs_control.py --stream NAME remove-channel CHANNEL
+#
+# An INSTANCE is a CloudFront domain, a stream instance name, or a region
+# with a single stream instance.
+#
+# In a multi-tenant table every channel has an item per stream instance,
+# keyed "<channel>#<domain>" and with a channel attribute. add-channel copies
+# the stream instances of the table (the items without a channel) to a new
+# channel in one transaction, open, and adds the path segment of the channel
+# on each distribution to channel_paths of the distribution's item. The path
+# is the channel name unless --path gives another one for an instance, as
+# for MediaPackage endpoints with different ids in every region.
+# remove-channel deletes the items and paths of a channel. open, close, flip
+# and drain act on the channel given with --channel, or on the items without
+# a channel.
+#
+# The instances changed by one command are written in one DynamoDB
+# transaction, so a flip that closes one region and opens another never
+# leaves both closed or both open in the region the command writes to. The
+# other replicas of the global table receive the items as they replicate.
+# close refuses to close the last open stream instance unless --force is
+# given, with a condition on another open instance in the same transaction.
+#
+# watch prints the table once, then every change from the stream of the
+# table, instead of scanning it again.
+
+import argparse
+import json
+import sys
+import time
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+COLUMNS = ["name", "region", "domain", "playlist_fresh", "segments_healthy", "distro_open", "drain_percent",
+           "closed_by", "stale_renditions"]
+
+# DynamoDB Streams allows about two readers per shard, and the stream is
+# already read by the StateHistory function and the PlaylistInvalidator, so
+# watch reads each shard at most once per STREAM_POLL_SECONDS. When reads are throttled, the wait
+# doubles up to STREAM_MAX_BACKOFF_SECONDS.
+STREAM_POLL_SECONDS = 1.0
+STREAM_MAX_BACKOFF_SECONDS = 30.0
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "LimitExceededException", "ThrottlingException")
+
+# shards are listed again when one ends, or at least this often
+SHARD_REFRESH_SECONDS = 30
+
+deserializer = TypeDeserializer()
+serializer = TypeSerializer()
+
+
+def deserialize(image):
+    return {k: deserializer.deserialize(v) for k, v in image.items()}
+
+
+def serialize(values):
+    return {k: serializer.serialize(v) for k, v in values.items()}
+
+
+def channel_of(instance):
+    # items written before the channel attribute existed carry it in the key
+    key = instance["domain"]
+    return instance.get("channel") or (key.rsplit("#", 1)[0] if "#" in key else "")
+
+
+def in_channel(instances, channel):
+    return [x for x in instances if channel_of(x) == (channel or "")]
+
+
+class Control:
+    def __init__(self, stream_name, region=None):
+        self.table_name = stream_name
+        self.dynamodb = boto3.client("dynamodb", region_name=region)
+        self.streams = boto3.client("dynamodbstreams", region_name=region)
+
+    def instances(self):
+        items = []
+        paginator = self.dynamodb.get_paginator("scan")
+        for page in paginator.paginate(TableName=self.table_name, ConsistentRead=True):
+            items.extend(deserialize(item) for item in page["Items"])
+        return sorted(items, key=lambda x: (x.get("name", ""), x["domain"]))
+
+    def resolve(self, instances, selectors):
+        """
+        Return the domains of the stream instances matching the selectors
+        """
+        domains = []
+        for selector in selectors:
+            matches = [x["domain"] for x in instances if selector in (x["domain"], x.get("name"))]
+            if not matches:
+                matches = [x["domain"] for x in instances if x.get("region") == selector]
+                if len(matches) > 1:
+                    raise ValueError("region {} has {} stream instances, use the domain".format(selector, len(matches)))
+            if not matches:
+                raise ValueError("no stream instance {}".format(selector))
+            domains.extend(x for x in matches if x not in domains)
+        return domains
+
+    def update(self, domain, expression, values=None):
+        update = {
+            "TableName": self.table_name,
+            "Key": serialize({"domain": domain}),
+            "UpdateExpression": expression,
+            "ConditionExpression": "attribute_exists(#domain)",
+            "ExpressionAttributeNames": {"#domain": "domain"}
+        }
+        if values:
+            update["ExpressionAttributeValues"] = serialize(values)
+        return {"Update": update}
+
+    def open_update(self, domain):
+        return self.update(domain, "SET distro_open = :open REMOVE closed_by", {":open": True})
+
+    def close_update(self, domain):
+        # closed_by marks the close as an operator decision, which the
+        # failover controller never reverts
+        return self.update(domain, "SET distro_open = :closed, closed_by = :operator",
+                           {":closed": False, ":operator": "operator"})
+
+    def remains_open(self, instances, closing, opening):
+        """
+        Return a condition check that keeps one stream instance open, or
+        raise if none would be
+        """
+        if opening:
+            return []
+        remaining = [x["domain"] for x in instances
+                     if x["domain"] not in closing and x.get("distro_open", True)]
+        if not remaining:
+            raise ValueError("refusing to close every open stream instance, use --force")
+        return [{"ConditionCheck": {
+            "TableName": self.table_name,
+            "Key": serialize({"domain": remaining[0]}),
+            "ConditionExpression": "attribute_not_exists(distro_open) OR distro_open = :open",
+            "ExpressionAttributeValues": serialize({":open": True})
+        }}]
+
+    def transact(self, items):
+        try:
+            self.dynamodb.transact_write_items(TransactItems=items)
+        except self.dynamodb.exceptions.TransactionCanceledException as e:
+            reasons = [x.get("Code") for x in e.response.get("CancellationReasons", [])]
+            raise RuntimeError("state changed during the update, nothing was written ({})".format(", ".join(reasons)))
+
+    def set_state(self, close=(), open=(), force=False, channel=None):
+        instances = in_channel(self.instances(), channel)
+        closing = self.resolve(instances, close)
+        opening = self.resolve(instances, open)
+        both = set(closing) & set(opening)
+        if both:
+            raise ValueError("cannot open and close {}".format(", ".join(sorted(both))))
+        items = [self.close_update(x) for x in closing] + [self.open_update(x) for x in opening]
+        if closing and not force:
+            items += self.remains_open(instances, closing, opening)
+        self.transact(items)
+        return closing, opening
+
+    def drain(self, selector, percent, channel=None):
+        if not 0 <= percent <= 100:
+            raise ValueError("drain percent must be between 0 and 100")
+        domain = self.resolve(in_channel(self.instances(), channel), [selector])[0]
+        if percent == 0:
+            self.transact([self.update(domain, "REMOVE drain_percent")])
+        else:
+            self.transact([self.update(domain, "SET drain_percent = :percent",
+                                       {":percent": Decimal(str(percent))})])
+        return domain
+
+    def paths_update(self, instance, paths):
+        """
+        Return a transaction item that replaces channel_paths of a stream
+        instance, if nobody changed it since it was read
+        """
+        update = {
+            "TableName": self.table_name,
+            "Key": serialize({"domain": instance["domain"]}),
+            "ExpressionAttributeValues": {}
+        }
+        if paths:
+            update["UpdateExpression"] = "SET channel_paths = :paths"
+            update["ExpressionAttributeValues"][":paths"] = serializer.serialize(paths)
+        else:
+            update["UpdateExpression"] = "REMOVE channel_paths"
+        if "channel_paths" in instance:
+            update["ConditionExpression"] = "channel_paths = :old"
+            update["ExpressionAttributeValues"][":old"] = serializer.serialize(instance["channel_paths"])
+        else:
+            update["ConditionExpression"] = "attribute_not_exists(channel_paths)"
+        if not update["ExpressionAttributeValues"]:
+            del update["ExpressionAttributeValues"]
+        return {"Update": update}
+
+    def add_channel(self, channel, paths=()):
+        """
+        Add an open item for every stream instance to a channel, and its path
+        on every distribution, return the keys of the new items. paths are
+        "INSTANCE=PATH" for instances where the path is not the channel name.
+        """
+        if not channel or "#" in channel or "/" in channel:
+            raise ValueError("a channel name cannot be empty or contain # or /")
+        everything = self.instances()
+        if in_channel(everything, channel):
+            raise ValueError("channel {} already exists".format(channel))
+        instances = in_channel(everything, None)
+        if not instances:
+            raise ValueError("the table has no stream instances without a channel to copy")
+        segments = {x["domain"]: channel for x in instances}
+        for entry in paths:
+            selector, _, segment = entry.rpartition("=")
+            if not selector or not segment or "/" in segment:
+                raise ValueError("a path is INSTANCE=PATH with a single path segment, not {}".format(entry))
+            segments[self.resolve(instances, [selector])[0]] = segment
+        items = []
+        keys = []
+        for x in instances:
+            current = dict(x.get("channel_paths", {}))
+            segment = segments[x["domain"]]
+            if segment in current:
+                raise ValueError("path {} of {} already belongs to channel {}".format(
+                    segment, x["domain"], current[segment]))
+            current[segment] = channel
+            key = "{}#{}".format(channel, x["domain"])
+            keys.append(key)
+            items.append({"Put": {
+                "TableName": self.table_name,
+                "Item": serialize({"domain": key, "channel": channel, "name": x.get("name", ""),
+                                   "region": x.get("region", ""), "distro_open": True}),
+                "ConditionExpression": "attribute_not_exists(#domain)",
+                "ExpressionAttributeNames": {"#domain": "domain"}
+            }})
+            items.append(self.paths_update(x, current))
+        self.transact(items)
+        return keys
+
+    def remove_channel(self, channel):
+        """
+        Delete every item and path of a channel, return the keys of the items
+        """
+        if not channel:
+            raise ValueError("a channel name cannot be empty")
+        everything = self.instances()
+        keys = [x["domain"] for x in in_channel(everything, channel)]
+        if not keys:
+            raise ValueError("no channel {}".format(channel))
+        items = [{"Delete": {
+            "TableName": self.table_name,
+            "Key": serialize({"domain": key})
+        }} for key in keys]
+        for x in in_channel(everything, None):
+            paths = x.get("channel_paths", {})
+            if channel in paths.values():
+                items.append(self.paths_update(x, {k: v for k, v in paths.items() if v != channel}))
+        self.transact(items)
+        return keys
+
+    def watch(self, on_change):
+        """
+        Call on_change(event name, old item, new item) for every change in
+        the stream of the table, following shards as they are split and
+        closed. Never returns.
+        """
+        stream_arn = self.dynamodb.describe_table(TableName=self.table_name)["Table"].get("LatestStreamArn")
+        if not stream_arn:
+            raise RuntimeError("table {} has no stream".format(self.table_name))
+        iterators = {}
+        seen = set()
+        refreshed = None
+        backoff = STREAM_POLL_SECONDS
+        while True:
+            started = time.time()
+            if refreshed is None or time.time() - refreshed > SHARD_REFRESH_SECONDS:
+                for shard in self.shards(stream_arn):
+                    shard_id = shard["ShardId"]
+                    if shard_id in seen:
+                        continue
+                    seen.add(shard_id)
+                    if refreshed is None:
+                        if "EndingSequenceNumber" in shard["SequenceNumberRange"]:
+                            # closed before the watch started
+                            continue
+                        iterator_type = "LATEST"
+                    else:
+                        # shards created while watching are read from their
+                        # start, so no change is lost when a shard is split
+                        iterator_type = "TRIM_HORIZON"
+                    iterators[shard_id] = self.streams.get_shard_iterator(
+                        StreamArn=stream_arn, ShardId=shard_id, ShardIteratorType=iterator_type)["ShardIterator"]
+                refreshed = time.time()
+            throttled = False
+            for shard_id, iterator in list(iterators.items()):
+                try:
+                    response = self.streams.get_records(ShardIterator=iterator)
+                except ClientError as error:
+                    if error.response["Error"]["Code"] not in THROTTLING_ERRORS:
+                        raise
+                    throttled = True
+                    break
+                for record in response["Records"]:
+                    change = record["dynamodb"]
+                    on_change(record["eventName"], deserialize(change.get("OldImage", {})),
+                              deserialize(change.get("NewImage", {})))
+                if response.get("NextShardIterator"):
+                    iterators[shard_id] = response["NextShardIterator"]
+                else:
+                    # the shard is closed, look for its children
+                    del iterators[shard_id]
+                    refreshed = 0
+            backoff = min(backoff * 2, STREAM_MAX_BACKOFF_SECONDS) if throttled else STREAM_POLL_SECONDS
+            time.sleep(max(0, started + backoff - time.time()))
+
+    def shards(self, stream_arn):
+        shards = []
+        kwargs = {"StreamArn": stream_arn}
+        while True:
+            description = self.streams.describe_stream(**kwargs)["StreamDescription"]
+            shards.extend(description["Shards"])
+            if not description.get("LastEvaluatedShardId"):
+                return shards
+            kwargs["ExclusiveStartShardId"] = description["LastEvaluatedShardId"]
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, (set, frozenset)):
+        # playlist names are enough to tell the renditions apart
+        return ",".join(sorted(path.rsplit("/", 1)[-1] for path in value))
+    return str(value)
+
+
+def print_table(instances, out=sys.stdout):
+    rows = [COLUMNS] + [[format_value(x.get(c)) for c in COLUMNS] for x in instances]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        out.write("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + "\n")
+
+
+def print_change(event_name, old, new, out=sys.stdout):
+    item = new or old
+    changes = {c: [format_value(old.get(c)), format_value(new.get(c))]
+               for c in COLUMNS if old.get(c) != new.get(c)}
+    if event_name == "MODIFY" and not changes:
+        # detector sequence and controller bookkeeping only
+        return
+    out.write("{} {} {} {} {}\n".format(time.strftime("%H:%M:%S"), event_name, item.get("name", "-"), item["domain"],
+                                        ", ".join("{} {} -> {}".format(k, v[0], v[1]) for k, v in changes.items())))
+    out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Control the stream instances of a clustered video stream")
+    parser.add_argument("--stream", required=True, help="ClusteredVideoStreamName, the name of the state table")
+    parser.add_argument("--region", help="region of the state table replica to use")
+    parser.add_argument("--json", action="store_true", help="print list output as JSON")
+    parser.add_argument("--channel", help="channel of a multi-tenant table to act on or list")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    commands.add_parser("list", help="show every stream instance")
+    for name, verb in (("open", "open"), ("close", "close")):
+        command = commands.add_parser(name, help="{} stream instances in one transaction".format(verb))
+        command.add_argument("instances", nargs="+")
+        if name == "close":
+            command.add_argument("--force", action="store_true", help="allow closing every stream instance")
+    flip = commands.add_parser("flip", help="close and open stream instances in one transaction")
+    flip.add_argument("--close", nargs="+", default=[], required=True)
+    flip.add_argument("--open", nargs="+", default=[], required=True)
+    drain = commands.add_parser("drain", help="set the drain percent of a stream instance, 0 removes it")
+    drain.add_argument("instance")
+    drain.add_argument("percent", type=float)
+    commands.add_parser("watch", help="show every stream instance, then every change as it happens")
+    for name, verb in (("add-channel", "add an open item for every stream instance to"),
+                       ("remove-channel", "delete every item of")):
+        command = commands.add_parser(name, help="{} a channel in one transaction".format(verb))
+        command.add_argument("channel")
+        if name == "add-channel":
+            command.add_argument("--path", action="append", default=[], metavar="INSTANCE=PATH",
+                                 help="path segment of the channel on an instance, the channel name by default")
+    args = parser.parse_args(argv)
+
+    control = Control(args.stream, args.region)
+    try:
+        if args.command == "list":
+            instances = control.instances()
+            if args.channel is not None:
+                instances = in_channel(instances, args.channel)
+            if args.json:
+                print(json.dumps(instances, default=format_value, indent=2))
+            else:
+                print_table(instances)
+        elif args.command == "open":
+            print("opened {}".format(", ".join(control.set_state(open=args.instances, channel=args.channel)[1])))
+        elif args.command == "close":
+            print("closed {}".format(", ".join(control.set_state(close=args.instances, force=args.force,
+                                                                 channel=args.channel)[0])))
+        elif args.command == "flip":
+            closed, opened = control.set_state(close=args.close, open=args.open, channel=args.channel)
+            print("closed {}, opened {}".format(", ".join(closed), ", ".join(opened)))
+        elif args.command == "drain":
+            percent = int(args.percent) if args.percent == int(args.percent) else args.percent
+            print("{} drain {}%".format(control.drain(args.instance, percent, channel=args.channel), percent))
+        elif args.command == "add-channel":
+            print("added {}".format(", ".join(control.add_channel(args.channel, args.path))))
+        elif args.command == "remove-channel":
+            print("removed {}".format(", ".join(control.remove_channel(args.channel))))
+        elif args.command == "watch":
+            print_table(control.instances())
+            control.watch(print_change)
+    except (ValueError, RuntimeError) as e:
+        print("error: {}".format(e), file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of cvs_control. The DynamoDB and DynamoDB Streams clients are
+# replaced with fakes, no AWS account is needed.
+
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+import cvs_control
+
+
+class Stopped(Exception):
+    pass
+
+
+class FakeDynamoDB:
+    def describe_table(self, TableName):
+        return {"Table": {"LatestStreamArn": "arn:stream"}}
+
+
+class FakeStreams:
+    """
+    One open shard whose reads are throttled the first times they happen
+    """
+
+    def __init__(self, throttled):
+        self.throttled = throttled
+        self.reads = 0
+
+    def describe_stream(self, StreamArn, **kwargs):
+        return {"StreamDescription": {"Shards": [{"ShardId": "shard-1", "SequenceNumberRange": {}}]}}
+
+    def get_shard_iterator(self, **kwargs):
+        return {"ShardIterator": "iterator"}
+
+    def get_records(self, ShardIterator):
+        self.reads += 1
+        if self.reads <= self.throttled:
+            raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "GetRecords")
+        return {"Records": [], "NextShardIterator": "iterator"}
+
+
+def watch(throttled, rounds, monkeypatch):
+    control = cvs_control.Control.__new__(cvs_control.Control)
+    control.table_name = "cvs"
+    control.dynamodb = FakeDynamoDB()
+    control.streams = FakeStreams(throttled)
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        if len(waits) == rounds:
+            raise Stopped()
+    monkeypatch.setattr(cvs_control.time, "sleep", sleep)
+    with pytest.raises(Stopped):
+        control.watch(lambda *change: None)
+    return waits
+
+
+def test_watch_reads_at_most_once_per_second(monkeypatch):
+    waits = watch(0, 5, monkeypatch)
+    assert all(0.9 < x <= cvs_control.STREAM_POLL_SECONDS for x in waits)
+
+
+def test_watch_backs_off_while_throttled(monkeypatch):
+    waits = watch(7, 9, monkeypatch)
+    assert [round(x) for x in waits] == [2, 4, 8, 16, 30, 30, 30, 1, 1]
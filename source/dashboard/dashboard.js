@@ -49,6 +49,8 @@ var init_control_compartment = () => {
                     crossElement: `<i class="material-icons distro-blocked">lock</i>`
                 }
             },
+            { title: "Drain %", align: "center", field: "drain_percent" },
+            { title: "Closed By", align: "center", field: "closed_by" },
             { title: "Last Change", align: "center", field: "updated" },
             { title: "Enable 404 Blocking", align: "center", formatter: enableBlockingIcon, cellClick: clickEnableBlockingIcon },
             { title: "Disable 404 Blocking", align: "center", formatter: disableBlockingIcon, cellClick: clickDisableBlockingIcon }
@@ -98,12 +100,18 @@ var updateBlockingState = function(domain, state) {
     var params = {
         TableName: table_name,
         Key: { "domain": domain },
-        UpdateExpression: 'set #attr = :value',
+        UpdateExpression: 'set #attr = :value remove closed_by',
         ExpressionAttributeNames: { '#attr': 'distro_open' },
         ExpressionAttributeValues: {
             ':value': state
         }
     };
+    if (!state) {
+        // closed_by marks the close as an operator decision, which the
+        // failover controller never reverts
+        params.UpdateExpression = 'set #attr = :value, closed_by = :operator';
+        params.ExpressionAttributeValues[':operator'] = 'operator';
+    }
     documentClient.update(params, function(err, data) {
         if (err) {
             console.log(err, err.stack);
@@ -0,0 +1,348 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Local stand-ins for the parts of a clustered video stream outside AWS
+# Lambda: live HLS origins that can stall or slow down, a stale playlist detector that
+# publishes the same reports as source/stale-playlist-detector, the SNS feed
+# that delivers them, and players that fail over on blocked requests.
+
+import json
+import queue
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+PLAYLIST_PATH = "/out/v1/index.m3u8"
+VARIANT_PATH = "/out/v1/index_{}.m3u8"
+
+
+class FakeOrigin:
+    """
+    Live HLS origin with a master playlist and one variant playlist per
+    rendition. The media sequence advances every segment_duration seconds
+    until the origin is stalled, like an encoder that stops producing
+    segments, and continues from there when it is resumed. A single
+    rendition can be stalled on its own, like one failed encoder output, and
+    segments can be delivered slowly while playlists stay current.
+    """
+
+    def __init__(self, domain, segment_duration=1.0, renditions=2, window=5):
+        self.domain = domain
+        self.segment_duration = segment_duration
+        self.renditions = renditions
+        self.window = window
+        self.epoch = time.monotonic()
+        self.stalled_at = None
+        # rendition -> last media sequence, for renditions stalled on their own
+        self.stalled_renditions = {}
+        # seconds each segment response is delayed
+        self.segment_delay = 0.0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def sequence(self):
+        with self.lock:
+            now = self.stalled_at if self.stalled_at is not None else time.monotonic()
+            return int((now - self.epoch) / self.segment_duration)
+
+    def stall(self):
+        with self.lock:
+            if self.stalled_at is None:
+                self.stalled_at = time.monotonic()
+
+    def resume(self):
+        with self.lock:
+            self.segment_delay = 0.0
+            if self.stalled_at is not None:
+                self.epoch += time.monotonic() - self.stalled_at
+                self.stalled_at = None
+
+    def stall_rendition(self, rendition=1):
+        sequence = self.sequence()
+        with self.lock:
+            self.stalled_renditions.setdefault(rendition, sequence)
+
+    def slow_segments(self, multiplier=2.0):
+        with self.lock:
+            self.segment_delay = self.segment_duration * multiplier
+
+    @property
+    def stalled(self):
+        return self.stalled_at is not None
+
+    def master_playlist(self):
+        lines = ["#EXTM3U"]
+        for rendition in range(1, self.renditions + 1):
+            lines.append("#EXT-X-STREAM-INF:BANDWIDTH={}".format(rendition * 1000000))
+            lines.append("index_{}.m3u8".format(rendition))
+        return "\n".join(lines) + "\n"
+
+    def variant_playlist(self, rendition):
+        last = self.stalled_renditions.get(rendition)
+        if last is None:
+            last = self.sequence()
+        first = max(0, last - self.window + 1)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3",
+                 "#EXT-X-TARGETDURATION:{}".format(max(1, int(round(self.segment_duration)))),
+                 "#EXT-X-MEDIA-SEQUENCE:{}".format(first)]
+        for number in range(first, last + 1):
+            lines.append("#EXTINF:{:.3f},".format(self.segment_duration))
+            lines.append("index_{}_{}.ts".format(rendition, number))
+        return "\n".join(lines) + "\n"
+
+    def respond(self, path):
+        if path == PLAYLIST_PATH:
+            return 200, self.master_playlist()
+        match = re.match(r"^/out/v1/index_(\d+)\.m3u8$", path)
+        if match and 1 <= int(match.group(1)) <= self.renditions:
+            return 200, self.variant_playlist(int(match.group(1)))
+        if re.match(r"^/out/v1/index_\d+_\d+\.ts$", path):
+            return 200, "segment"
+        return 404, "not found"
+
+    def start(self):
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with origin.lock:
+                    origin.requests += 1
+                    delay = origin.segment_delay
+                path = urlparse(self.path).path
+                if delay and path.endswith(".ts"):
+                    time.sleep(delay)
+                status, body = origin.respond(path)
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def http_get(url, timeout=2.0):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as error:
+        return error.code, ""
+
+
+class Detector(threading.Thread):
+    """
+    Stale playlist detector for one origin, following the rules of
+    source/stale-playlist-detector: a variant playlist is stale when it has not
+    changed for duration_multiplier times its shortest segment duration, and
+    the origin is stale when at least stale_tolerance of its variant playlists
+    are. A report is published on every change of the origin's state or of
+    the set of stale playlists.
+    """
+
+    def __init__(self, origin, publish, region, duration_multiplier=1.5, stale_tolerance=0.9):
+        super().__init__(daemon=True)
+        self.origin = origin
+        self.publish = publish
+        self.options = {
+            "cdn_url": "https://{}{}".format(origin.domain, PLAYLIST_PATH),
+            "origin_url": origin.url + PLAYLIST_PATH,
+            "duration_multiplier": duration_multiplier,
+            "name": origin.domain,
+            "region": region,
+            "stale_tolerance": stale_tolerance
+        }
+        self.started = int(time.time() * 1000)
+        self.sequence = 0
+        self.last_notified_state = "fresh"
+        self.last_notified_stale = set()
+        self.stopped = threading.Event()
+
+    def run(self):
+        status, body = http_get(self.options["origin_url"])
+        urls = [self.options["origin_url"].rsplit("/", 1)[0] + "/" + line
+                for line in body.splitlines() if line and not line.startswith("#")]
+        playlists = {url: {"body": None, "changed": time.time(), "duration": 0.0, "state": "fresh"} for url in urls}
+        # the detector samples five times per segment
+        pause = self.origin.segment_duration / 5
+        while not self.stopped.wait(pause):
+            now = time.time()
+            for url, playlist in playlists.items():
+                status, body = http_get(url)
+                durations = [float(x) for x in re.findall(r"#EXTINF:([\d.]+)", body)]
+                if durations:
+                    playlist["duration"] = min(durations)
+                if body != playlist["body"]:
+                    playlist["body"] = body
+                    playlist["changed"] = now
+                    playlist["state"] = "fresh"
+                elif now > playlist["changed"] + playlist["duration"] * self.options["duration_multiplier"]:
+                    playlist["state"] = "stale"
+            self.evaluate(playlists)
+
+    def evaluate(self, playlists):
+        total = len(playlists)
+        stale_playlists = {url for url, x in playlists.items() if x["state"] == "stale"}
+        stale = len(stale_playlists)
+        state = "stale" if stale / float(total) >= self.options["stale_tolerance"] else "fresh"
+        if state == self.last_notified_state and stale_playlists == self.last_notified_stale:
+            return
+        report = {
+            "options": self.options,
+            "playlists": {url: {"state": x["state"], "changed": int(x["changed"]), "duration": x["duration"]}
+                          for url, x in playlists.items()},
+            "detector": {
+                "total": total,
+                "fresh": total - stale,
+                "stale": stale,
+                "stale_playlist_percent": stale * 100.0 / total,
+                "stale_tolerance_percent": self.options["stale_tolerance"] * 100,
+                "started": self.started,
+                "state": state,
+                "sequence": self.sequence
+            }
+        }
+        self.sequence += 1
+        self.last_notified_state = state
+        self.last_notified_stale = stale_playlists
+        self.publish(report)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Feed(threading.Thread):
+    """
+    Delivers detector reports to a handler the way SNS invokes a Lambda
+    function, one record per invocation after delivery_delay seconds
+    """
+
+    def __init__(self, invoke, delivery_delay=0.05):
+        super().__init__(daemon=True)
+        self.invoke = invoke
+        self.delivery_delay = delivery_delay
+        self.queue = queue.Queue()
+
+    def publish(self, report):
+        self.queue.put((time.monotonic() + self.delivery_delay, report))
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            deliver_at, report = entry
+            pause = deliver_at - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            self.invoke({"Records": [{
+                "EventSource": "aws:sns",
+                "Sns": {"Message": json.dumps(report)}
+            }]})
+
+    def stop(self):
+        self.queue.put(None)
+
+
+def origin_request_event(domain, uri):
+    """
+    Build the CloudFront origin-request event the copilot receives
+    """
+    return {
+        "Records": [{
+            "cf": {
+                "config": {
+                    "distributionDomainName": domain,
+                    "distributionId": "EDFDVBD6EXAMPLE",
+                    "eventType": "origin-request",
+                    "requestId": "simulated"
+                },
+                "request": {
+                    "clientIp": "203.0.113.178",
+                    "headers": {"host": [{"key": "Host", "value": domain}]},
+                    "method": "GET",
+                    "querystring": "",
+                    "uri": uri
+                }
+            }
+        }]
+    }
+
+
+class Player(threading.Thread):
+    """
+    Viewer that reloads a variant playlist about twice per segment through an
+    edge running the copilot. On a 404 it tries the other renditions of the
+    stream instance, like an ABR player, and then switches to the next stream
+    instance of the master playlist. A redirect is followed, and any other
+    request goes to the origin of the stream instance.
+    """
+
+    def __init__(self, number, edge, origins, first, record, rng):
+        super().__init__(daemon=True)
+        self.number = number
+        self.edge = edge
+        self.origins = origins
+        self.current = first
+        self.rendition = 1
+        self.record = record
+        self.rng = rng
+        self.stopped = threading.Event()
+
+    def request(self, domain, uri):
+        response = self.edge.origin_request(origin_request_event(domain, uri), None)
+        if "status" not in response:
+            return domain, http_get(self.origins[domain].url + uri)[0]
+        status = int(response["status"])
+        if status == 302:
+            location = urlparse(response["headers"]["location"][0]["value"])
+            if location.netloc in self.origins:
+                return location.netloc, http_get(self.origins[location.netloc].url + location.path)[0]
+        return domain, status
+
+    def run(self):
+        domains = list(self.origins)
+        segment_duration = self.origins[domains[0]].segment_duration
+        renditions = self.origins[domains[0]].renditions
+        while not self.stopped.wait(segment_duration / 2 * self.rng.uniform(0.8, 1.2)):
+            # the current rendition first, then the others of this instance
+            order = [self.rendition] + [r for r in range(1, renditions + 1) if r != self.rendition]
+            for rendition in order:
+                domain, status = self.request(self.current, VARIANT_PATH.format(rendition))
+                self.record(self.number, self.current, domain, status, rendition)
+                if status == 200:
+                    self.current = domain
+                    self.rendition = rendition
+                    break
+            else:
+                # players move down the master playlist on errors
+                self.current = domains[(domains.index(self.current) + 1) % len(domains)]
+
+    def stop(self):
+        self.stopped.set()
+
+
+def make_rng(seed, *keys):
+    return random.Random("{}:{}".format(seed, ":".join(str(x) for x in keys)))
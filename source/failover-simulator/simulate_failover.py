@@ -0,0 +1,403 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Local end-to-end failover simulator.
+#
+# Runs a clustered video stream on one machine: fake HLS origins, a stale
+# playlist detector and a segment health check per origin publishing reports
+# through an SNS-like feed to
+# the real PlaylistAlertHandler (with automatic failover), the real copilot
+# in every simulated edge location, and synthetic players. The state table is
+# the LocalDynamoDB stand-in from the copilot benchmark.
+#
+# Each scenario stalls and resumes origins on a fixed schedule and reports,
+# in seconds after the stall:
+#
+#   detection_s       the detector publishes a stale report
+#   state_s           the handler marks the playlist stale in the state table
+#   flip_s            the stream instance is closed in the state table
+#   first_viewer_s    the first affected player gets a playlist from another
+#                     stream instance
+#   viewer_p50/p95/max_s  the same for every affected player
+#
+# and, when the origin resumes, fresh_s and reopen_s after the resume.
+#
+# In stall-rendition only one rendition stalls. detection_s and state_s are
+# then the stale playlist being reported and stored in stale_renditions,
+# rendition_blocked_s is the first 404 for that rendition, and the viewer
+# times are players reaching another rendition, viewers_in_region of them on
+# the same stream instance.
+#
+# In slow-segments the playlists stay current but segments take twice their
+# duration to download. detection_s and state_s are then the segment health
+# check reporting degraded and segments_healthy changing, and fresh_s is
+# segments_healthy changing back after the resume.
+#
+# Usage (from source/failover-simulator):
+#   python simulate_failover.py
+#   python simulate_failover.py --scenario stall-primary --repeat 3 --output report.json
+#   python simulate_failover.py --config blocked_response=redirect --config cache_ttl_seconds=1
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SIMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(SIMULATOR_DIR)
+sys.path.insert(0, os.path.join(SOURCE_DIR, "copilot", "benchmark"))
+# the copilot imports state_reader from its own directory
+sys.path.insert(0, os.path.join(SOURCE_DIR, "copilot"))
+sys.path.insert(0, os.path.join(SOURCE_DIR, "segment-health-check"))
+
+from local_dynamodb import LocalDynamoDB  # noqa: E402
+from fake_hls import Detector, FakeOrigin, Feed, Player, PLAYLIST_PATH, make_rng  # noqa: E402
+from segment_health_check import SegmentHealthCheck  # noqa: E402
+
+TABLE_NAME = "cvs-simulator"
+REGIONS = ["us-west-2", "eu-west-1", "ap-northeast-1", "sa-east-1"]
+
+# times are in segments, so scenarios keep their shape at any segment duration
+SCENARIOS = {
+    "stall-primary": {
+        "description": "the first of two origins stalls",
+        "origins": 2,
+        "events": [(3, "stall", 0)],
+        "duration": 14
+    },
+    "stall-three-regions": {
+        "description": "the second of three origins stalls",
+        "origins": 3,
+        "events": [(3, "stall", 1)],
+        "duration": 14
+    },
+    "stall-and-recover": {
+        "description": "the first origin stalls and resumes, and is reopened",
+        "origins": 2,
+        "events": [(3, "stall", 0), (11, "resume", 0)],
+        "duration": 20
+    },
+    "stall-rendition": {
+        "description": "one rendition of the first origin stalls, its viewers stay in the region",
+        "origins": 2,
+        "events": [(3, "stall_rendition", 0)],
+        "duration": 12
+    },
+    "slow-segments": {
+        "description": "the first origin delivers segments slowly, and recovers",
+        "origins": 2,
+        "events": [(3, "slow_segments", 0), (14, "resume", 0)],
+        "duration": 30
+    },
+    "all-stalled": {
+        "description": "every origin stalls, one stream instance always stays open",
+        "origins": 2,
+        "events": [(3, "stall", 0), (3, "stall", 1)],
+        "duration": 12
+    }
+}
+
+METRICS = ["detection_s", "state_s", "flip_s", "first_viewer_s", "viewer_p50_s", "viewer_p95_s",
+           "viewer_max_s", "fresh_s", "reopen_s", "rendition_blocked_s"]
+
+# the rendition stalled by stall_rendition
+STALLED_RENDITION = 1
+
+
+class Timeline:
+    """
+    Time-stamped events of a run, in seconds since it started
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, kind, **detail):
+        with self.lock:
+            self.events.append(dict(detail, kind=kind, at=time.monotonic() - self.start))
+
+    def first(self, kind, after, **match):
+        with self.lock:
+            for event in self.events:
+                if event["kind"] == kind and event["at"] >= after and \
+                        all(event.get(k) == v for k, v in match.items()):
+                    return event["at"]
+        return None
+
+
+def load_module(path, name):
+    """
+    Import a fresh copy of a module, as a new Lambda container would
+    """
+    spec = importlib.util.spec_from_file_location("{}_{}".format(name, time.monotonic_ns()), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def since(value, origin):
+    return None if value is None else round(value - origin, 3)
+
+
+def run_scenario(name, scenario, args, seed):
+    segment = args.segment_duration
+    timeline = Timeline()
+    stand_in = LocalDynamoDB(latency_ms=args.table_latency_ms, seed=seed)
+    stand_in.create_table(TABLE_NAME)
+
+    def on_write(table, old, new):
+        old, new = old or {}, new or {}
+        for attribute in ("playlist_fresh", "distro_open", "stale_renditions", "segments_healthy"):
+            if new.get(attribute) is not None and old.get(attribute) != new.get(attribute):
+                timeline.add(attribute, domain=new["domain"], value=new[attribute])
+    stand_in.listeners.append(on_write)
+
+    origins = {}
+    for n in range(scenario["origins"]):
+        origin = FakeOrigin("d{}.cloudfront.sim".format(n), segment_duration=segment, renditions=args.renditions)
+        origin.start()
+        origins[origin.domain] = origin
+        stand_in.put(TABLE_NAME, {"domain": origin.domain, "name": "({}) Region {}".format(n + 1, n + 1),
+                                  "region": REGIONS[n % len(REGIONS)], "distro_open": True})
+    domains = list(origins)
+    endpoint_url = stand_in.start()
+
+    config_path = os.path.join(tempfile.mkdtemp(prefix="cvs-simulator-"), "copilot_config.json")
+    config = {
+        "table_name": TABLE_NAME,
+        "stream_instances": [{"domain": d, "region": REGIONS[n % len(REGIONS)]} for n, d in enumerate(domains)],
+        "endpoint_url": endpoint_url
+    }
+    config.update(dict(item.split("=", 1) for item in args.config))
+    with open(config_path, "w") as config_file:
+        json.dump(config, config_file)
+    os.environ.update({
+        "COPILOT_CONFIG": config_path,
+        "PlaylistStateTable": TABLE_NAME,
+        "AutomaticFailover": "true",
+        "ReopenAfterSeconds": str(args.reopen_after),
+        # the handler creates its client without an endpoint, this points it
+        # at the stand-in
+        "AWS_ENDPOINT_URL_DYNAMODB": endpoint_url
+    })
+
+    handler = load_module(os.path.join(SOURCE_DIR, "playlist-alert-handler", "playlist-alert-handler.py"),
+                          "playlist_alert_handler")
+    edges = [load_module(os.path.join(SOURCE_DIR, "copilot", "copilot.py"), "copilot") for _ in range(args.edges)]
+
+    # one invocation at a time, so runs with the same seed make the same decisions
+    invoke_lock = threading.Lock()
+    invocations = []
+
+    def invoke(event):
+        with invoke_lock:
+            invocations.append(event)
+            handler.handler(event, None)
+
+    feed = Feed(invoke, delivery_delay=args.delivery_delay)
+
+    def publish(report):
+        timeline.add("report", domain=report["options"]["cdn_url"].split("/")[2], state=report["detector"]["state"],
+                     stale=report["detector"]["stale"], source=report["detector"].get("source", "playlist"))
+        feed.publish(report)
+
+    detectors = [Detector(origins[d], publish, REGIONS[n % len(REGIONS)]) for n, d in enumerate(domains)]
+    # windows and thresholds scaled to the segment duration
+    detectors += [SegmentHealthCheck({
+        "cdn_url": "https://{}{}".format(d, PLAYLIST_PATH),
+        "origin_url": origins[d].url + PLAYLIST_PATH,
+        "sample_url": origins[d].url + PLAYLIST_PATH,
+        "name": d,
+        "region": REGIONS[n % len(REGIONS)],
+        "window_seconds": 4 * segment,
+        "sample_interval": segment / 2,
+        "min_samples": 4,
+        "timeout": 4 * segment,
+        "max_ttfb_ms": 500 * segment,
+        "min_speed": 1.5,
+        "max_error_rate": 0.05,
+        "degraded_after": 2,
+        "healthy_after": 3
+    }, publish) for n, d in enumerate(domains)]
+
+    def record(number, tried, domain, status, rendition):
+        timeline.add("request", player=number, tried=tried, domain=domain, status=status, rendition=rendition)
+
+    players = []
+    for n in range(args.players):
+        rng = make_rng(seed, name, "player", n)
+        # viewers are spread over the stream instances
+        players.append(Player(n, edges[n % len(edges)], origins, domains[n % len(domains)], record, rng))
+
+    schedule_stop = threading.Event()
+
+    def schedule():
+        # the one minute schedule, scaled to the segment duration
+        while not schedule_stop.wait(args.schedule_segments * segment):
+            invoke({})
+
+    threads = [feed] + detectors + players + [threading.Thread(target=schedule, daemon=True)]
+    try:
+        for thread in threads:
+            thread.start()
+        for at, action, index in sorted(scenario["events"]):
+            pause = at * segment - (time.monotonic() - timeline.start)
+            if pause > 0:
+                time.sleep(pause)
+            getattr(origins[domains[index]], action)()
+            timeline.add(action, domain=domains[index])
+        pause = scenario["duration"] * segment - (time.monotonic() - timeline.start)
+        if pause > 0:
+            time.sleep(pause)
+    finally:
+        schedule_stop.set()
+        for thread in players + detectors + [feed]:
+            thread.stop()
+        for thread in players:
+            thread.join()
+        stand_in.stop()
+        for origin in origins.values():
+            origin.stop()
+
+    return analyse(name, scenario, timeline, stand_in, domains, invocations)
+
+
+def analyse(name, scenario, timeline, stand_in, domains, invocations):
+    report = {"scenario": name, "description": scenario["description"]}
+    stalls = [e for e in timeline.events if e["kind"] in ("stall", "stall_rendition", "slow_segments")]
+    stall = stalls[0]
+    domain, t0 = stall["domain"], stall["at"]
+    # with a single stalled rendition, the stream instance stays usable
+    rendition = STALLED_RENDITION if stall["kind"] == "stall_rendition" else None
+    stalled = {e["domain"] for e in stalls if e["kind"] != "stall_rendition"}
+    report["stalled"] = domain
+    # the attribute and report source that tell the stream instance is unhealthy
+    if stall["kind"] == "slow_segments":
+        health, source = "segments_healthy", "segment-health"
+    else:
+        health, source = "playlist_fresh", "playlist"
+    if rendition is None:
+        report["detection_s"] = since(timeline.first("report", t0, domain=domain, state="stale", source=source), t0)
+        report["state_s"] = since(timeline.first(health, t0, domain=domain, value=False), t0)
+    else:
+        report["detection_s"] = since(timeline.first("report", t0, domain=domain, stale=1, source=source), t0)
+        report["state_s"] = since(timeline.first("stale_renditions", t0, domain=domain), t0)
+    report["flip_s"] = since(timeline.first("distro_open", t0, domain=domain, value=False), t0)
+
+    # players on the stalled stream instance, or rendition, when it stalled
+    requests = [e for e in timeline.events if e["kind"] == "request"]
+    current = {}
+    for event in requests:
+        if event["at"] < t0 and event["status"] == 200:
+            current[event["player"]] = (event["domain"], event["rendition"])
+    affected = [player for player, (d, r) in current.items() if d == domain and rendition in (None, r)]
+    recovered = []
+    in_region = 0
+    for player in affected:
+        for event in requests:
+            if event["player"] == player and event["at"] >= t0 and event["status"] == 200 and \
+                    event["domain"] not in stalled and (event["domain"], event["rendition"]) != (domain, rendition):
+                recovered.append(event["at"] - t0)
+                in_region += event["domain"] == domain
+                break
+    recovered.sort()
+    report["viewers_affected"] = len(affected)
+    report["viewers_recovered"] = len(recovered)
+    if rendition is not None:
+        report["viewers_in_region"] = in_region
+        report["rendition_blocked_s"] = since(
+            timeline.first("request", t0, domain=domain, rendition=rendition, status=404), t0)
+    report["first_viewer_s"] = round(recovered[0], 3) if recovered else None
+    report["viewer_p50_s"] = round(recovered[len(recovered) // 2], 3) if recovered else None
+    report["viewer_p95_s"] = round(recovered[min(len(recovered) - 1, int(len(recovered) * 0.95))], 3) \
+        if recovered else None
+    report["viewer_max_s"] = round(recovered[-1], 3) if recovered else None
+    report["blocked_requests"] = sum(1 for e in requests if e["status"] == 404)
+
+    resumes = [e for e in timeline.events if e["kind"] == "resume" and e["domain"] == domain]
+    if resumes:
+        t1 = resumes[0]["at"]
+        report["fresh_s"] = since(timeline.first(health, t1, domain=domain, value=True), t1)
+        report["reopen_s"] = since(timeline.first("distro_open", t1, domain=domain, value=True), t1)
+
+    report["closed_at_end"] = sorted(x["domain"] for x in stand_in.items(TABLE_NAME) if x.get("distro_open") is False)
+    report["handler_invocations"] = len(invocations)
+    report["table_calls"] = dict(stand_in.calls)
+    return report
+
+
+def summarize(reports):
+    """
+    Median of every metric over repeated runs of a scenario
+    """
+    summary = {"scenario": reports[0]["scenario"], "runs": len(reports)}
+    for metric in METRICS:
+        values = [r[metric] for r in reports if r.get(metric) is not None]
+        if values:
+            summary[metric] = round(statistics.median(values), 3)
+        elif any(metric in r for r in reports):
+            summary[metric] = None
+    summary["viewers_affected"] = sum(r["viewers_affected"] for r in reports)
+    summary["viewers_recovered"] = sum(r["viewers_recovered"] for r in reports)
+    summary["closed_at_end"] = reports[-1]["closed_at_end"]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate failover of a clustered video stream locally")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run, repeat for several, all by default")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario, with different seeds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--segment-duration", type=float, default=1.0, help="seconds per segment")
+    parser.add_argument("--renditions", type=int, default=2, help="variant playlists per origin")
+    parser.add_argument("--players", type=int, default=20, help="synthetic viewers")
+    parser.add_argument("--edges", type=int, default=2, help="edge locations, each with its own copilot")
+    parser.add_argument("--delivery-delay", type=float, default=0.05, help="seconds from report to handler")
+    parser.add_argument("--table-latency-ms", type=float, default=5, help="state table latency per call")
+    parser.add_argument("--reopen-after", type=int, default=2, help="ReopenAfterSeconds of the handler")
+    parser.add_argument("--schedule-segments", type=float, default=2,
+                        help="segments between scheduled handler invocations")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a copilot_config.json setting")
+    parser.add_argument("--log", default=os.devnull, help="file for the output of the handler and copilot")
+    parser.add_argument("--output", help="write the reports as JSON to this file")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "simulator")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "simulator")
+
+    results = {"settings": vars(args), "scenarios": []}
+    out = sys.stdout
+    with open(args.log, "a") as log:
+        for name in args.scenario or list(SCENARIOS):
+            reports = []
+            for run in range(args.repeat):
+                # the handler and copilot print every event, keep it out of the report
+                sys.stdout = log
+                try:
+                    reports.append(run_scenario(name, SCENARIOS[name], args, args.seed + run))
+                finally:
+                    sys.stdout = out
+                print(json.dumps(reports[-1]))
+            entry = {"runs": reports}
+            if args.repeat > 1:
+                entry["summary"] = summarize(reports)
+                print(json.dumps(entry["summary"]))
+            results["scenarios"].append(entry)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Handle stale playlist detector reports by updating the state of the stream
+# instance in the state table.
+#
+# With AutomaticFailover enabled this function is also the failover
+# controller. It closes a stale stream instance when at least one other
+# instance is open and fresh, and reopens instances it closed once they have
+# been fresh for ReopenAfterSeconds. It never closes the last open instance,
+# and it only reopens instances it closed itself, never ones closed by an
+# operator. A schedule invokes it every minute so decisions that depend on
+# time or on other instances are made without waiting for a report.
+#
+# While a stream instance is fresh, the paths of its stale variant playlists
+# are kept in stale_renditions, and the copilot returns 404 for those
+# renditions only. Players then switch to a healthy rendition in the same
+# region. Once the instance is stale as a whole, stale_renditions is removed
+# and the instance is failed over instead.
+#
+# With ChannelPathSegment above 0 the table holds many channels. A report is
+# written to "<channel>#<domain>", with the channel id looked up like the
+# copilot does: the path segment of cdn_url in channel_paths of the item of
+# the domain. Failover decisions only compare the stream instances with the
+# same channel attribute, so a channel can have a different path in every
+# region.
+#
+# The paths of the playlists in each report are kept in playlist_paths, for
+# the playlist invalidator.
+#
+# Reports of the segment health check (detector.source "segment-health") are
+# kept in segments_healthy, apart from the stale playlist reports in
+# playlist_fresh, and each kind is ordered on its own. An instance is healthy
+# for failover only while both are, so slow or failing segment delivery
+# fails a region over like stale playlists do.
+
+import json
+import boto3
+import os
+import posixpath
+import time
+from urllib.parse import urlparse
+
+tablename = os.environ['PlaylistStateTable']
+automatic_failover = os.environ.get('AutomaticFailover', 'false') == 'true'
+reopen_after = int(os.environ.get('ReopenAfterSeconds', '60'))
+channel_segment = int(os.environ.get('ChannelPathSegment', '0'))
+
+dynamodb = boto3.resource('dynamodb')
+table = dynamodb.Table(tablename)
+ConditionalCheckFailed = dynamodb.meta.client.exceptions.ConditionalCheckFailedException
+TransactionCanceled = dynamodb.meta.client.exceptions.TransactionCanceledException
+
+CONTROLLER = "controller"
+
+SEGMENT_HEALTH = "segment-health"
+
+
+def state_key(parsed):
+    """
+    Return the state table key of a cdn_url, using the same rule as the
+    copilot: the directory at ChannelPathSegment of the path is a channel if
+    channel_paths of the domain maps it to one
+    """
+    segments = parsed.path.split("/")
+    if 0 < channel_segment < len(segments) - 1:
+        item = table.get_item(Key={"domain": parsed.netloc}, ProjectionExpression="channel_paths",
+                              ConsistentRead=True).get("Item", {})
+        channel = item.get("channel_paths", {}).get(segments[channel_segment])
+        if channel:
+            return "{}#{}".format(channel, parsed.netloc)
+    return parsed.netloc
+
+
+def channel_of(instance):
+    # items written before the channel attribute existed carry it in the key
+    key = instance["domain"]
+    return instance.get("channel") or (key.rsplit("#", 1)[0] if "#" in key else "")
+
+
+def source_of(item):
+    return item["detector"].get("source", "playlist")
+
+
+def order(item):
+    # sequence restarts at zero when a detector restarts, started orders the runs
+    return (item["detector"].get("started", 0), item["detector"].get("sequence", -1))
+
+
+def cdn_playlists(item):
+    """
+    Return the path of each variant playlist of a report as the CDN serves
+    it, with the playlist's report. The detector reads playlists from the
+    origin, so each path is moved from the directory of origin_url to the
+    directory of cdn_url.
+    """
+    origin_dir = posixpath.dirname(urlparse(item["options"]["origin_url"]).path) or "/"
+    cdn_dir = posixpath.dirname(urlparse(item["options"]["cdn_url"]).path) or "/"
+    playlists = {}
+    for url, playlist in item.get("playlists", {}).items():
+        relative = posixpath.relpath(urlparse(url).path, origin_dir)
+        playlists[posixpath.normpath(posixpath.join(cdn_dir, relative))] = playlist
+    return playlists
+
+
+def stale_renditions(item):
+    """
+    Return the paths of the stale variant playlists of a report as the CDN
+    serves them
+    """
+    return {path for path, playlist in cdn_playlists(item).items() if playlist.get("state") == "stale"}
+
+
+def playlist_paths(item):
+    """
+    Return the paths of the playlist of a report and of its variant
+    playlists as the CDN serves them, which are the paths the playlist
+    invalidator invalidates
+    """
+    return {urlparse(item["options"]["cdn_url"]).path} | set(cdn_playlists(item))
+
+
+def write_report(domain, item, updates, removes, values, started, sequence):
+    if "started" not in item["detector"] or "sequence" not in item["detector"]:
+        # reports from older detectors cannot be ordered
+        return table.update_item(
+            Key={"domain": domain},
+            UpdateExpression="set {} remove {}".format(", ".join(updates), ", ".join(removes)),
+            ExpressionAttributeValues=values)
+    # only write a report newer than the one already stored for the domain
+    values[':st'] = item["detector"]["started"]
+    values[':sq'] = item["detector"]["sequence"]
+    updates += ["{} = :st".format(started), "{} = :sq".format(sequence)]
+    return table.update_item(
+        Key={"domain": domain},
+        UpdateExpression="set {} remove {}".format(", ".join(updates), ", ".join(removes)),
+        ConditionExpression="attribute_not_exists({started}) OR {started} < :st OR "
+                            "({started} = :st AND {sequence} < :sq)".format(started=started, sequence=sequence),
+        ExpressionAttributeValues=values)
+
+
+def update_segment_health(domain, item, now):
+    segments_healthy = (item["detector"]["state"] == 'fresh')
+    values = {':sh': segments_healthy, ':now': now}
+    updates = ["segments_healthy = :sh"]
+    if segments_healthy:
+        updates.append("segments_healthy_since = if_not_exists(segments_healthy_since, :now)")
+        removes = ["segments_degraded_since"]
+    else:
+        updates.append("segments_degraded_since = if_not_exists(segments_degraded_since, :now)")
+        removes = ["segments_healthy_since"]
+    return write_report(domain, item, updates, removes, values, "segment_check_started", "segment_check_sequence")
+
+
+def update_state(domain, item, now):
+    if source_of(item) == SEGMENT_HEALTH:
+        return update_segment_health(domain, item, now)
+    playlist_fresh = (item["detector"]["state"] == 'fresh')
+    values = {':pf': playlist_fresh}
+    values[':now'] = now
+    values[':pp'] = playlist_paths(item)
+    updates = ["playlist_fresh = :pf", "playlist_paths = :pp"]
+    # fresh_since and stale_since are when the current period began, used for
+    # reopening and for the failover metrics
+    if playlist_fresh:
+        updates.append("fresh_since = if_not_exists(fresh_since, :now)")
+        removes = ["stale_since"]
+    else:
+        updates.append("stale_since = if_not_exists(stale_since, :now)")
+        removes = ["fresh_since"]
+    # a stale instance is failed over as a whole, so renditions are only
+    # blocked while the instance is fresh. Empty sets cannot be stored.
+    renditions = stale_renditions(item) if playlist_fresh else set()
+    if renditions:
+        updates.append("stale_renditions = :sr")
+        values[':sr'] = renditions
+    else:
+        removes.append("stale_renditions")
+    return write_report(domain, item, updates, removes, values, "detector_started", "detector_sequence")
+
+
+def is_open(instance):
+    return instance.get("distro_open", True)
+
+
+def is_fresh(instance):
+    # instances without a report yet are assumed fresh, and instances
+    # without a segment health check deliver segments well
+    return instance.get("playlist_fresh", True) and instance.get("segments_healthy", True)
+
+
+def fresh_since(instance, now):
+    """
+    Return when the instance became fresh, the later of its playlists and
+    its segment delivery recovering, or now if nothing has been reported
+    """
+    times = []
+    if "playlist_fresh" in instance:
+        times.append(int(instance.get("fresh_since", now)))
+    if "segments_healthy" in instance:
+        times.append(int(instance.get("segments_healthy_since", now)))
+    return max(times) if times else now
+
+
+def unhealthy(instance):
+    if not instance.get("playlist_fresh", True):
+        return "stale"
+    return "segment delivery degraded"
+
+
+# condition of an update or check that the item is fresh in the table
+FRESH_CONDITION = ("(attribute_not_exists(playlist_fresh) OR playlist_fresh = :true) AND "
+                   "(attribute_not_exists(segments_healthy) OR segments_healthy = :true)")
+
+
+def get_instances():
+    """
+    Read every stream instance from the state table with strongly consistent reads
+    """
+    instances = []
+    response = table.scan(ConsistentRead=True)
+    instances.extend(response["Items"])
+    while "LastEvaluatedKey" in response:
+        response = table.scan(ConsistentRead=True, ExclusiveStartKey=response["LastEvaluatedKey"])
+        instances.extend(response["Items"])
+    return instances
+
+
+def record_decision(domain, action, reason, now):
+    """
+    Log an automatic decision. Close and reopen decisions are also kept on the
+    stream instance by the update that applies them.
+    """
+    print(json.dumps({"controller": action, "domain": domain, "reason": reason, "time": now}))
+
+
+def close_if_stale(instance, instances, now):
+    domain = instance["domain"]
+    if not is_open(instance) or is_fresh(instance):
+        return
+    # only instances of the same channel can take over
+    healthy = [x for x in instances if x["domain"] != domain and channel_of(x) == channel_of(instance) and
+               is_open(x) and is_fresh(x)]
+    if not healthy:
+        record_decision(domain, "hold", "no other stream instance is open and fresh", now)
+        return
+    reason = "{} while {} is fresh".format(unhealthy(instance), healthy[0]["domain"])
+    # close only if the healthy instance is still open and fresh in this replica.
+    # The client of the resource serializes plain values like the table does.
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=[{
+            "Update": {
+                "TableName": tablename,
+                "Key": {"domain": domain},
+                "UpdateExpression": "set distro_open = :false, closed_by = :controller, "
+                                    "controller_action = :action, controller_reason = :reason, "
+                                    "controller_updated = :now",
+                "ConditionExpression": "(attribute_not_exists(distro_open) OR distro_open = :true) "
+                                       "AND (playlist_fresh = :false OR segments_healthy = :false)",
+                "ExpressionAttributeValues": {
+                    ":true": True,
+                    ":false": False,
+                    ":controller": CONTROLLER,
+                    ":action": "close",
+                    ":reason": reason,
+                    ":now": now
+                }
+            }
+        }, {
+            "ConditionCheck": {
+                "TableName": tablename,
+                "Key": {"domain": healthy[0]["domain"]},
+                "ConditionExpression": "(attribute_not_exists(distro_open) OR distro_open = :true) "
+                                       "AND " + FRESH_CONDITION,
+                "ExpressionAttributeValues": {
+                    ":true": True
+                }
+            }
+        }])
+    except TransactionCanceled:
+        record_decision(domain, "hold", "state changed while closing", now)
+        return
+    # later decisions in this run see the instance as closed
+    instance["distro_open"] = False
+    instance["closed_by"] = CONTROLLER
+    record_decision(domain, "close", reason, now)
+
+
+def reopen_recovered(instances, now):
+    """
+    Reopen instances closed by the controller that have been fresh for
+    reopen_after seconds. If no instance of a channel is open at all, for
+    example after regions closed each other before replication caught up,
+    reopen every instance of the channel the controller closed.
+    """
+    open_channels = {channel_of(x) for x in instances if is_open(x)}
+    for instance in instances:
+        if is_open(instance) or instance.get("closed_by") != CONTROLLER:
+            continue
+        if channel_of(instance) not in open_channels:
+            reason = "no stream instance is open"
+            condition = "closed_by = :controller"
+            values = {':controller': CONTROLLER}
+        elif is_fresh(instance) and now - fresh_since(instance, now) >= reopen_after:
+            reason = "fresh for {} seconds".format(reopen_after)
+            condition = "closed_by = :controller AND " + FRESH_CONDITION
+            values = {':controller': CONTROLLER, ':true': True}
+        else:
+            continue
+        values.update({':open': True, ':action': "reopen", ':reason': reason, ':now': now})
+        try:
+            table.update_item(
+                Key={"domain": instance["domain"]},
+                UpdateExpression="set distro_open = :open, controller_action = :action, "
+                                 "controller_reason = :reason, controller_updated = :now remove closed_by",
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values)
+        except ConditionalCheckFailed:
+            continue
+        instance["distro_open"] = True
+        instance.pop("closed_by")
+        record_decision(instance["domain"], "reopen", reason, now)
+
+
+def control(now):
+    """
+    Apply the failover rules to every stream instance, so an instance that
+    stayed stale is closed once another one recovers
+    """
+    instances = get_instances()
+    # reopen first, so a recovered instance can take over from a stale one
+    reopen_recovered(instances, now)
+    for instance in instances:
+        close_if_stale(instance, instances, now)
+
+
+def handler(event, context):
+    print(json.dumps(event))
+    now = int(time.time())
+    records = event.get("Records", [])
+    # keep only the newest report per domain and source, so a burst is one
+    # write for each
+    latest = {}
+    # reports whose state table key could not be looked up. They fail the
+    # invocation once the other reports are written, so the failure shows in
+    # the Lambda Errors metric and SNS retries the delivery.
+    failed = []
+    for record in records:
+        try:
+            item = json.loads(record["Sns"]["Message"])
+            cdn_url = urlparse(item["options"]["cdn_url"])
+            source = source_of(item)
+        except Exception as exception:
+            # a malformed report is never going to succeed, so it is skipped
+            print(json.dumps({"skipped": record.get("Sns", {}).get("MessageId"), "error": repr(exception)}))
+            continue
+        try:
+            key = (state_key(cdn_url), source)
+        except Exception as exception:
+            print(json.dumps({"failed": cdn_url.geturl(), "error": repr(exception)}))
+            failed.append(exception)
+            continue
+        if key not in latest or order(item) > order(latest[key]):
+            latest[key] = item
+    for (domain, source), item in latest.items():
+        try:
+            response = update_state(domain, item, now)
+            print(json.dumps(response))
+        except ConditionalCheckFailed:
+            print("ignoring out of order {} report {} for {}".format(source, order(item), domain))
+        except Exception as exception:
+            print(exception)
+    # scheduled invocations have no records and only apply the failover rules
+    if automatic_failover:
+        try:
+            control(now)
+        except Exception as exception:
+            print(exception)
+    if failed:
+        raise RuntimeError("{} of {} reports could not be matched to a state table item: {!r}".format(
+            len(failed), len(records), failed[0]))
+    return True
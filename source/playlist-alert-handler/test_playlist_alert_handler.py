@@ -0,0 +1,166 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the PlaylistAlertHandler and its failover controller. The
+# state table is the local stand-in of the copilot benchmark, so conditional
+# writes and transactions behave like DynamoDB without an AWS account.
+
+import importlib.util
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "copilot", "benchmark"))
+
+from local_dynamodb import LocalDynamoDB
+
+D0 = "d0.cloudfront.net"
+D1 = "d1.cloudfront.net"
+
+
+@pytest.fixture(scope="module")
+def database():
+    db = LocalDynamoDB()
+    url = db.start()
+    yield db, url
+    db.stop()
+
+
+@pytest.fixture
+def load_handler(database, monkeypatch):
+    db, url = database
+
+    def load(items, **settings):
+        name = "cvs-" + uuid.uuid4().hex
+        db.create_table(name)
+        for item in items:
+            db.put(name, item)
+        environment = {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test",
+                       "AWS_DEFAULT_REGION": "us-west-2", "AWS_ENDPOINT_URL_DYNAMODB": url,
+                       "PlaylistStateTable": name, "AutomaticFailover": "true", "ReopenAfterSeconds": "0"}
+        environment.update(settings)
+        for key, value in environment.items():
+            monkeypatch.setenv(key, value)
+        spec = importlib.util.spec_from_file_location(
+            "playlist_alert_handler", os.path.join(HERE, "playlist-alert-handler.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module, lambda: {x["domain"]: x for x in db.items(name)}
+    return load
+
+
+def report(domain, state, sequence, path="/out/v1/index.m3u8", source=None, playlists=None):
+    detector = {"state": state, "started": 1, "sequence": sequence}
+    if source:
+        detector["source"] = source
+    return {"Sns": {"Message": json.dumps({
+        "options": {"cdn_url": "https://{}{}".format(domain, path), "origin_url": "https://origin{}".format(path)},
+        "playlists": playlists or {},
+        "detector": detector
+    })}}
+
+
+def test_stale_instance_is_closed_while_another_is_fresh(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}, {"domain": D1, "distro_open": True}])
+    handler.handler({"Records": [report(D0, "stale", 1)]}, None)
+    assert items()[D0]["distro_open"] is False
+    assert items()[D0]["closed_by"] == "controller"
+    assert items()[D1]["distro_open"] is True
+
+
+def test_last_open_instance_is_never_closed(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}, {"domain": D1, "distro_open": True}])
+    handler.handler({"Records": [report(D0, "stale", 1), report(D1, "stale", 1)]}, None)
+    assert items()[D0]["distro_open"] or items()[D1]["distro_open"]
+
+
+def test_recovered_instance_is_reopened_but_not_one_closed_by_an_operator(load_handler):
+    handler, items = load_handler([
+        {"domain": D0, "distro_open": False, "closed_by": "controller"},
+        {"domain": D1, "distro_open": False, "closed_by": "operator"},
+        {"domain": "d2.cloudfront.net", "distro_open": True}
+    ])
+    handler.handler({"Records": [report(D0, "fresh", 1), report(D1, "fresh", 1)]}, None)
+    assert items()[D0]["distro_open"] is True
+    assert items()[D1]["distro_open"] is False
+
+
+def test_out_of_order_reports_are_ignored(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}], AutomaticFailover="false")
+    handler.handler({"Records": [report(D0, "stale", 2)]}, None)
+    handler.handler({"Records": [report(D0, "fresh", 1)]}, None)
+    assert items()[D0]["playlist_fresh"] is False
+
+
+def test_degraded_segment_delivery_fails_over(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}, {"domain": D1, "distro_open": True}])
+    handler.handler({"Records": [report(D0, "fresh", 1), report(D0, "stale", 1, source="segment-health")]}, None)
+    assert items()[D0]["playlist_fresh"] is True
+    assert items()[D0]["segments_healthy"] is False
+    assert items()[D0]["distro_open"] is False
+
+
+def test_stale_renditions_are_kept_while_the_instance_is_fresh(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}], AutomaticFailover="false")
+    playlists = {"https://origin/out/v1/index_1.m3u8": {"state": "stale"},
+                 "https://origin/out/v1/index_2.m3u8": {"state": "fresh"}}
+    handler.handler({"Records": [report(D0, "fresh", 1, playlists=playlists)]}, None)
+    assert items()[D0]["stale_renditions"] == {"/out/v1/index_1.m3u8"}
+    handler.handler({"Records": [report(D0, "stale", 2, playlists=playlists)]}, None)
+    assert "stale_renditions" not in items()[D0]
+
+
+def test_channels_with_different_paths_fail_over_together(load_handler):
+    handler, items = load_handler([
+        {"domain": D0, "channel_paths": {"news": "news"}},
+        {"domain": D1, "channel_paths": {"ep-1234": "news"}},
+        {"domain": "news#" + D0, "channel": "news", "distro_open": True},
+        {"domain": "news#" + D1, "channel": "news", "distro_open": True}
+    ], ChannelPathSegment="3")
+    handler.handler({"Records": [report(D1, "fresh", 1, "/out/v1/ep-1234/index.m3u8"),
+                                 report(D0, "stale", 1, "/out/v1/news/index.m3u8")]}, None)
+    assert items()["news#" + D1]["playlist_fresh"] is True
+    assert items()["news#" + D0]["distro_open"] is False
+    # a made up path segment is the distribution's own item
+    handler.handler({"Records": [report(D0, "fresh", 2, "/out/v1/weather/index.m3u8")]}, None)
+    assert "weather#" + D0 not in items()
+    assert items()[D0]["playlist_fresh"] is True
+
+
+def test_playlist_paths_are_kept_for_the_invalidator(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}], AutomaticFailover="false")
+    playlists = {"https://origin/out/v1/index_1.m3u8": {"state": "fresh"},
+                 "https://origin/out/v1/index_2.m3u8": {"state": "fresh"}}
+    handler.handler({"Records": [report(D0, "fresh", 1, playlists=playlists)]}, None)
+    assert items()[D0]["playlist_paths"] == {"/out/v1/index.m3u8", "/out/v1/index_1.m3u8", "/out/v1/index_2.m3u8"}
+
+
+def test_failed_channel_lookup_fails_the_invocation(load_handler):
+    handler, items = load_handler([
+        {"domain": D0, "channel_paths": {"news": "news"}},
+        {"domain": "news#" + D0, "channel": "news", "distro_open": True},
+        {"domain": D1, "distro_open": True}
+    ], ChannelPathSegment="3", AutomaticFailover="false")
+    table_get_item = handler.table.get_item
+
+    def get_item(Key, **kwargs):
+        if Key["domain"] == D0:
+            raise RuntimeError("AccessDenied")
+        return table_get_item(Key=Key, **kwargs)
+    handler.table.get_item = get_item
+    with pytest.raises(RuntimeError):
+        handler.handler({"Records": [report(D0, "stale", 1, "/out/v1/news/index.m3u8"),
+                                     report(D1, "stale", 1, "/out/v1/news/index.m3u8")]}, None)
+    # the other report is still written
+    assert items()[D1]["playlist_fresh"] is False
+    assert "playlist_fresh" not in items()["news#" + D0]
+
+
+def test_malformed_reports_are_skipped(load_handler):
+    handler, items = load_handler([{"domain": D0, "distro_open": True}], AutomaticFailover="false")
+    assert handler.handler({"Records": [{"Sns": {"Message": "not json"}}, report(D0, "stale", 1)]}, None)
+    assert items()[D0]["playlist_fresh"] is False
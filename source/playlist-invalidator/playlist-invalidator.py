@@ -0,0 +1,134 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Invalidate the cached playlists of this region's stream instance when its
+# state changes, so viewers see a failover without waiting for cache expiry.
+#
+# The copilot only runs on cache misses. Until cached playlists expire, a
+# closed distribution keeps serving them, and a reopened one keeps serving the
+# 404s it cached while it was closed.
+#
+# This function reads the stream of the state table replica in its region and
+# only acts on the stream instance of CloudfrontDistributionId, so each
+# distribution is invalidated once and not by every region. Changes to
+# distro_open, drain_percent and stale_renditions from the detector, the failover controller or
+# an operator are handled alike. All changes in a batch become one
+# invalidation, and a new invalidation waits until MinIntervalSeconds have
+# passed since the last one and fewer than MaxInProgress are running, so a
+# flapping stream instance cannot use up the invalidation quota.
+#
+# Only the playlists of the changed items are invalidated: the playlist and
+# variant playlists in playlist_paths, which the PlaylistAlertHandler keeps
+# from the detector reports. Segments never change, so invalidating them
+# would only send every viewer back to the origin at once. InvalidationPaths
+# replaces playlist_paths, for example with /* to invalidate everything, and
+# is needed for stream instances without a stale playlist detector.
+#
+# In a multi-tenant table the items of every channel served by the
+# distribution ("<channel>#<domain>") are handled like its own item, each
+# with the playlist paths of its channel.
+
+import json
+import boto3
+import os
+import time
+from datetime import datetime, timezone
+from boto3.dynamodb.types import TypeDeserializer
+
+distribution_id = os.environ['CloudfrontDistributionId']
+configured_paths = [x.strip() for x in os.environ.get('InvalidationPaths', '').split(',') if x.strip()]
+min_interval = int(os.environ.get('MinIntervalSeconds', '10'))
+max_in_progress = int(os.environ.get('MaxInProgress', '5'))
+
+cloudfront = boto3.client('cloudfront')
+deserializer = TypeDeserializer()
+
+# changes of these attributes change what the copilot answers
+TRACKED = ["distro_open", "drain_percent", "stale_renditions"]
+
+# seconds between checks while too many invalidations are in progress
+IN_PROGRESS_WAIT = 5
+
+# seconds of the invocation kept free to return before the timeout
+TIMEOUT_MARGIN = 5
+
+domain = None
+
+
+def get_domain():
+    # looked up once per container
+    global domain
+    if domain is None:
+        domain = cloudfront.get_distribution(Id=distribution_id)["Distribution"]["DomainName"]
+    return domain
+
+
+def images(record):
+    change = record["dynamodb"]
+    old = {k: deserializer.deserialize(v) for k, v in change.get("OldImage", {}).items()}
+    new = {k: deserializer.deserialize(v) for k, v in change.get("NewImage", {}).items()}
+    return old, new
+
+
+def changed(old, new):
+    return [name for name in TRACKED if old.get(name) != new.get(name)]
+
+
+def wait_for_slot(context):
+    """
+    Wait until an invalidation may be created. Raises if that takes longer
+    than the invocation has left, so the batch is retried.
+    """
+    while True:
+        response = cloudfront.list_invalidations(DistributionId=distribution_id, MaxItems="25")
+        items = response["InvalidationList"].get("Items", [])
+        in_progress = sum(1 for x in items if x["Status"] == "InProgress")
+        age = min([(datetime.now(timezone.utc) - x["CreateTime"]).total_seconds() for x in items] or [min_interval])
+        if in_progress >= max_in_progress:
+            wait = IN_PROGRESS_WAIT
+        else:
+            wait = max(0, min_interval - age)
+        if wait <= 0:
+            return
+        if context is not None and context.get_remaining_time_in_millis() / 1000.0 < wait + TIMEOUT_MARGIN:
+            raise RuntimeError("invalidation of {} is rate limited, {} in progress".format(distribution_id, in_progress))
+        print(json.dumps({"rate_limited": distribution_id, "wait": wait, "in_progress": in_progress}))
+        time.sleep(wait)
+
+
+def handler(event, context):
+    own_domain = get_domain()
+    reasons = set()
+    paths = set(configured_paths)
+    last_sequence = None
+    for record in event["Records"]:
+        key = deserializer.deserialize(record["dynamodb"]["Keys"]["domain"])
+        if key.rsplit("#", 1)[-1] != own_domain:
+            continue
+        old, new = images(record)
+        attributes = changed(old, new)
+        if not attributes:
+            continue
+        if not configured_paths:
+            known = set(new.get("playlist_paths", ())) | set(old.get("playlist_paths", ()))
+            if not known:
+                print(json.dumps({"skipped": key, "reason": "no playlist_paths, set InvalidationPaths"}))
+                continue
+            paths.update(known)
+        reasons.update(attributes)
+        last_sequence = record["dynamodb"]["SequenceNumber"]
+    if not reasons:
+        return True
+    paths = sorted(paths)
+    wait_for_slot(context)
+    # the reference is the same when a failed batch is retried, so CloudFront
+    # returns the invalidation already created instead of a new one
+    response = cloudfront.create_invalidation(
+        DistributionId=distribution_id,
+        InvalidationBatch={
+            "Paths": {"Quantity": len(paths), "Items": paths},
+            "CallerReference": "{}-{}".format(own_domain, last_sequence)
+        })
+    print(json.dumps({"invalidation": response["Invalidation"]["Id"], "distribution": distribution_id,
+                      "paths": paths, "changed": sorted(reasons)}))
+    return True
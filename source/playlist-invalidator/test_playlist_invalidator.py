@@ -0,0 +1,83 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the playlist invalidator. CloudFront is replaced with a fake,
+# no AWS account is needed.
+
+import importlib.util
+import os
+
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+serializer = TypeSerializer()
+
+
+class FakeCloudFront:
+    def __init__(self):
+        self.invalidations = []
+
+    def list_invalidations(self, **kwargs):
+        return {"InvalidationList": {}}
+
+    def create_invalidation(self, DistributionId, InvalidationBatch):
+        self.invalidations.append(InvalidationBatch)
+        return {"Invalidation": {"Id": "I{}".format(len(self.invalidations))}}
+
+
+@pytest.fixture
+def load_invalidator(monkeypatch):
+    def load(paths=""):
+        for name, value in (("CloudfrontDistributionId", "E123"), ("InvalidationPaths", paths),
+                            ("MinIntervalSeconds", "0"), ("AWS_DEFAULT_REGION", "us-west-2")):
+            monkeypatch.setenv(name, value)
+        spec = importlib.util.spec_from_file_location("playlist_invalidator",
+                                                      os.path.join(HERE, "playlist-invalidator.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.domain = "d0.cloudfront.net"
+        module.cloudfront = FakeCloudFront()
+        return module
+    return load
+
+
+def record(key, old, new, sequence="1"):
+    return {"eventName": "MODIFY", "dynamodb": {
+        "Keys": {"domain": serializer.serialize(key)},
+        "OldImage": {k: serializer.serialize(v) for k, v in old.items()},
+        "NewImage": {k: serializer.serialize(v) for k, v in new.items()},
+        "SequenceNumber": sequence
+    }}
+
+
+PLAYLISTS = {"/out/v1/index.m3u8", "/out/v1/index_1.m3u8"}
+
+
+def test_only_the_playlists_of_changed_items_are_invalidated(load_invalidator):
+    invalidator = load_invalidator()
+    invalidator.handler({"Records": [
+        record("d0.cloudfront.net", {"distro_open": True, "playlist_paths": PLAYLISTS},
+               {"distro_open": False, "playlist_paths": PLAYLISTS}),
+        record("sport#d0.cloudfront.net", {"playlist_fresh": True, "playlist_paths": {"/out/v1/sport/index.m3u8"}},
+               {"playlist_fresh": False, "playlist_paths": {"/out/v1/sport/index.m3u8"}}),
+        record("d1.cloudfront.net", {"distro_open": True, "playlist_paths": {"/other.m3u8"}},
+               {"distro_open": False, "playlist_paths": {"/other.m3u8"}})
+    ]}, None)
+    [batch] = invalidator.cloudfront.invalidations
+    assert batch["Paths"]["Items"] == sorted(PLAYLISTS)
+
+
+def test_items_without_playlist_paths_are_not_invalidated(load_invalidator):
+    invalidator = load_invalidator()
+    invalidator.handler({"Records": [record("d0.cloudfront.net", {"distro_open": True}, {"distro_open": False})]},
+                        None)
+    assert invalidator.cloudfront.invalidations == []
+
+
+def test_configured_paths_replace_the_playlists(load_invalidator):
+    invalidator = load_invalidator("/*")
+    invalidator.handler({"Records": [record("d0.cloudfront.net", {"distro_open": True}, {"distro_open": False})]},
+                        None)
+    [batch] = invalidator.cloudfront.invalidations
+    assert batch["Paths"] == {"Quantity": 1, "Items": ["/*"]}
@@ -0,0 +1,420 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Segment delivery health check for one stream instance.
+#
+# The stale playlist detector notices an origin that stops producing
+# segments. This service notices one that still produces them but delivers
+# them too slowly or with errors for players to keep up. Once per sample
+# interval it downloads the newest segment of every variant playlist, like a
+# player would, and keeps the time to first byte, the throughput and the
+# outcome of every download of the last SHC_WINDOW_SECONDS. The stream
+# instance is degraded when, over that window:
+#
+#   the 95th percentile of the time to first byte is above SHC_MAX_TTFB_MS
+#   the 10th percentile of the download speed, the segment duration divided
+#   by the download time, is below SHC_MIN_SPEED
+#   the fraction of failed downloads is above SHC_MAX_ERROR_RATE
+#
+# The state changes after SHC_DEGRADED_AFTER degraded or SHC_HEALTHY_AFTER
+# healthy evaluations in a row, so a single slow download does not fail a
+# region over and back. Every change is published in the report shape of the
+# stale playlist detector, with detector.source "segment-health" and
+# detector.state "stale" while degraded and "fresh" while healthy. The
+# PlaylistAlertHandler keeps these reports apart from the stale playlist
+# reports of the same stream instance.
+#
+# Required environment variables:
+# SHC_ORIGIN_URL = master playlist endpoint of the origin (http or https)
+# SHC_CDN_URL = CDN endpoint of the master playlist, identifies the stream instance in the state table
+#
+# Optional environment variables:
+# SHC_SAMPLE_URL = master playlist to sample segments from (default: SHC_ORIGIN_URL)
+# SHC_NAME = anything to identify this instance of the health check for humans (default: Segment Health Check)
+# SHC_REGION = desired AWS region string (default: us-west-2)
+# SHC_SNS_TOPIC = topic arn (AWS ARN)
+# SHC_SQS_URL = queue endpoint (https)
+# SHC_WINDOW_SECONDS = seconds of downloads kept for the percentiles (default: 60)
+# SHC_SAMPLE_INTERVAL = seconds between samples of every variant (default: the segment duration)
+# SHC_MIN_SAMPLES = downloads needed in the window before the state is judged (default: 10)
+# SHC_TIMEOUT = seconds before a download counts as failed (default: 10)
+# SHC_MAX_TTFB_MS = highest 95th percentile of the time to first byte (default: 1000)
+# SHC_MIN_SPEED = lowest 10th percentile of the download speed (default: 1.5)
+# SHC_MAX_ERROR_RATE = highest fraction of failed downloads (default: 0.05)
+# SHC_DEGRADED_AFTER = degraded evaluations in a row before reporting degraded (default: 3)
+# SHC_HEALTHY_AFTER = healthy evaluations in a row before reporting healthy (default: 6)
+# SHC_LOG_LEVEL = DEBUG, INFO, WARNING or ERROR (default: INFO)
+#
+# Sampling through the CDN measures what viewers get, but the copilot blocks
+# every request to a closed stream instance, so the instance stays degraded
+# until an operator opens it. The default samples the origin, which is never
+# blocked.
+#
+# Setting SHC_SNS_TOPIC or SHC_SQS_URL requires credentials that allow
+# sns:Publish or sqs:SendMessage, found the usual way by boto3.
+
+import collections
+import json
+import logging
+import math
+import os
+import re
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+logger = logging.getLogger("segment-health-check")
+
+SOURCE = "segment-health"
+
+# sample interval until a segment duration has been seen
+DEFAULT_INTERVAL = 2.0
+
+# seconds between attempts to read the master playlist at start
+RETRY_PAUSE = 5
+
+Sample = collections.namedtuple("Sample", ["at", "ok", "ttfb_ms", "throughput_bps", "speed"])
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list, None for an empty list
+    """
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def summarize(samples):
+    """
+    Return the error rate and the percentiles of a list of samples
+    """
+    ok = [x for x in samples if x.ok]
+    ttfb = sorted(x.ttfb_ms for x in ok)
+    throughput = sorted(x.throughput_bps for x in ok)
+    speed = sorted(x.speed for x in ok)
+
+    def rounded(value, digits):
+        return None if value is None else round(value, digits)
+
+    return {
+        "samples": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_rate": rounded((len(samples) - len(ok)) / float(len(samples)), 4) if samples else None,
+        "ttfb_p50_ms": rounded(percentile(ttfb, 0.5), 1),
+        "ttfb_p95_ms": rounded(percentile(ttfb, 0.95), 1),
+        "ttfb_p99_ms": rounded(percentile(ttfb, 0.99), 1),
+        "throughput_p5_bps": rounded(percentile(throughput, 0.05), 0),
+        "throughput_p50_bps": rounded(percentile(throughput, 0.5), 0),
+        "speed_p10": rounded(percentile(speed, 0.1), 3),
+        "speed_p50": rounded(percentile(speed, 0.5), 3)
+    }
+
+
+def breaches(summary, options):
+    """
+    Return the reasons a summary is degraded, an empty list if it is healthy
+    """
+    reasons = []
+    if summary["error_rate"] is not None and summary["error_rate"] > options["max_error_rate"]:
+        reasons.append("error rate {} above {}".format(summary["error_rate"], options["max_error_rate"]))
+    if summary["ttfb_p95_ms"] is not None and summary["ttfb_p95_ms"] > options["max_ttfb_ms"]:
+        reasons.append("ttfb p95 {} ms above {} ms".format(summary["ttfb_p95_ms"], options["max_ttfb_ms"]))
+    if summary["speed_p10"] is not None and summary["speed_p10"] < options["min_speed"]:
+        reasons.append("speed p10 {} below {}".format(summary["speed_p10"], options["min_speed"]))
+    return reasons
+
+
+class Window:
+    """
+    Samples of the last seconds, oldest first
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = collections.deque()
+
+    def add(self, sample):
+        self.samples.append(sample)
+
+    def prune(self, now):
+        while self.samples and self.samples[0].at < now - self.seconds:
+            self.samples.popleft()
+
+
+class Hysteresis:
+    """
+    Reported state that only changes after a run of opposite verdicts
+    """
+
+    def __init__(self, degraded_after, healthy_after):
+        self.degraded_after = degraded_after
+        self.healthy_after = healthy_after
+        self.state = None
+        self.run = 0
+
+    def update(self, healthy):
+        """
+        Add a verdict, return True if the state changed. The first verdict
+        sets the state.
+        """
+        state = "fresh" if healthy else "stale"
+        if self.state is None:
+            self.state = state
+            return True
+        if state == self.state:
+            self.run = 0
+            return False
+        self.run += 1
+        if self.run < (self.healthy_after if healthy else self.degraded_after):
+            return False
+        self.state = state
+        self.run = 0
+        return True
+
+
+def parse_playlist(body, url):
+    """
+    Return the variant playlist URLs of a master playlist, or
+    [(duration, segment URL)] of a media playlist
+    """
+    lines = [line.strip() for line in body.splitlines() if line.strip()]
+    if any(line.startswith("#EXT-X-STREAM-INF") for line in lines):
+        return [urljoin(url, line) for line in lines if not line.startswith("#")]
+    segments = []
+    duration = None
+    for line in lines:
+        match = re.match(r"^#EXTINF:([\d.]+)", line)
+        if match:
+            duration = float(match.group(1))
+        elif not line.startswith("#") and duration is not None:
+            segments.append((duration, urljoin(url, line)))
+            duration = None
+    return segments
+
+
+def download(url, timeout):
+    """
+    GET a URL. Return (status, body, seconds to the first byte of the
+    response, seconds to the last byte), status 0 when no response came.
+    """
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            first = time.monotonic()
+            body = response.read()
+            return response.status, body, first - start, time.monotonic() - start
+    except urllib.error.HTTPError as error:
+        return error.code, b"", time.monotonic() - start, time.monotonic() - start
+    except (urllib.error.URLError, socket.timeout, OSError) as error:
+        logger.info("{} failed: {}".format(url, error))
+        return 0, b"", None, None
+
+
+class SegmentHealthCheck(threading.Thread):
+    """
+    Samples the segments of one stream instance and publishes a report to
+    publish(report) on every change of its state
+    """
+
+    def __init__(self, options, publish):
+        super().__init__(daemon=True)
+        self.options = options
+        self.publish = publish
+        self.windows = {}
+        self.last_segment = {}
+        self.segment_duration = None
+        self.state = Hysteresis(options["degraded_after"], options["healthy_after"])
+        self.lock = threading.Lock()
+        # start time orders reports across restarts, when sequence resets
+        self.started = int(time.time() * 1000)
+        self.sequence = 0
+        self.stopped = threading.Event()
+
+    def load_variants(self):
+        """
+        Return the variant playlist URLs, the sample URL itself if it is a
+        media playlist, or None when stopped before it could be read
+        """
+        url = self.options["sample_url"]
+        while not self.stopped.is_set():
+            status, body, _, _ = download(url, self.options["timeout"])
+            if status == 200:
+                entries = parse_playlist(body.decode(errors="replace"), url)
+                if entries and isinstance(entries[0], str):
+                    return entries
+                return [url]
+            logger.warning("{} returned {}, retrying".format(url, status))
+            self.stopped.wait(RETRY_PAUSE)
+        return None
+
+    def record(self, variant, ok, ttfb=None, total=None, size=0, duration=None):
+        now = time.monotonic()
+        if ok:
+            total = max(total, 1e-6)
+            sample = Sample(now, True, ttfb * 1000, size * 8 / total, duration / total)
+        else:
+            sample = Sample(now, False, None, None, None)
+        with self.lock:
+            self.windows[variant].add(sample)
+
+    def sample(self, variant):
+        """
+        Download the newest segment of a variant playlist if it is new. A
+        playlist that cannot be read counts as a failed download, one that
+        has not changed is left to the stale playlist detector.
+        """
+        timeout = self.options["timeout"]
+        status, body, _, _ = download(variant, timeout)
+        if status != 200:
+            self.record(variant, False)
+            return
+        segments = parse_playlist(body.decode(errors="replace"), variant)
+        if not segments or isinstance(segments[0], str):
+            return
+        duration, url = segments[-1]
+        with self.lock:
+            self.segment_duration = min(duration, self.segment_duration or duration)
+            if self.last_segment.get(variant) == url:
+                return
+            self.last_segment[variant] = url
+        status, data, ttfb, total = download(url, timeout)
+        if status != 200 or total > timeout:
+            self.record(variant, False)
+        else:
+            self.record(variant, True, ttfb, total, len(data), duration)
+
+    def interval(self):
+        return self.options["sample_interval"] or self.segment_duration or DEFAULT_INTERVAL
+
+    def evaluate(self):
+        """
+        Judge the samples in the window and publish a report if the state
+        changed. Returns the report, or None if nothing was published.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for window in self.windows.values():
+                window.prune(now)
+            variants = {url: list(window.samples) for url, window in self.windows.items()}
+        summary = summarize([x for samples in variants.values() for x in samples])
+        logger.info(json.dumps(summary))
+        if summary["samples"] < self.options["min_samples"]:
+            return None
+        reasons = breaches(summary, self.options)
+        if not self.state.update(not reasons):
+            return None
+        playlists = {}
+        for url, samples in variants.items():
+            playlists[url] = summarize(samples)
+            playlists[url]["state"] = "degraded" if breaches(playlists[url], self.options) else "healthy"
+        degraded = sum(1 for x in playlists.values() if x["state"] == "degraded")
+        report = {
+            "options": self.options,
+            "playlists": playlists,
+            "detector": dict(summary, **{
+                "source": SOURCE,
+                "total": len(playlists),
+                "fresh": len(playlists) - degraded,
+                "stale": degraded,
+                "reasons": reasons,
+                "started": self.started,
+                "state": self.state.state,
+                "sequence": self.sequence
+            })
+        }
+        self.sequence += 1
+        self.publish(report)
+        return report
+
+    def run(self):
+        variants = self.load_variants()
+        if variants is None:
+            return
+        for variant in variants:
+            self.windows[variant] = Window(self.options["window_seconds"])
+        with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+            while not self.stopped.is_set():
+                start = time.monotonic()
+                for future in [executor.submit(self.sample, x) for x in variants]:
+                    try:
+                        future.result()
+                    except Exception as error:
+                        logger.error("sample failed: {}".format(error))
+                self.evaluate()
+                self.stopped.wait(max(0, self.interval() - (time.monotonic() - start)))
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Notifier:
+    """
+    Publish reports to SNS and SQS like the stale playlist detector does
+    """
+
+    def __init__(self, region, sns_topic=None, sqs_url=None):
+        self.sns_topic = sns_topic
+        self.sqs_url = sqs_url
+        if sns_topic or sqs_url:
+            import boto3
+            self.sns = boto3.client("sns", region_name=region)
+            self.sqs = boto3.client("sqs", region_name=region)
+
+    def __call__(self, report):
+        message = json.dumps(report)
+        logger.info("notify message = " + message)
+        if self.sqs_url:
+            try:
+                self.sqs.send_message(QueueUrl=self.sqs_url, MessageBody=message)
+            except Exception as error:
+                logger.error("error sending SQS: {}".format(error))
+        if self.sns_topic:
+            try:
+                self.sns.publish(TopicArn=self.sns_topic, Message=message)
+            except Exception as error:
+                logger.error("error sending SNS: {}".format(error))
+
+
+def options_from_environment(environ):
+    # the host of cdn_url is the state table key of the stream instance. A
+    # report for any other host would add an item that the failover
+    # controller counts as an open stream instance.
+    missing = [x for x in ("SHC_ORIGIN_URL", "SHC_CDN_URL") if not environ.get(x)]
+    if missing:
+        raise ValueError("missing required environment variables: {}".format(", ".join(missing)))
+    origin_url = environ["SHC_ORIGIN_URL"]
+    return {
+        "cdn_url": environ["SHC_CDN_URL"],
+        "origin_url": origin_url,
+        "sample_url": environ.get("SHC_SAMPLE_URL") or origin_url,
+        "name": environ.get("SHC_NAME") or "Segment Health Check",
+        "region": environ.get("SHC_REGION") or "us-west-2",
+        "sns_topic": environ.get("SHC_SNS_TOPIC"),
+        "sqs_url": environ.get("SHC_SQS_URL"),
+        "window_seconds": float(environ.get("SHC_WINDOW_SECONDS") or 60),
+        "sample_interval": float(environ.get("SHC_SAMPLE_INTERVAL") or 0),
+        "min_samples": int(environ.get("SHC_MIN_SAMPLES") or 10),
+        "timeout": float(environ.get("SHC_TIMEOUT") or 10),
+        "max_ttfb_ms": float(environ.get("SHC_MAX_TTFB_MS") or 1000),
+        "min_speed": float(environ.get("SHC_MIN_SPEED") or 1.5),
+        "max_error_rate": float(environ.get("SHC_MAX_ERROR_RATE") or 0.05),
+        "degraded_after": int(environ.get("SHC_DEGRADED_AFTER") or 3),
+        "healthy_after": int(environ.get("SHC_HEALTHY_AFTER") or 6)
+    }
+
+
+def main():
+    logging.basicConfig(level=os.environ.get("SHC_LOG_LEVEL", "INFO"),
+                        format="%(asctime)s %(levelname)s %(message)s")
+    options = options_from_environment(os.environ)
+    check = SegmentHealthCheck(options, Notifier(options["region"], options["sns_topic"], options["sqs_url"]))
+    check.run()
+
+
+if __name__ == "__main__":
+    main()
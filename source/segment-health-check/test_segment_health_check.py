@@ -0,0 +1,137 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the segment health check. Samples are built directly and
+# reports are collected from publish, no stream or AWS account is needed.
+
+import pytest
+
+import segment_health_check as shc
+
+ENVIRONMENT = {"SHC_ORIGIN_URL": "https://origin/out/v1/index.m3u8",
+               "SHC_CDN_URL": "https://d0.cloudfront.net/out/v1/index.m3u8"}
+
+
+def good(at, ttfb_ms=100, speed=4.0):
+    return shc.Sample(at, True, ttfb_ms, 5e6, speed)
+
+
+def failed(at):
+    return shc.Sample(at, False, None, None, None)
+
+
+@pytest.fixture
+def check():
+    reports = []
+    options = dict(shc.options_from_environment(ENVIRONMENT), min_samples=4, degraded_after=2, healthy_after=3)
+    check = shc.SegmentHealthCheck(options, reports.append)
+    check.windows["https://origin/out/v1/index_1.m3u8"] = shc.Window(options["window_seconds"])
+    return check, reports
+
+
+def add(check, samples):
+    for sample in samples:
+        check.windows["https://origin/out/v1/index_1.m3u8"].add(sample)
+
+
+def test_percentile_is_the_nearest_rank():
+    values = list(range(1, 101))
+    assert shc.percentile(values, 0.5) == 50
+    assert shc.percentile(values, 0.95) == 95
+    assert shc.percentile(values, 0.01) == 1
+    assert shc.percentile(values, 0) == 1
+    assert shc.percentile([7], 0.99) == 7
+    assert shc.percentile([], 0.5) is None
+
+
+def test_summary_counts_errors_and_skips_them_in_percentiles():
+    summary = shc.summarize([good(0, 100), good(1, 300), failed(2), failed(3)])
+    assert summary["samples"] == 4
+    assert summary["errors"] == 2
+    assert summary["error_rate"] == 0.5
+    assert summary["ttfb_p50_ms"] == 100
+    assert summary["ttfb_p95_ms"] == 300
+    assert shc.summarize([])["error_rate"] is None
+
+
+@pytest.mark.parametrize("samples, reason", [
+    ([good(0)] * 19 + [failed(1)], None),
+    ([good(0)] * 18 + [failed(1)] * 2, "error rate"),
+    ([good(0)] * 18 + [good(1, ttfb_ms=1500)] * 2, "ttfb p95"),
+    ([good(0)] * 8 + [good(1, speed=1.0)] * 2, "speed p10"),
+    ([failed(0)] * 20, "error rate")
+])
+def test_breaches(samples, reason):
+    options = shc.options_from_environment(ENVIRONMENT)
+    reasons = shc.breaches(shc.summarize(samples), options)
+    if reason is None:
+        assert reasons == []
+    else:
+        assert len(reasons) == 1 and reasons[0].startswith(reason)
+
+
+def test_window_drops_old_samples():
+    window = shc.Window(60)
+    for at in (0, 30, 61, 90):
+        window.add(good(at))
+    window.prune(100)
+    assert [x.at for x in window.samples] == [61, 90]
+
+
+def test_hysteresis_changes_state_after_a_run_of_opposite_verdicts():
+    state = shc.Hysteresis(degraded_after=2, healthy_after=3)
+    assert state.update(True) and state.state == "fresh"
+    assert not state.update(False)
+    assert state.update(False) and state.state == "stale"
+    assert not state.update(True)
+    assert not state.update(True)
+    assert state.update(True) and state.state == "fresh"
+
+
+def test_hysteresis_run_resets_on_an_agreeing_verdict():
+    state = shc.Hysteresis(degraded_after=2, healthy_after=2)
+    state.update(True)
+    for healthy in (False, True, False, True, False):
+        assert not state.update(healthy)
+    assert state.state == "fresh"
+
+
+def test_first_verdict_sets_the_state():
+    state = shc.Hysteresis(degraded_after=5, healthy_after=5)
+    assert state.update(False) and state.state == "stale"
+
+
+def test_evaluate_waits_for_enough_samples(check, monkeypatch):
+    check, reports = check
+    monkeypatch.setattr(shc.time, "monotonic", lambda: 10)
+    add(check, [failed(9)] * 3)
+    assert check.evaluate() is None
+    assert reports == []
+
+
+def test_evaluate_publishes_only_state_changes(check, monkeypatch):
+    check, reports = check
+    monkeypatch.setattr(shc.time, "monotonic", lambda: 10)
+    add(check, [good(9)] * 4)
+    assert check.evaluate()["detector"]["state"] == "fresh"
+    assert check.evaluate() is None
+    add(check, [failed(9)] * 4)
+    assert check.evaluate() is None
+    report = check.evaluate()
+    assert report["detector"]["state"] == "stale"
+    assert report["detector"]["source"] == shc.SOURCE
+    assert report["detector"]["sequence"] == 1
+    assert report["options"]["cdn_url"] == ENVIRONMENT["SHC_CDN_URL"]
+    assert report["playlists"]["https://origin/out/v1/index_1.m3u8"]["state"] == "degraded"
+    assert reports == [reports[0], report]
+
+
+@pytest.mark.parametrize("name", ["SHC_CDN_URL", "SHC_ORIGIN_URL"])
+def test_required_environment_variables(name):
+    environment = dict(ENVIRONMENT)
+    del environment[name]
+    with pytest.raises(ValueError, match=name):
+        shc.options_from_environment(environment)
+    environment[name] = ""
+    with pytest.raises(ValueError, match=name):
+        shc.options_from_environment(environment)
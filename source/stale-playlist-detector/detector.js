@@ -37,10 +37,15 @@ class Detector {
         this.options = options;
         // sequence is used to number outbound notifications
         this.internal_sequence = 0;
+        // start time orders notifications across restarts, when sequence resets
+        this.started = Date.now();
         // out playlist objects
         this.playlists = [];
         // last state we notified
         this.last_notified_state = "fresh";
+        // stale playlists in the last notification, so the state table can
+        // block single renditions while the stream instance stays fresh
+        this.last_notified_stale = "";
         // default pause between samples
         this.pause_ms = 500;
         // calculated pause is 1/5 * segment time
@@ -112,25 +117,19 @@ class Detector {
                                         fresh: fresh,
                                         stale: stale,
                                         stale_playlist_percent: (fraction * 100),
-                                        stale_tolerance_percent: (detector.options.stale_tolerance * 100)
+                                        stale_tolerance_percent: (detector.options.stale_tolerance * 100),
+                                        started: detector.started
                                     };
                                     logger.info(`${total} total playlists, ${fresh} fresh, ${stale} stale, ${fraction * 100}% stale, ${detector.options.stale_tolerance * 100}% stale tolerance`);
-                                    if (fraction >= detector.options.stale_tolerance) {
-                                        if (detector.last_notified_state != "stale") {
-                                            report.detector.state = "stale";
-                                            // notify
-                                            report.detector.sequence = detector.internal_sequence++;
-                                            notify(JSON.stringify(report), classobject.options);
-                                            detector.last_notified_state = "stale";
-                                        }
-                                    } else {
-                                        if (detector.last_notified_state != "fresh") {
-                                            report.detector.state = "fresh";
-                                            // notify
-                                            report.detector.sequence = detector.internal_sequence++;
-                                            notify(JSON.stringify(report), classobject.options);
-                                            detector.last_notified_state = "fresh";
-                                        }
+                                    let state = (fraction >= detector.options.stale_tolerance) ? "stale" : "fresh";
+                                    let stale_playlists = detector.playlists.filter((item) => item.fsm.state == "stale").map((item) => item.options.url).sort().join(" ");
+                                    if (detector.last_notified_state != state || detector.last_notified_stale != stale_playlists) {
+                                        report.detector.state = state;
+                                        // notify
+                                        report.detector.sequence = detector.internal_sequence++;
+                                        notify(JSON.stringify(report), classobject.options);
+                                        detector.last_notified_state = state;
+                                        detector.last_notified_stale = stale_playlists;
                                     }
                                 }
                             };
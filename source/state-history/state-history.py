@@ -0,0 +1,200 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Record every change of the state table in an append-only history table and
+# publish failover metrics in CloudWatch Embedded Metric Format.
+#
+# This function reads the stream of the state table replica in its region.
+# Replicated writes appear in every region's stream, so each region keeps a
+# complete history. Metrics are only published for the items of the
+# distribution of this stack, CloudfrontDistributionId, and its channels
+# ("<channel>#<domain>"), so each change is counted once, whoever wrote it.
+#
+# A failed history write fails the invocation, so the stream retries the
+# batch. The history key holds the stream sequence number, so writing a
+# record again replaces it. Records that cannot be parsed are logged and
+# skipped.
+#
+# Metrics, in the ClusteredVideoStream namespace:
+#
+#   DetectionToFlipSeconds  stale detection to the distribution being closed
+#   RecoveryToReopenSeconds fresh again to the distribution being reopened
+#   StaleSeconds            how long a playlist stayed stale
+#   Flips                   distro_open changes
+#   Flaps                   distro_open changes within FlapWindowSeconds of
+#                           the previous change
+
+import json
+import boto3
+import os
+import time
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
+
+history_tablename = os.environ['StateHistoryTable']
+stream_name = os.environ['ClusteredVideoStreamName']
+retention_days = int(os.environ.get('HistoryRetentionDays', '30'))
+flap_window = int(os.environ.get('FlapWindowSeconds', '600'))
+distribution_id = os.environ['CloudfrontDistributionId']
+
+dynamodb = boto3.resource('dynamodb')
+history_table = dynamodb.Table(history_tablename)
+cloudfront = boto3.client('cloudfront')
+deserializer = TypeDeserializer()
+
+NAMESPACE = "ClusteredVideoStream"
+
+# attributes whose changes are recorded
+TRACKED = ["playlist_fresh", "distro_open", "drain_percent", "path_prefix", "closed_by", "stale_renditions",
+           "segments_healthy"]
+
+
+own_domain = None
+
+
+def get_domain():
+    # looked up once per container
+    global own_domain
+    if own_domain is None:
+        own_domain = cloudfront.get_distribution(Id=distribution_id)["Distribution"]["DomainName"]
+    return own_domain
+
+
+def deserialize(image):
+    return {k: deserializer.deserialize(v) for k, v in image.items()}
+
+
+def plain(value):
+    # numbers come back as Decimal, which json cannot write
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (set, frozenset)):
+        return sorted(plain(x) for x in value)
+    return float(value)
+
+
+def changed_attributes(old, new):
+    return {
+        name: {"old": old.get(name), "new": new.get(name)}
+        for name in TRACKED
+        if old.get(name) != new.get(name)
+    }
+
+
+def source_of(old, new, changes):
+    if "playlist_fresh" in changes or "stale_renditions" in changes:
+        return "detector"
+    if "segments_healthy" in changes:
+        return "segment-health-check"
+    # the failover controller stamps controller_updated with every change it makes
+    if old.get("controller_updated") != new.get("controller_updated"):
+        return "controller"
+    return "operator"
+
+
+def last_flip(domain, since, before):
+    """
+    Return the changed_at of the most recent distro_open change for a domain
+    after since (epoch seconds) and before the changed_at key before, or None
+    """
+    response = history_table.query(
+        KeyConditionExpression=Key("domain").eq(domain) & Key("changed_at").between(
+            "{:013d}".format(since * 1000), before),
+        FilterExpression=Attr("flip").eq(True),
+        ScanIndexForward=False,
+        ProjectionExpression="changed_at")
+    # between includes before, the change's own row when a retried batch
+    # has already written it
+    items = [x for x in response["Items"] if x["changed_at"] != before]
+    return items[0]["changed_at"] if items else None
+
+
+def emit_metrics(domain, values, timestamp):
+    """
+    Print one EMF document, CloudWatch Logs turns it into metrics
+    """
+    document = {
+        "_aws": {
+            "Timestamp": int(timestamp * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [["ClusteredVideoStreamName"], ["ClusteredVideoStreamName", "Domain"]],
+                "Metrics": [{"Name": name, "Unit": "Seconds" if name.endswith("Seconds") else "Count"}
+                            for name in values]
+            }]
+        },
+        "ClusteredVideoStreamName": stream_name,
+        "Domain": domain
+    }
+    document.update(values)
+    print(json.dumps(document))
+
+
+def failover_metrics(domain, old, new, changes, timestamp, changed_at):
+    values = {}
+    if "playlist_fresh" in changes and new.get("playlist_fresh") and old.get("stale_since") is not None:
+        values["StaleSeconds"] = max(0, timestamp - float(old["stale_since"]))
+    if "distro_open" in changes and old.get("distro_open") is not None:
+        # an instance closed for slow segment delivery has no stale_since
+        detected = new.get("stale_since", new.get("segments_degraded_since"))
+        if new.get("distro_open") is False and detected is not None:
+            values["DetectionToFlipSeconds"] = max(0, timestamp - float(detected))
+        recovered = [float(new[x]) for x in ("fresh_since", "segments_healthy_since") if new.get(x) is not None]
+        if new.get("distro_open") is True and recovered:
+            values["RecoveryToReopenSeconds"] = max(0, timestamp - max(recovered))
+        values["Flips"] = 1
+        values["Flaps"] = 1 if last_flip(domain, int(timestamp) - flap_window, changed_at) else 0
+    return values
+
+
+def handler(event, context):
+    expires = int(time.time()) + retention_days * 86400
+    documents = []
+    for record in event["Records"]:
+        try:
+            change = record["dynamodb"]
+            old = deserialize(change.get("OldImage", {}))
+            new = deserialize(change.get("NewImage", {}))
+            domain = deserializer.deserialize(change["Keys"]["domain"])
+            changes = changed_attributes(old, new)
+            timestamp = float(change.get("ApproximateCreationDateTime", time.time()))
+            sequence = change["SequenceNumber"]
+            event_name = record["eventName"]
+        except Exception as exception:
+            print(json.dumps({"skipped": record.get("eventID"), "error": repr(exception)}))
+            continue
+        if event_name != "REMOVE" and not changes:
+            # detector sequence and controller bookkeeping only
+            continue
+        source = source_of(old, new, changes)
+        # time first so a domain's history sorts by time, the sequence
+        # number keeps changes within the same second apart
+        changed_at = "{:013d}#{}".format(int(timestamp * 1000), sequence)
+        metrics = {}
+        if domain.rsplit("#", 1)[-1] == get_domain():
+            try:
+                metrics = failover_metrics(domain, old, new, changes, timestamp, changed_at)
+            except (TypeError, ValueError) as exception:
+                # a malformed timestamp on the item costs its metrics, not its history
+                print(json.dumps({"metrics": domain, "error": repr(exception)}))
+        item = {
+            "domain": domain,
+            "changed_at": changed_at,
+            "event": event_name,
+            "source": source,
+            "changes": json.dumps({k: {"old": plain(v["old"]), "new": plain(v["new"])}
+                                   for k, v in changes.items()}),
+            "flip": "distro_open" in changes,
+            "expires": expires
+        }
+        if source == "controller" and new.get("controller_reason"):
+            item["reason"] = new["controller_reason"]
+        history_table.put_item(Item=item)
+        print(json.dumps({"history": domain, "source": source, "changes": item["changes"]}))
+        if metrics:
+            documents.append((domain, metrics, timestamp))
+    # metrics are only published once the whole batch is written, so a
+    # retried batch does not count its changes twice
+    for domain, metrics, timestamp in documents:
+        emit_metrics(domain, metrics, timestamp)
+    return True
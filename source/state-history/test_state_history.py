@@ -0,0 +1,119 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+# Unit tests of the StateHistory function. The history table is replaced with
+# a fake and the domain of the distribution is set directly, no AWS account
+# is needed.
+
+import importlib.util
+import json
+import os
+
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+serializer = TypeSerializer()
+
+
+class FakeHistoryTable:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.items = []
+
+    def put_item(self, Item):
+        if self.fail:
+            raise RuntimeError("throttled")
+        self.items.append(Item)
+
+    def query(self, **kwargs):
+        # the written flips of every domain, newest first; the tests use one
+        # domain and times within the flap window
+        flips = [{"changed_at": x["changed_at"]} for x in self.items if x["flip"]]
+        return {"Items": sorted(flips, key=lambda x: x["changed_at"], reverse=True)}
+
+
+@pytest.fixture
+def history(monkeypatch):
+    for name, value in (("StateHistoryTable", "cvs-history"), ("ClusteredVideoStreamName", "cvs"),
+                        ("CloudfrontDistributionId", "E123"), ("AWS_REGION", "us-west-2"),
+                        ("AWS_DEFAULT_REGION", "us-west-2")):
+        monkeypatch.setenv(name, value)
+    spec = importlib.util.spec_from_file_location("state_history", os.path.join(HERE, "state-history.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.own_domain = "d0.cloudfront.net"
+    module.history_table = FakeHistoryTable()
+    return module
+
+
+def record(domain, old, new, sequence="1"):
+    return {
+        "eventID": sequence,
+        "eventName": "MODIFY",
+        "dynamodb": {
+            "Keys": {"domain": serializer.serialize(domain)},
+            "OldImage": {k: serializer.serialize(v) for k, v in old.items()},
+            "NewImage": {k: serializer.serialize(v) for k, v in new.items()},
+            "SequenceNumber": sequence,
+            "ApproximateCreationDateTime": 1000
+        }
+    }
+
+
+def metric_documents(output):
+    return [json.loads(x) for x in output.splitlines() if x.startswith('{"_aws"')]
+
+
+def test_metrics_of_own_distribution_without_region(history, capsys):
+    # written by the PlaylistAlertHandler, which never sets region
+    history.handler({"Records": [
+        record("news#d0.cloudfront.net", {"distro_open": True}, {"distro_open": False, "stale_since": 990})
+    ]}, None)
+    documents = metric_documents(capsys.readouterr().out)
+    assert len(documents) == 1
+    assert documents[0]["DetectionToFlipSeconds"] == 10
+    assert documents[0]["Flips"] == 1
+
+
+def test_no_metrics_for_other_distributions(history, capsys):
+    history.handler({"Records": [
+        record("d1.cloudfront.net", {"distro_open": True, "region": "us-west-2"}, {"distro_open": False,
+                                                                                  "region": "us-west-2"})
+    ]}, None)
+    assert metric_documents(capsys.readouterr().out) == []
+    assert len(history.history_table.items) == 1
+
+
+def test_failed_history_write_fails_the_batch(history):
+    history.history_table = FakeHistoryTable(fail=True)
+    with pytest.raises(RuntimeError):
+        history.handler({"Records": [record("d0.cloudfront.net", {"distro_open": True}, {"distro_open": False})]},
+                        None)
+
+
+def test_unparseable_records_are_skipped(history):
+    broken = record("d0.cloudfront.net", {}, {"distro_open": False}, "1")
+    del broken["dynamodb"]["Keys"]
+    history.handler({"Records": [broken, record("d0.cloudfront.net", {"distro_open": True},
+                                                {"distro_open": False}, "2")]}, None)
+    assert [x["changed_at"] for x in history.history_table.items] == ["0000001000000#2"]
+
+
+def test_retried_batch_does_not_count_its_own_flip_as_a_flap(history, capsys):
+    batch = {"Records": [record("d0.cloudfront.net", {"distro_open": True}, {"distro_open": False})]}
+    history.handler(batch, None)
+    capsys.readouterr()
+    # the history row is already written when the batch is retried
+    history.handler(batch, None)
+    documents = metric_documents(capsys.readouterr().out)
+    assert [x["Flaps"] for x in documents] == [0]
+
+
+def test_flip_after_an_earlier_flip_is_a_flap(history, capsys):
+    history.handler({"Records": [
+        record("d0.cloudfront.net", {"distro_open": True}, {"distro_open": False}, "1"),
+        record("d0.cloudfront.net", {"distro_open": False}, {"distro_open": True}, "2")
+    ]}, None)
+    documents = metric_documents(capsys.readouterr().out)
+    assert [x["Flaps"] for x in documents] == [0, 1]